@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+
+# Admission control for conversions: per client rate limits and a fair queue
+
+import ipaddress, math, threading, time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+
+from convert_executor import ExecutorBusy
+
+
+class RateLimited(Exception):
+    """The client is over its conversion budget, retry after retry_after seconds."""
+    def __init__(self, retry_after):
+        super().__init__(f"retry after {retry_after}s")
+        self.retry_after = retry_after
+
+
+def client_key(address, prefix_v4=32, prefix_v6=64):
+    """The network a client address is counted in, e.g. its IPv6 /64."""
+    try:
+        ip = ipaddress.ip_address(address)
+    except ValueError:
+        return address
+    if ip.version == 6 and ip.ipv4_mapped:
+        ip = ip.ipv4_mapped
+    prefix = prefix_v4 if ip.version == 4 else prefix_v6
+    return str(ipaddress.ip_network((ip, prefix), strict=False))
+
+
+class RateLimiter:
+    """Token bucket per client: `burst` conversions at once, refilled at
+    `rate` per second. Only the `max_clients` most recently seen clients are
+    remembered, a forgotten one starts with a full bucket again.
+    """
+    def __init__(self, rate, burst, max_clients=100000):
+        self.rate = rate
+        self.burst = burst
+        self.max_clients = max_clients
+        self.lock = threading.Lock()
+        # client -> (tokens, monotonic time of the last update)
+        self.buckets = OrderedDict()
+        self.limited = 0
+
+    def take(self, client, now=None):
+        """Take a token, raises RateLimited if there is none."""
+        if self.rate is None:
+            return
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            (tokens, last) = self.buckets.pop(client, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+            if tokens >= 1:
+                tokens -= 1
+                wait = 0
+            else:
+                self.limited += 1
+                wait = (1 - tokens) / self.rate if self.rate > 0 else math.inf
+            self.buckets[client] = (tokens, now)
+            while len(self.buckets) > self.max_clients:
+                self.buckets.popitem(last=False)
+        if wait:
+            raise RateLimited(math.ceil(wait) if wait != math.inf else 3600)
+
+    def give(self, client):
+        """Return the token of a conversion turned away after take()."""
+        if self.rate is None:
+            return
+        with self.lock:
+            if client in self.buckets:
+                (tokens, last) = self.buckets[client]
+                self.buckets[client] = (min(self.burst, tokens + 1), last)
+
+    def stats(self):
+        with self.lock:
+            return {'clients': len(self.buckets), 'limited': self.limited}
+
+
+class FairGate:
+    """At most `limit` conversions at a time, the others wait in a queue per
+    client. A free slot goes to the clients in turn, so one client with many
+    uploads waits behind everybody else instead of in front.
+
+    A client may have `per_client` requests waiting (RateLimited beyond
+    that), all clients `max_waiting` (ExecutorBusy). Nobody waits longer
+    than `timeout` seconds (ExecutorBusy).
+    """
+    def __init__(self, limit, max_waiting, per_client, timeout):
+        self.limit = limit
+        self.max_waiting = max_waiting
+        self.per_client = per_client
+        self.timeout = timeout
+        self.cond = threading.Condition()
+        self.running = 0
+        # client -> deque of tickets, in the order clients get their turn
+        self.queues = OrderedDict()
+        self.waiting = 0
+        self.admitted = 0
+        self.queued = 0
+        self.rejected = 0
+        self.timeouts = 0
+        self.wait_seconds = 0.0
+
+    @contextmanager
+    def slot(self, client):
+        self.acquire(client)
+        try:
+            yield
+        finally:
+            self.release()
+
+    def acquire(self, client):
+        with self.cond:
+            if self.running < self.limit and not self.waiting:
+                self.running += 1
+                self.admitted += 1
+                return
+            queue = self.queues.get(client)
+            if queue is not None and len(queue) >= self.per_client:
+                self.rejected += 1
+                raise RateLimited(1)
+            if self.waiting >= self.max_waiting:
+                self.rejected += 1
+                raise ExecutorBusy()
+            ticket = {'granted': False}
+            self.queues.setdefault(client, deque()).append(ticket)
+            self.waiting += 1
+            self.queued += 1
+            t0 = time.monotonic()
+            granted = self.cond.wait_for(lambda: ticket['granted'], self.timeout)
+            self.wait_seconds += time.monotonic() - t0
+            if not granted:
+                queue = self.queues[client]
+                queue.remove(ticket)
+                if not queue:
+                    del self.queues[client]
+                self.waiting -= 1
+                self.timeouts += 1
+                raise ExecutorBusy()
+            self.admitted += 1
+
+    def release(self):
+        with self.cond:
+            self.running -= 1
+            while self.running < self.limit and self.queues:
+                # first client in turn, moved to the end if it has more waiting
+                (client, queue) = self.queues.popitem(last=False)
+                queue.popleft()['granted'] = True
+                if queue:
+                    self.queues[client] = queue
+                self.waiting -= 1
+                self.running += 1
+            self.cond.notify_all()
+
+    def stats(self):
+        with self.cond:
+            return {
+                'limit': self.limit,
+                'running': self.running,
+                'waiting': self.waiting,
+                'waiting_clients': len(self.queues),
+                'admitted': self.admitted,
+                'queued': self.queued,
+                'rejected': self.rejected,
+                'timeouts': self.timeouts,
+                'wait_seconds': round(self.wait_seconds, 3),
+            }
@@ -0,0 +1,504 @@
+#!/usr/bin/env python3
+
+# Benchmarks of the dtb -> dtbo pipeline on a synthetic corpus of stock-like dtbs
+#
+#   ./bench_dtbo.py -o base.json               # record a baseline
+#   ./bench_dtbo.py --compare base.json        # exits 1 if something got slower
+#   ./bench_dtbo.py --hostile                  # exits 1 if a crafted dtb is not contained
+
+import os, sys, io, json, math, time, random, shutil, struct, hashlib, statistics, tempfile, tracemalloc, logging
+import collections
+import fdt
+
+import rocknix_dtbo
+import fdt_reader
+import init_sequence
+
+STAGES = ['parse', 'panel', 'modes', 'gpio', 'assemble', 'serialize']
+FLAGSETS = [[], ['LSi'], ['HPi'], ['Dno'], ['JPmm', 'RSi']]
+
+
+def make_stock_dtb(soc='rk3326', timings=1, iseq_cmds=40, adc_keys=True, joystick=True,
+                   sound=True, filler=600, seed=0):
+    """Build a dtb shaped like the stock R36S-ish ones the server gets."""
+    rnd = random.Random(seed)
+    dt = fdt.FDT()
+    dt.header.version = 17
+    root = dt.root
+    symbols = {}
+    last_phandle = 0
+    def phandle(node):
+        nonlocal last_phandle
+        last_phandle += 1
+        node.set_property('phandle', last_phandle)
+        return last_phandle
+    def add(parent, name):
+        node = fdt.Node(name)
+        parent.append(node)
+        return node
+
+    compat = 'rockchip,rk3326-odroid-go2' if soc == 'rk3326' else 'rockchip,rk3566-anbernic'
+    root.set_property('compatible', [compat, 'rockchip,' + soc])
+    root.set_property('#address-cells', 2)
+
+    pinctrl = add(root, 'pinctrl')
+    base = 0xff040000 if soc == 'rk3326' else 0xfdd60000
+    gpios = []
+    for i in range(4):
+        gpio = add(pinctrl, f'gpio{i}@{base + 0x10000 * i:x}')
+        gpio.set_property('gpio-controller', None)
+        gpios.append(phandle(gpio))
+        symbols[f'gpio{i}'] = '/pinctrl/' + gpio.name
+    pcfg = {}
+    for bias in ('pull-up', 'pull-none', 'pull-down'):
+        node = add(pinctrl, 'pcfg-' + bias)
+        node.set_property('bias-' + bias, None)
+        pcfg[bias] = phandle(node)
+        symbols['pcfg_' + bias.replace('-', '_')] = '/pinctrl/' + node.name
+
+    # unrelated devices, for a realistic tree size
+    for i in range(filler):
+        node = add(root, f'dev{i}@{0xfe000000 + i * 0x100:x}')
+        node.set_property('compatible', f'vendor,dev{i % 37}')
+        node.set_property('reg', [0, 0xfe000000 + i * 0x100, 0, 0x100])
+        node.set_property('status', 'okay' if i % 3 else 'disabled')
+        node.set_property('clocks', [rnd.randrange(1, 200), rnd.randrange(0, 300)])
+        if i % 5 == 0:
+            phandle(node)
+            symbols[f'dev{i}'] = '/' + node.name
+
+    vcc = add(root, 'vcc18-lcd0')
+    vcc.set_property('compatible', 'regulator-fixed')
+    vcc.set_property('gpio', [gpios[0], 2, 0])
+    vcc_phandle = phandle(vcc)
+    symbols['vcc18_lcd'] = '/vcc18-lcd0'
+
+    dsi = add(root, 'dsi@ff450000' if soc == 'rk3326' else 'dsi@fe060000')
+    phandle(dsi)
+    symbols['dsi'] = '/' + dsi.name
+    panel = add(dsi, 'panel@0')
+    panel.set_property('compatible', 'simple-panel-dsi')
+    panel.set_property('reset-gpios', [gpios[3], 13, 1])
+    panel.set_property('power-supply', vcc_phandle)
+    for (name, value) in (('prepare-delay-ms', 2), ('reset-delay-ms', 1), ('init-delay-ms', 20),
+                          ('enable-delay-ms', 120), ('width-mm', 52), ('height-mm', 70),
+                          ('dsi,flags', 0xa03), ('dsi,format', 0), ('dsi,lanes', 4 if soc == 'rk3326' else 2)):
+        panel.set_property(name, value)
+    iseq = bytearray()
+    for i in range(iseq_cmds):
+        n = rnd.randrange(1, 6)
+        iseq += bytes([0x15 if n == 1 else 0x39, rnd.choice([0, 0, 0, 5, 120]), n])
+        iseq += bytes(rnd.randrange(256) for _ in range(n))
+    # a byte string property must not look like a list of words
+    if len(iseq) % 4 == 0:
+        iseq += bytes([0x05, 0x00, 0x01, 0x29, 0x05, 0x00, 0x00])
+    panel.set_property('panel-init-sequence', bytes(iseq))
+
+    display_timings = add(panel, 'display-timings')
+    (hactive, vactive) = (640, 480) if soc == 'rk3326' else (720, 720)
+    modes = []
+    for i in range(timings):
+        timing = add(display_timings, f'timing{i}')
+        hor = (hactive, 40 + i, 2 + (i % 3), 40)
+        ver = (vactive, 18 + i, 4, 10)
+        timing.set_property('clock-frequency', int(round(60 * sum(hor) * sum(ver) * (1 + 0.02 * i), -4)))
+        for (name, value) in zip(('hactive', 'hfront-porch', 'hsync-len', 'hback-porch'), hor):
+            timing.set_property(name, value)
+        for (name, value) in zip(('vactive', 'vfront-porch', 'vsync-len', 'vback-porch'), ver):
+            timing.set_property(name, value)
+        modes.append(phandle(timing))
+    display_timings.set_property('native-mode', modes[0])
+
+    if adc_keys:
+        node = add(root, 'adc-keys')
+        node.set_property('compatible', 'adc-keys')
+    if joystick:
+        node = add(root, 'play_joystick')
+        node.set_property('key-gpios', sum(([gpios[1 + i % 2], i, 1] for i in range(16)), []))
+        buttons = add(pinctrl, 'buttons')
+        pins = add(buttons, 'gpio-key-pin')
+        pins.set_property('rockchip,pins', sum(([1 + i % 2, i, 0, pcfg['pull-up']] for i in range(16)), []))
+    if sound:
+        node = add(root, 'rk817-sound')
+        node.set_property('compatible', 'simple-audio-card')
+        node.set_property('hp-det-gpio', [gpios[2], 6, 0])
+        headphone = add(pinctrl, 'headphone')
+        hpdet = add(headphone, 'hp-det')
+        hpdet.set_property('rockchip,pins', [2, 6, 0, pcfg['pull-down']])
+
+    node = add(root, '__symbols__')
+    for (name, path) in symbols.items():
+        node.set_property(name, path)
+    return dt.to_dtb()
+
+def make_corpus():
+    """name -> stock-like dtb, covering both socs and the optional nodes."""
+    corpus = {}
+    for soc in ('rk3326', 'rk3566'):
+        for (timings, iseq_cmds) in ((1, 40), (3, 120), (8, 300)):
+            corpus[f'{soc}-t{timings}-i{iseq_cmds}'] = make_stock_dtb(soc, timings, iseq_cmds)
+        corpus[f'{soc}-bare'] = make_stock_dtb(soc, adc_keys=False, joystick=False, sound=False)
+        corpus[f'{soc}-noadc'] = make_stock_dtb(soc, adc_keys=False)
+        corpus[f'{soc}-nosound'] = make_stock_dtb(soc, sound=False)
+    return corpus
+
+
+def raw_dtb(structure, strings=b''):
+    """Wrap a structure block (without FDT_END) into a v17 dtb."""
+    structure += struct.pack('>I', 9)
+    off_struct = 40 + 16
+    off_strings = off_struct + len(structure)
+    header = struct.pack('>10I', 0xd00dfeed, off_strings + len(strings), off_struct, off_strings, 40,
+                         17, 16, 0, len(strings), len(structure))
+    return header + bytes(16) + structure + strings
+
+def make_hostile_corpus(mutations=200):
+    """name -> dtb crafted to make the parser or panel_to_desc() work hard.
+
+    Everything stays under the 512K upload limit.
+    """
+    begin = struct.pack('>I', 1)
+    end = struct.pack('>I', 2)
+    corpus = {
+        'deep-nesting': raw_dtb(begin + bytes(4) + (begin + b'a\0\0\0') * 20000 + end * 20001),
+        'many-nodes': raw_dtb(begin + bytes(4) + (begin + b'a\0\0\0' + end) * 40000 + end),
+        'many-props': raw_dtb(begin + bytes(4) + struct.pack('>III', 3, 0, 0) * 40000 + end, b'p\0'),
+    }
+
+    def tweak(name, change):
+        dt = fdt.parse_dtb(make_stock_dtb())
+        change(dt, dt.get_node('/dsi@ff450000/panel@0'))
+        corpus[name] = dt.to_dtb()
+    def many_timings(dt, panel):
+        timings = panel.get_subnode('display-timings')
+        for i in range(1, 2000):
+            node = timings.get_subnode('timing0').copy()
+            node.set_name(f'timing{i}')
+            node.set_property('clock-frequency', 10000000 + 10000 * i)
+            node.set_property('phandle', 0x10000 + i)
+            timings.append(node)
+    def set_timing(prop, value):
+        return lambda dt, panel: panel.get_subnode('display-timings').get_subnode('timing0').set_property(prop, value)
+    def long_iseq(dt, panel):
+        panel.set_property('panel-init-sequence', bytes([0x05, 0, 0]) * 140000 + b'\x05')
+    def truncated_iseq(dt, panel):
+        panel.set_property('panel-init-sequence', bytes([0x39, 0, 0xff]) + bytes(100))
+    tweak('many-timings', many_timings)
+    tweak('huge-vtotal', set_timing('vactive', 0x7fffffff))
+    tweak('huge-htotal', set_timing('hactive', 0x7fffffff))
+    tweak('huge-clock', set_timing('clock-frequency', 0xffffffff))
+    tweak('long-init-sequence', long_iseq)
+    tweak('truncated-init-sequence', truncated_iseq)
+
+    # random corruption of a valid tree
+    good = make_stock_dtb()
+    rnd = random.Random(1)
+    for i in range(mutations):
+        blob = bytearray(good)
+        for _ in range(rnd.randrange(1, 8)):
+            pos = rnd.randrange(40, len(blob) - 4)
+            blob[pos:pos + 4] = struct.pack('>I', rnd.choice([0, 1, 2, 3, 9, 0xffffffff, 0x7fffffff, rnd.randrange(1 << 32)]))
+        corpus[f'mutation{i}'] = bytes(blob)
+    return corpus
+
+def check_hostile(corpus, logger):
+    """Time and peak traced memory of a guarded conversion of each dtb."""
+    def convert(dtb):
+        try:
+            for dtbo in rocknix_dtbo.make_dtbos(dtb, FLAGSETS[:2], {'logger': logger, 'limits': rocknix_dtbo.LIMITS}):
+                if isinstance(dtbo, rocknix_dtbo.ConversionError):
+                    return dtbo.code
+            return 'ok'
+        except rocknix_dtbo.ConversionError as e:
+            return e.code
+        except Exception as e:
+            return 'internal:' + type(e).__name__
+
+    results = {}
+    for (name, dtb) in corpus.items():
+        t0 = time.perf_counter()
+        result = convert(dtb)
+        seconds = time.perf_counter() - t0
+        # again for memory, tracemalloc slows everything down a lot
+        tracemalloc.start()
+        convert(dtb)
+        (_, peak) = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        results[name] = {'ms': round(seconds * 1000, 3), 'peak_kb': peak // 1024, 'size_kb': len(dtb) // 1024,
+                         'result': result}
+    return results
+
+
+def bench_stages(corpus, rounds, logger):
+    """Median ms per stage over rounds, summed over the corpus and flag sets."""
+    results = {}
+    for (name, dtb) in corpus.items():
+        samples = {stage: [] for stage in STAGES + ['total']}
+        for _ in range(rounds):
+            for flags in FLAGSETS:
+                stages = {}
+                t0 = time.perf_counter()
+                rocknix_dtbo.make_dtbo(dtb, {'flags': flags, 'logger': logger, 'stages': stages})
+                stages['total'] = time.perf_counter() - t0
+                for stage in samples:
+                    samples[stage].append(stages.get(stage, 0))
+        results[name] = {stage: statistics.median(s) * 1000 * len(FLAGSETS) for (stage, s) in samples.items()}
+    return results
+
+# (width, height) of panels, from small handheld ones to 1080p
+GEOMETRIES = [(320, 240), (480, 320), (640, 480), (720, 720), (960, 544), (1280, 720), (1920, 1080)]
+TARGET_FPSS = [50/1.001, 50, 50.0070, 57.5, 59.7275, 60/1.001, 60.0988, 75.47, 90, 120]
+
+def brute_mode(targetfps, clock, maxclock, htotal, vtotal, maxvtotal):
+    """The list comprehension solve_mode() replaced, as the reference."""
+    options = [(rocknix_dtbo.absfrac(c*1000/targetfps/vt), c, vt)
+               for vt in range(vtotal, maxvtotal+1)
+               for c in range(clock, maxclock, 10)
+               if ((c*1000/targetfps/vt) >= htotal) and ((c*1000/targetfps/vt) < htotal*1.05)]
+    return min(options) if options else None
+
+def bench_modes(rounds, geometries=GEOMETRIES, brute=True):
+    """Median ms of solving the modes panel_to_desc() adds for a 60Hz panel
+    of each geometry, and once the brute force with the same results."""
+    results = {}
+    for (w, h) in geometries:
+        (htotal, vtotal) = (w + w//10 + 40, h + h//40 + 20)
+        clock = math.ceil(60*htotal*vtotal/10000)*10
+        cases = []
+        for targetfps in TARGET_FPSS:
+            perfectclock = targetfps*htotal*vtotal/1000
+            c = clock if perfectclock <= clock <= 1.25*perfectclock else math.ceil(perfectclock/10)*10
+            cases.append((targetfps, c, round(1.25*perfectclock), htotal, vtotal, round(vtotal*1.25)))
+        samples = []
+        for _ in range(rounds):
+            t0 = time.perf_counter()
+            solved = [rocknix_dtbo.solve_mode(*case) for case in cases]
+            samples.append(time.perf_counter() - t0)
+        results[f'{w}x{h}'] = statistics.median(samples) * 1000
+        if brute:
+            t0 = time.perf_counter()
+            reference = [brute_mode(*case) for case in cases]
+            results[f'{w}x{h}-brute'] = (time.perf_counter() - t0) * 1000
+            if solved != reference:
+                raise RuntimeError(f"{w}x{h}: solve_mode differs from the brute force")
+    return results
+
+def scan_symbol(dt, phandle):
+    """Symbol of the node with phandle the way make_dtbo() looked it up before
+    DtbIndex: a dt.search() of the whole tree and a scan of __symbols__."""
+    node = [p.parent for p in dt.search('phandle', fdt.ItemType.PROP_WORDS) if p.value == phandle][0]
+    path = os.path.join(node.path, node.name)
+    return [p.name for p in dt.get_node('__symbols__').props if p.value == path][0]
+
+def bench_lookups(corpus, rounds):
+    """Median ms of the gpio symbol lookups of a conversion, per dtb: scanning
+    a pyfdt tree per lookup against building a DtbIndex and using it."""
+    results = {}
+    for (name, dtb) in corpus.items():
+        dt = fdt.parse_dtb(dtb)
+        panel = dt.get_node(dt.get_property('dsi', '__symbols__').value + '/panel@0')
+        # gpio controllers of reset, power supply, enable and hp-det, as inspect_dtb() resolves them
+        phandles = [panel.get_property('reset-gpios').data[0]]
+        supply = [p.parent for p in dt.search('phandle', fdt.ItemType.PROP_WORDS)
+                  if p.value == panel.get_property('power-supply').value][0]
+        phandles.append(supply.get_property('gpio').data[0])
+        if panel.exist_property('enable-gpios'):
+            phandles.append(panel.get_property('enable-gpios').data[0])
+        if dt.exist_node('/rk817-sound'):
+            phandles.append(dt.get_node('/rk817-sound').get_property('hp-det-gpio').data[0])
+        lazy = fdt_reader.parse_dtb(dtb)
+        samples = {'scan': [], 'index': []}
+        for _ in range(rounds):
+            t0 = time.perf_counter()
+            scanned = [scan_symbol(dt, phandle) for phandle in phandles]
+            samples['scan'].append(time.perf_counter() - t0)
+            t0 = time.perf_counter()
+            idx = rocknix_dtbo.DtbIndex(lazy)
+            indexed = [rocknix_dtbo.symbol_by_phandle(idx, phandle) for phandle in phandles]
+            samples['index'].append(time.perf_counter() - t0)
+            if scanned != indexed:
+                raise RuntimeError(f"{name}: DtbIndex found {indexed}, scanning {scanned}")
+        for (kind, s) in samples.items():
+            results[f'{name}-{kind}'] = statistics.median(s) * 1000
+    return results
+
+def bench_init_sequence(rounds, sizes=(1, 8, 64)):
+    """Median ms to decode and format init sequences of sizes KB, as bytes and as u32 cells."""
+    rnd = random.Random(0)
+    results = {}
+    for kb in sizes:
+        iseq = bytearray()
+        while len(iseq) < kb * 1024:
+            n = rnd.randrange(1, 40)
+            iseq += bytes([0x39, rnd.choice([0, 0, 5]), n]) + rnd.randbytes(n)
+        while len(iseq) % 4:
+            iseq += bytes([0x05, 0x00, 0x00])
+        dt = fdt.FDT()
+        dt.header.version = 17
+        dt.set_property('panel-init-sequence', bytes(iseq))
+        blob = dt.to_dtb()
+        nodes = {'lazy': fdt_reader.parse_dtb(blob).root, 'words': fdt.parse_dtb(blob).root}
+        for (kind, node) in nodes.items():
+            samples = []
+            for _ in range(rounds):
+                t0 = time.perf_counter()
+                lines = [f"I seq={data.hex()} wait={wait}"
+                         for (_, wait, data) in init_sequence.decode(init_sequence.property_bytes(node))]
+                samples.append(time.perf_counter() - t0)
+            if init_sequence.encode((cmd, wait, data) for (cmd, wait, data) in init_sequence.decode(iseq)) != iseq:
+                raise RuntimeError("init sequence does not round trip")
+            results[f'{kb}k-{kind}'] = statistics.median(samples) * 1000
+    return results
+
+def bench_server(corpus, rounds):
+    """Median ms of /convert_dtb uncached and cached, and of /dtbo/ downloads."""
+    workdir = tempfile.mkdtemp(prefix='bench_dtbo.')
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        # the server keeps its pack/ in the current directory
+        import overlay_server
+        app = overlay_server.app
+        cache = overlay_server.conversion_cache
+        # pre-generated variants would turn cold runs into cache hits
+        overlay_server.speculator.variants = 0
+        # every cold run is a conversion, the benchmark is not a client to limit
+        overlay_server.rate_limiter.rate = None
+        client = app.test_client()
+        samples = {'convert_cold': [], 'convert_warm': [], 'convert_variants_cold': [], 'dtbo_get': []}
+        variants = '&'.join('variant=' + '-'.join(flags) for flags in FLAGSETS)
+
+        def post(dtb, query):
+            t0 = time.perf_counter()
+            response = client.post('/convert_dtb?silent=1' + query,
+                                   data={'file': (io.BytesIO(dtb), 'stock.dtb')})
+            if response.status_code != 200:
+                raise RuntimeError(f"/convert_dtb returned {response.status_code}")
+            return time.perf_counter() - t0
+
+        def forget():
+            with cache.lock:
+                cache.entries.clear()
+                cache.size = 0
+            # equivalent dtbs share overlays too, see FingerprintCache
+            for prefix in ('dtbo/', 'fingerprint/'):
+                for key in list(overlay_server.pack_store.keys(prefix)):
+                    overlay_server.pack_store.delete(key)
+
+        for _ in range(rounds):
+            for (name, dtb) in corpus.items():
+                forget()
+                samples['convert_cold'].append(post(dtb, '&opts=-LSi'))
+                samples['convert_warm'].append(post(dtb, '&opts=-LSi'))
+                forget()
+                samples['convert_variants_cold'].append(post(dtb, '&' + variants))
+                md5 = hashlib.md5(dtb).hexdigest()
+                t0 = time.perf_counter()
+                response = client.get(f'/dtbo/{md5}-LSi')
+                samples['dtbo_get'].append(time.perf_counter() - t0)
+                if response.status_code != 200:
+                    raise RuntimeError(f"/dtbo returned {response.status_code}")
+        overlay_server.executor.stop()
+        return {name: statistics.median(s) * 1000 for (name, s) in samples.items()}
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+def flatten(report):
+    """'group/name/stage' -> ms, the metrics compared between runs."""
+    metrics = {}
+    for (name, stages) in report['stages'].items():
+        for (stage, ms) in stages.items():
+            metrics[f'stages/{name}/{stage}'] = ms
+    for (name, ms) in report.get('server', {}).items():
+        metrics[f'server/{name}'] = ms
+    for (name, ms) in report.get('init_sequence', {}).items():
+        metrics[f'init_sequence/{name}'] = ms
+    for (name, ms) in report.get('lookups', {}).items():
+        metrics[f'lookups/{name}'] = ms
+    for (name, ms) in report.get('modes', {}).items():
+        metrics[f'modes/{name}'] = ms
+    return metrics
+
+def compare(base, new, threshold, noise_ms):
+    """Metrics slower than base by more than threshold (and noise_ms)."""
+    regressions = []
+    base = flatten(base)
+    for (name, ms) in flatten(new).items():
+        old = base.get(name)
+        if old is None:
+            continue
+        if ms > old * (1 + threshold) and ms - old > noise_ms:
+            regressions.append((name, old, ms))
+    return regressions
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Benchmark the dtb -> dtbo conversion")
+    parser.add_argument('-n', '--rounds', type=int, default=5, help="rounds per measurement (default 5)")
+    parser.add_argument('-o', '--output', help="write the JSON report there instead of stdout")
+    parser.add_argument('--no-server', action='store_true', help="skip the /convert_dtb benchmarks")
+    parser.add_argument('--compare', metavar='BASE.json', help="fail if slower than this earlier report")
+    parser.add_argument('--threshold', type=float, default=0.10, help="allowed slowdown ratio (default 0.10)")
+    parser.add_argument('--noise', type=float, default=0.05, help="ignore slowdowns under this many ms (default 0.05)")
+    parser.add_argument('--no-brute', action='store_true', help="skip the brute force reference of the mode sweep")
+    parser.add_argument('--hostile', action='store_true', help="check guarded conversions of crafted dtbs instead")
+    parser.add_argument('--max-seconds', type=float, default=2.0, help="--hostile: allowed time per dtb (default 2)")
+    parser.add_argument('--max-mb', type=float, default=64, help="--hostile: allowed peak memory per dtb (default 64)")
+    args = parser.parse_args()
+
+    logger = logging.getLogger('dtbo')
+    logger.setLevel(logging.WARNING)
+
+    if args.hostile:
+        results = check_hostile(make_hostile_corpus(), logger)
+        worst_ms = max(r['ms'] for r in results.values())
+        worst_kb = max(r['peak_kb'] for r in results.values())
+        outcomes = dict(sorted(collections.Counter(r['result'] for r in results.values()).items()))
+        report = {'version': rocknix_dtbo.VERSION, 'limits': rocknix_dtbo.LIMITS, 'worst_ms': worst_ms,
+                  'worst_peak_kb': worst_kb, 'outcomes': outcomes, 'cases': results}
+        out = json.dumps(report, indent=2)
+        if args.output:
+            with open(args.output, 'w') as f:
+                f.write(out + '\n')
+        else:
+            print(out)
+        failed = [name for (name, r) in results.items()
+                  if r['ms'] > args.max_seconds * 1000 or r['peak_kb'] > args.max_mb * 1024]
+        for name in failed:
+            print(f"UNBOUNDED {name}: {results[name]}", file=sys.stderr)
+        sys.exit(1 if failed else 0)
+
+    corpus = make_corpus()
+    report = {
+        'version': rocknix_dtbo.VERSION,
+        'python': sys.version.split()[0],
+        'rounds': args.rounds,
+        'flagsets': ['-'.join(flags) for flags in FLAGSETS],
+        'corpus': {name: len(dtb) for (name, dtb) in corpus.items()},
+        'stages': bench_stages(corpus, args.rounds, logger),
+    }
+    report['stages']['all'] = {stage: sum(r[stage] for r in report['stages'].values())
+                               for stage in STAGES + ['total']}
+    report['init_sequence'] = bench_init_sequence(args.rounds * 4)
+    report['lookups'] = bench_lookups(corpus, args.rounds)
+    report['modes'] = bench_modes(args.rounds, brute=not args.no_brute)
+    if not args.no_server:
+        report['server'] = bench_server(corpus, args.rounds)
+
+    out = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(out + '\n')
+    else:
+        print(out)
+
+    if args.compare:
+        with open(args.compare) as f:
+            base = json.load(f)
+        regressions = compare(base, report, args.threshold, args.noise)
+        for (name, old, ms) in regressions:
+            print(f"REGRESSION {name}: {old:.3f}ms -> {ms:.3f}ms", file=sys.stderr)
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+
+# Running conversions in worker processes
+
+import contextlib, logging, multiprocessing, os, signal, threading, time
+
+import rocknix_dtbo
+from overlay_cache import FingerprintCache
+from pack_store import PackStore
+
+
+class ExecutorBusy(Exception):
+    """Too many conversions are already waiting for a worker."""
+
+class ConversionTimeout(Exception):
+    """A conversion took longer than allowed, its worker was killed."""
+
+class WorkerDied(Exception):
+    """A worker process exited in the middle of a conversion."""
+
+
+# pack stores opened by this (worker) process, by directory
+stores = {}
+
+def open_store(directory):
+    if directory not in stores:
+        stores[directory] = PackStore(directory, logger=logging.getLogger('dtbo'))
+    return stores[directory]
+
+def make_dtbos_job(content, flagsets, limits=None, pack_dir=None):
+    """Returns per flag set the overlay or the ConversionError making it
+    raised, the seconds spent per conversion stage, the fingerprint of the
+    stock dtb and per flag set whether its overlay was found in the
+    FingerprintCache of the pack in pack_dir instead of made.
+    """
+    stages = {}
+    args = {'logger': logging.getLogger('dtbo'), 'stages': stages, 'limits': limits}
+    stock = rocknix_dtbo.inspect_dtb(content, dict(args, flags=flagsets[0] if flagsets else []))
+    fingerprint = rocknix_dtbo.fingerprint(stock, args)
+    found = [None] * len(flagsets)
+    if pack_dir is not None:
+        cache = FingerprintCache(open_store(pack_dir), rocknix_dtbo.VERSION)
+        found = [cache.get(fingerprint, flags) for flags in flagsets]
+    dtbos = []
+    for (flags, dtbo) in zip(flagsets, found):
+        if dtbo is None:
+            # mode synthesis only when something is left to make
+            dtbo = rocknix_dtbo.try_emit_dtbo(stock, dict(args, flags=flags))
+        dtbos.append(dtbo)
+    return (dtbos, stages, fingerprint, [dtbo is not None for dtbo in found])
+
+def worker_main(conn):
+    # rocknix_dtbo came with this module, after a fork its pages are shared
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    while True:
+        try:
+            (func, args) = conn.recv()
+        except (EOFError, OSError):
+            return
+        try:
+            result = ('ok', func(*args))
+        except Exception as e:
+            result = ('error', e)
+        try:
+            conn.send(result)
+        except Exception as e:
+            # e.g. exception which does not pickle
+            conn.send(('error', RuntimeError(repr(result[1]))))
+
+
+class Worker:
+    def __init__(self, ctx):
+        (self.conn, child_conn) = ctx.Pipe()
+        self.process = ctx.Process(target=worker_main, args=(child_conn,), daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.jobs = 0
+
+    def kill(self):
+        self.process.kill()
+        self.process.join()
+        self.conn.close()
+
+
+class ConversionExecutor:
+    """Pool of pre-started conversion processes.
+
+    run() executes a job on an idle worker and waits for it at most `timeout`
+    seconds, a stuck worker is killed and replaced. At most `max_pending`
+    callers may wait for a worker, for at most `queue_timeout` seconds,
+    others get ExecutorBusy right away. Concurrent calls with the same key
+    share a single execution.
+    """
+    def __init__(self, workers, max_pending, timeout, logger, queue_timeout=10):
+        self.nworkers = workers
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self.queue_timeout = queue_timeout
+        self.logger = logger
+        self.ctx = multiprocessing.get_context('fork' if hasattr(os, 'fork') else 'spawn')
+        self.cond = threading.Condition()
+        # all live workers, idle the ones without a job
+        self.workers = []
+        self.idle = []
+        self.started = False
+        self.pending = 0
+        self.inflight = {}
+        self.jobs = 0
+        self.coalesced = 0
+        self.rejected = 0
+        self.timeouts = 0
+        self.failures = 0
+
+    def start(self):
+        with self.cond:
+            if not self.started:
+                self.workers = [Worker(self.ctx) for _ in range(self.nworkers)]
+                self.idle = list(self.workers)
+                self.started = True
+
+    def stop(self):
+        """Kill all workers, jobs still running on them raise WorkerDied."""
+        with self.cond:
+            for w in self.workers:
+                w.kill()
+            self.workers = []
+            self.idle = []
+            self.started = False
+
+    def run(self, key, func, *args, admit=None):
+        """Run func(*args) in a worker, sharing the result with concurrent runs of the same key.
+
+        Only the run that executes enters admit(), a context manager, around
+        it. If admit() turns it away, the runs that joined it try again.
+        """
+        while True:
+            with self.cond:
+                flight = self.inflight.get(key)
+                if flight is None:
+                    flight = {'done': threading.Event(), 'admitted': False}
+                    self.inflight[key] = flight
+                    leader = True
+                else:
+                    self.coalesced += 1
+                    leader = False
+
+            if leader:
+                try:
+                    with admit() if admit is not None else contextlib.nullcontext():
+                        flight['admitted'] = True
+                        flight['result'] = self.execute(func, args)
+                except BaseException as e:
+                    flight['error'] = e
+                finally:
+                    with self.cond:
+                        del self.inflight[key]
+                    flight['done'].set()
+            else:
+                flight['done'].wait()
+                if not flight['admitted']:
+                    # the leader's limits are not ours
+                    continue
+
+            if 'error' in flight:
+                raise flight['error']
+            return flight['result']
+
+    def idle_workers(self):
+        """Number of workers a new job would get right away."""
+        if self.nworkers == 0:
+            return 1
+        self.start()
+        with self.cond:
+            return max(len(self.idle) - self.pending, 0)
+
+    def acquire(self):
+        self.start()
+        with self.cond:
+            if not self.idle and self.pending >= self.max_pending:
+                self.rejected += 1
+                raise ExecutorBusy()
+            self.pending += 1
+            try:
+                if not self.cond.wait_for(lambda: self.idle, timeout=self.queue_timeout):
+                    self.rejected += 1
+                    raise ExecutorBusy()
+                return self.idle.pop()
+            finally:
+                self.pending -= 1
+
+    def release(self, worker):
+        with self.cond:
+            if worker not in self.workers:
+                # killed by stop()
+                return
+            self.idle.append(worker)
+            self.cond.notify()
+
+    def replace(self, worker):
+        worker.kill()
+        with self.cond:
+            if worker not in self.workers:
+                return
+            self.workers.remove(worker)
+            worker = Worker(self.ctx)
+            self.workers.append(worker)
+        self.release(worker)
+
+    def execute(self, func, args):
+        if self.nworkers == 0:
+            # inline mode, for debugging
+            return func(*args)
+        worker = self.acquire()
+        t0 = time.monotonic()
+        try:
+            worker.conn.send((func, args))
+            if not worker.conn.poll(self.timeout):
+                with self.cond:
+                    self.timeouts += 1
+                self.logger.warning(f"conversion timed out after {self.timeout}s, killing worker {worker.process.pid}")
+                self.replace(worker)
+                raise ConversionTimeout()
+            (status, result) = worker.conn.recv()
+        except (EOFError, OSError, BrokenPipeError):
+            with self.cond:
+                self.failures += 1
+            self.logger.warning(f"conversion worker {worker.process.pid} died")
+            self.replace(worker)
+            raise WorkerDied()
+        worker.jobs += 1
+        self.release(worker)
+        with self.cond:
+            self.jobs += 1
+        self.logger.info(f"conversion done in {time.monotonic() - t0:.3f}s")
+        if status == 'error':
+            raise result
+        return result
+
+    def stats(self):
+        with self.cond:
+            return {
+                'workers': self.nworkers,
+                'idle': len(self.idle),
+                'pending': self.pending,
+                'inflight': len(self.inflight),
+                'jobs': self.jobs,
+                'coalesced': self.coalesced,
+                'rejected': self.rejected,
+                'timeouts': self.timeouts,
+                'failures': self.failures,
+            }
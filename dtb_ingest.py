@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+
+# Reading uploaded dtbs: hash while streaming and reject non-dtbs early
+
+import hashlib, struct
+
+from werkzeug.sansio.multipart import MultipartDecoder, NeedData, File, Data, Epilogue
+
+FDT_MAGIC = 0xd00dfeed
+FDT_BEGIN_NODE = 0x1
+# magic, totalsize, off_dt_struct, off_dt_strings, off_mem_rsvmap, version,
+# last_comp_version, boot_cpuid_phys, size_dt_strings, size_dt_struct
+FDT_HEADER = struct.Struct('>10I')
+
+
+class BadDtb(Exception):
+    """Uploaded file is not a usable flattened device tree."""
+
+
+def check_header(buf, size=None):
+    """Validate an FDT header at the start of buf.
+
+    size is the full file size when known, otherwise only the header itself
+    is checked. Returns totalsize.
+    """
+    if len(buf) < FDT_HEADER.size:
+        raise BadDtb("too short for a dtb header")
+    (magic, totalsize, off_struct, off_strings, off_rsvmap, version,
+     last_comp_version, _, size_strings, size_struct) = FDT_HEADER.unpack_from(buf)
+    if magic != FDT_MAGIC:
+        raise BadDtb(f"bad magic 0x{magic:08x}")
+    if not (16 <= version <= 17) or last_comp_version > 16:
+        raise BadDtb(f"unsupported version {version} (compatible with {last_comp_version})")
+    if totalsize < FDT_HEADER.size:
+        raise BadDtb(f"bad totalsize {totalsize}")
+    if size is not None and totalsize > size:
+        raise BadDtb(f"truncated: totalsize {totalsize} but got {size} bytes")
+    if (off_rsvmap % 8) or not (FDT_HEADER.size <= off_rsvmap <= totalsize - 16):
+        raise BadDtb(f"bad memory reserve map offset {off_rsvmap}")
+    if (off_struct % 4) or not (FDT_HEADER.size <= off_struct) or (off_struct + size_struct > totalsize) or size_struct < 8:
+        raise BadDtb(f"bad structure block {off_struct}+{size_struct}")
+    if not (FDT_HEADER.size <= off_strings) or (off_strings + size_strings > totalsize):
+        raise BadDtb(f"bad strings block {off_strings}+{size_strings}")
+    if size is not None:
+        (tag,) = struct.unpack_from('>I', buf, off_struct)
+        if tag != FDT_BEGIN_NODE:
+            raise BadDtb(f"structure block starts with tag {tag}")
+    return totalsize
+
+def ingest(stream, max_size, chunk_size=64*1024):
+    """Read a dtb from stream in chunks.
+
+    Returns (content, md5hex), content being a bytearray which can go to the
+    converter as is. Raises BadDtb as soon as the header shows the upload is
+    not a dtb, without reading the rest of the stream.
+    """
+    content = bytearray()
+    md5 = hashlib.md5()
+    totalsize = None
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+        md5.update(chunk)
+        content += chunk
+        if totalsize is None and len(content) >= FDT_HEADER.size:
+            totalsize = check_header(content)
+            if totalsize > max_size:
+                raise BadDtb(f"totalsize {totalsize} is over the {max_size} limit")
+        if len(content) > max_size:
+            raise BadDtb(f"over the {max_size} limit")
+    check_header(content, len(content))
+    return (content, md5.hexdigest())
+
+
+class MultipartFile:
+    """The `name` file of a multipart/form-data body, decoded from stream as
+    the client sends it, so ingest() can stop reading at a bad header
+    instead of after the whole request was buffered. read() returns the
+    next piece of the file, whatever its size.
+    """
+    def __init__(self, stream, boundary, name='file', chunk_size=64*1024):
+        self.stream = stream
+        self.decoder = MultipartDecoder(boundary.encode('latin-1'))
+        self.name = name
+        self.chunk_size = chunk_size
+        self.filename = None
+        self.inside = False
+
+    def find(self):
+        """Skip to the file, returns whether the body has one."""
+        while not self.inside:
+            event = self.next_event()
+            if event is None:
+                return False
+            if isinstance(event, File) and event.name == self.name:
+                self.filename = event.filename
+                self.inside = True
+        return True
+
+    def read(self, size=-1):
+        while self.inside:
+            event = self.next_event()
+            if not isinstance(event, Data):
+                self.inside = False
+                break
+            self.inside = event.more_data
+            if event.data:
+                return event.data
+        return b''
+
+    def read_chunk(self):
+        # whole chunks like werkzeug's own parser reads, the decoder may put the
+        # CR before a boundary into the file when fed a few bytes at a time
+        chunk = bytearray()
+        while len(chunk) < self.chunk_size:
+            data = self.stream.read(self.chunk_size - len(chunk))
+            if not data:
+                break
+            chunk += data
+        return bytes(chunk)
+
+    def next_event(self):
+        """The next decoder event, None at the end of the body."""
+        while True:
+            try:
+                event = self.decoder.next_event()
+            except ValueError as e:
+                raise BadDtb(f"bad multipart body: {e}")
+            if isinstance(event, NeedData):
+                self.decoder.receive_data(self.read_chunk() or None)
+            elif isinstance(event, Epilogue):
+                return None
+            else:
+                return event
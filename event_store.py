@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+
+# Uploads and feedback kept in SQLite instead of one file per event
+
+import os, re, queue, sqlite3, threading, time
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS uploads (
+    id INTEGER PRIMARY KEY,
+    md5 TEXT NOT NULL,
+    filename TEXT,
+    opts TEXT,
+    version TEXT,
+    size INTEGER,
+    seconds REAL,
+    time REAL NOT NULL,
+    source TEXT UNIQUE
+);
+CREATE INDEX IF NOT EXISTS uploads_md5 ON uploads (md5, time);
+CREATE INDEX IF NOT EXISTS uploads_time ON uploads (time);
+-- time is repeated here so "newest with flag X" is a single index walk
+CREATE TABLE IF NOT EXISTS upload_flags (
+    upload_id INTEGER NOT NULL REFERENCES uploads (id),
+    flag TEXT NOT NULL,
+    time REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS upload_flags_flag ON upload_flags (flag, time);
+CREATE INDEX IF NOT EXISTS upload_flags_upload ON upload_flags (upload_id);
+CREATE TABLE IF NOT EXISTS feedback (
+    id INTEGER PRIMARY KEY,
+    md5 TEXT NOT NULL,
+    user TEXT,
+    device TEXT,
+    description TEXT,
+    time REAL NOT NULL,
+    source TEXT UNIQUE
+);
+CREATE INDEX IF NOT EXISTS feedback_md5 ON feedback (md5, time);
+CREATE INDEX IF NOT EXISTS feedback_time ON feedback (time);
+"""
+
+# what feedback() used to write into feedback/<md5>-<time>
+FEEDBACK_FILE = re.compile(r"`[^`]*`\nfeedback from `(?P<user>.*?)`\ndev: `(?P<device>.*?)`\n\n(?P<description>.*?)\n?\Z", re.S)
+
+
+class EventStore:
+    """Upload metadata and feedback in an SQLite database in WAL mode.
+
+    record_*() only queue the row, a writer thread inserts whatever queued
+    up in one transaction every `flush_interval` seconds (or `batch_size`
+    rows). Beyond `max_queued` waiting rows new ones are dropped. Queries use
+    a connection per thread and never wait for writes.
+    """
+    def __init__(self, path, logger, batch_size=200, flush_interval=0.5, max_queued=10000):
+        self.path = path
+        self.logger = logger
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue(max_queued)
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.writer = None
+        self.written = 0
+        self.batches = 0
+        self.dropped = 0
+        db = self.connect()
+        db.executescript(SCHEMA)
+        db.close()
+
+    def connect(self):
+        db = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        db.row_factory = sqlite3.Row
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        return db
+
+    def reader(self):
+        db = getattr(self.local, 'db', None)
+        if db is None:
+            db = self.local.db = self.connect()
+        return db
+
+    def start(self):
+        # started lazily, so a forked process gets its own thread and connection
+        with self.lock:
+            if self.writer is None or not self.writer.is_alive():
+                self.writer = threading.Thread(target=self.run, name='event-store', daemon=True)
+                self.writer.start()
+
+    def record_upload(self, md5, filename, flagsets, version, size, seconds, when=None):
+        """One upload converted for flagsets (lists of flags)."""
+        self.start()
+        opts = ','.join(''.join('-' + f for f in flags) for flags in flagsets)
+        flags = sorted(set(f for flags in flagsets for f in flags))
+        self.enqueue(('upload', (md5, filename, opts, version, size, seconds, when or time.time(), None), flags))
+
+    def record_feedback(self, md5, user, device, description, when=None):
+        self.start()
+        self.enqueue(('feedback', (md5, user, device, description, when or time.time(), None), None))
+
+    def enqueue(self, item):
+        # a stuck writer must not take the requests down with it
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            with self.lock:
+                self.dropped += 1
+                dropped = self.dropped
+            if dropped % 1000 == 1:
+                self.logger.error(f"event store: queue is full, {dropped} rows dropped so far")
+
+    def run(self):
+        db = self.connect()
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get(timeout=max(0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            try:
+                with db:
+                    self.insert(db, batch)
+                with self.lock:
+                    self.written += len(batch)
+                    self.batches += 1
+            except Exception as e:
+                self.logger.error(f"event store: lost {len(batch)} rows: {e!r}")
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+    def insert(self, db, rows):
+        for (kind, row, flags) in rows:
+            if kind == 'upload':
+                cursor = db.execute("INSERT OR IGNORE INTO uploads (md5, filename, opts, version, size, seconds, time, source) "
+                                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?)", row)
+                if cursor.rowcount:
+                    db.executemany("INSERT INTO upload_flags (upload_id, flag, time) VALUES (?, ?, ?)",
+                                   [(cursor.lastrowid, flag, row[6]) for flag in flags])
+            else:
+                db.execute("INSERT OR IGNORE INTO feedback (md5, user, device, description, time, source) "
+                           "VALUES (?, ?, ?, ?, ?, ?)", row)
+
+    def flush(self):
+        """Wait until everything recorded so far is written."""
+        self.queue.join()
+
+    def uploads(self, md5=None, flag=None, before=None, limit=100):
+        """Newest uploads first, of one md5 and/or with one flag, older than before."""
+        if flag is not None and md5 is None:
+            # walk the (flag, time) index instead of sorting every upload with the flag
+            sql = ("SELECT uploads.* FROM upload_flags JOIN uploads ON uploads.id = upload_flags.upload_id"
+                   " WHERE upload_flags.flag = ?")
+            params = [flag]
+            if before is not None:
+                sql += " AND upload_flags.time < ?"
+                params.append(before)
+            sql += " ORDER BY upload_flags.time DESC LIMIT ?"
+        else:
+            # one md5 has few uploads, the flag is checked per row
+            sql = "SELECT * FROM uploads"
+            where = []
+            params = []
+            if md5 is not None:
+                where.append("md5 = ?")
+                params.append(md5)
+            if flag is not None:
+                where.append("EXISTS (SELECT 1 FROM upload_flags WHERE upload_id = uploads.id AND flag = ?)")
+                params.append(flag)
+            if before is not None:
+                where.append("time < ?")
+                params.append(before)
+            if where:
+                sql += " WHERE " + " AND ".join(where)
+            sql += " ORDER BY time DESC LIMIT ?"
+        params.append(limit)
+        return [dict(row) for row in self.reader().execute(sql, params)]
+
+    def feedback(self, md5=None, before=None, limit=100):
+        sql = "SELECT * FROM feedback"
+        where = []
+        params = []
+        if md5 is not None:
+            where.append("md5 = ?")
+            params.append(md5)
+        if before is not None:
+            where.append("time < ?")
+            params.append(before)
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY time DESC LIMIT ?"
+        params.append(limit)
+        return [dict(row) for row in self.reader().execute(sql, params)]
+
+    def import_dirs(self, uploads_dir=None, feedback_dir=None):
+        """Import the old uploads/<md5>-<name> and feedback/<md5>-<time> files.
+
+        The file path is kept as the row source, so importing again skips
+        what is already there. Options of old uploads are not known.
+        Returns (uploads, feedback) rows added.
+        """
+        added = [0, 0]
+        db = self.connect()
+        try:
+            for (i, directory) in enumerate((uploads_dir, feedback_dir)):
+                if not directory or not os.path.isdir(directory):
+                    continue
+                rows = []
+                for name in sorted(os.listdir(directory)):
+                    path = os.path.join(directory, name)
+                    if len(name) < 34 or name[32] != '-' or not os.path.isfile(path):
+                        continue
+                    if i == 0:
+                        st = os.stat(path)
+                        rows.append((name[:32], name[33:], None, None, st.st_size, None, st.st_mtime, path))
+                    else:
+                        with open(path, errors='replace') as f:
+                            m = FEEDBACK_FILE.match(f.read())
+                        if m is None:
+                            self.logger.warning(f"event store: can not parse {path}")
+                            continue
+                        try:
+                            when = float(name[33:])
+                        except ValueError:
+                            when = os.stat(path).st_mtime
+                        rows.append((name[:32], m['user'], m['device'], m['description'], when, path))
+                    if len(rows) >= self.batch_size:
+                        added[i] += self.import_rows(db, i, rows)
+                        rows = []
+                added[i] += self.import_rows(db, i, rows)
+        finally:
+            db.close()
+        return tuple(added)
+
+    def import_rows(self, db, i, rows):
+        before = db.total_changes
+        with db:
+            if i == 0:
+                db.executemany("INSERT OR IGNORE INTO uploads (md5, filename, opts, version, size, seconds, time, source) "
+                               "VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+            else:
+                db.executemany("INSERT OR IGNORE INTO feedback (md5, user, device, description, time, source) "
+                               "VALUES (?, ?, ?, ?, ?, ?)", rows)
+        return db.total_changes - before
+
+    def stats(self):
+        with self.lock:
+            return {'queued': self.queue.qsize(), 'written': self.written, 'batches': self.batches,
+                    'dropped': self.dropped}
+
+
+if __name__ == '__main__':
+    import argparse, logging
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description="Import uploads/ and feedback/ into the event store")
+    parser.add_argument('db', help="database path, e.g. events.sqlite")
+    parser.add_argument('--uploads', default='uploads', help="uploads directory (default uploads)")
+    parser.add_argument('--feedback', default='feedback', help="feedback directory (default feedback)")
+    args = parser.parse_args()
+
+    store = EventStore(args.db, logging.getLogger('events'))
+    (uploads, feedback) = store.import_dirs(args.uploads, args.feedback)
+    print(f"imported {uploads} uploads and {feedback} feedback reports")
@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+
+# Read-only lazy access to a dtb blob, for the stock dtb side of rocknix_dtbo.
+# Offers the small part of the fdt.FDT / fdt.Node API that make_dtbo() uses.
+
+import struct
+from fdt.items import new_property
+
+FDT_MAGIC = 0xd00dfeed
+FDT_BEGIN_NODE = 0x1
+FDT_END_NODE = 0x2
+FDT_PROP = 0x3
+FDT_NOP = 0x4
+FDT_END = 0x9
+
+WORD = struct.Struct('>I')
+PROP = struct.Struct('>II')
+
+
+class LimitError(ValueError):
+    """The blob is over one of the limits given to LazyFdt."""
+
+
+class LazyFdt:
+    """A dtb blob with an index of node positions, built in one linear scan.
+
+    Only node names and tree structure are decoded up front, property values
+    are decoded from a memoryview of the blob when they are asked for.
+    limits may cap 'nodes', 'depth' and 'props' (total), LimitError is raised
+    as soon as the scan goes over one.
+    """
+    def __init__(self, data, limits=None):
+        self.blob = data
+        self.mv = memoryview(data)
+        (magic, totalsize, self.off_struct, self.off_strings, _, self.version) = struct.unpack_from('>6I', data)
+        if magic != FDT_MAGIC:
+            raise ValueError(f"Bad magic 0x{magic:08x}")
+        if totalsize > len(data):
+            raise ValueError(f"Truncated dtb: totalsize {totalsize} but {len(data)} bytes")
+        # per node: name, parent index, offset of its first property token, children
+        self.names = []
+        self.parents = []
+        self.starts = []
+        self.children = []
+        self.strings = {}
+        self.phandle_nodes = {}
+        self.scan(limits or {})
+        self.root = LazyNode(self, 0)
+
+    def string(self, nameoff):
+        name = self.strings.get(nameoff)
+        if name is None:
+            start = self.off_strings + nameoff
+            name = self.blob[start:self.blob.index(b'\0', start)].decode('ascii')
+            self.strings[nameoff] = name
+        return name
+
+    def prop_start(self, pos, size):
+        # versions before 16 align big property values to 8 bytes
+        if self.version < 16 and size >= 8:
+            return (pos + 7) & ~7
+        return pos
+
+    def scan(self, limits):
+        blob = self.blob
+        pos = self.off_struct
+        current = -1
+        max_nodes = limits.get('nodes', len(blob))
+        max_depth = limits.get('depth', len(blob))
+        props_left = limits.get('props', len(blob))
+        depth = 0
+        while True:
+            (tag,) = WORD.unpack_from(blob, pos)
+            pos += 4
+            if tag == FDT_BEGIN_NODE:
+                end = blob.index(b'\0', pos)
+                name = blob[pos:end].decode('ascii') or '/'
+                pos = (end + 4) & ~3
+                index = len(self.names)
+                depth += 1
+                if index >= max_nodes:
+                    raise LimitError(f"more than {max_nodes} nodes")
+                if depth > max_depth:
+                    raise LimitError(f"nodes nested deeper than {max_depth}")
+                self.names.append(name)
+                self.parents.append(current)
+                self.starts.append(pos)
+                self.children.append([])
+                if current >= 0:
+                    self.children[current].append(index)
+                current = index
+            elif tag == FDT_END_NODE:
+                current = self.parents[current]
+                depth -= 1
+            elif tag == FDT_PROP:
+                props_left -= 1
+                if props_left < 0:
+                    raise LimitError(f"more than {limits['props']} properties")
+                (size, nameoff) = PROP.unpack_from(blob, pos)
+                start = self.prop_start(pos + 8, size)
+                if size == 4 and self.string(nameoff) == 'phandle':
+                    self.phandle_nodes.setdefault(WORD.unpack_from(blob, start)[0], current)
+                pos = (start + size + 3) & ~3
+            elif tag == FDT_NOP:
+                pass
+            elif tag == FDT_END:
+                break
+            else:
+                raise ValueError(f"Unknown Tag: {tag}")
+
+    def props_of(self, index):
+        """Yield (name, start, size) of the properties of a node."""
+        blob = self.blob
+        pos = self.starts[index]
+        while True:
+            (tag,) = WORD.unpack_from(blob, pos)
+            if tag == FDT_PROP:
+                (size, nameoff) = PROP.unpack_from(blob, pos + 4)
+                start = self.prop_start(pos + 12, size)
+                yield (self.string(nameoff), start, size)
+                pos = (start + size + 3) & ~3
+            elif tag == FDT_NOP:
+                pos += 4
+            else:
+                return
+
+    def phandles(self):
+        return {phandle: LazyNode(self, index) for (phandle, index) in self.phandle_nodes.items()}
+
+    def get_node(self, path):
+        node = self.root
+        path = path.lstrip('/')
+        if path:
+            for name in path.split('/'):
+                item = node.get_subnode(name)
+                if item is None:
+                    raise ValueError("Path \"{}\" doesn't exists".format(path))
+                node = item
+        return node
+
+    def exist_node(self, path):
+        try:
+            self.get_node(path)
+        except ValueError:
+            return False
+        return True
+
+    def get_property(self, name, path=''):
+        return self.get_node(path).get_property(name)
+
+
+class LazyNode:
+    """Node of a LazyFdt, with the read side of the fdt.Node API."""
+    __slots__ = ('fdt', 'index', 'cache')
+
+    def __init__(self, fdt, index):
+        self.fdt = fdt
+        self.index = index
+        # property name -> decoded property (or None)
+        self.cache = {}
+
+    @property
+    def name(self):
+        return self.fdt.names[self.index]
+
+    @property
+    def parent(self):
+        parent = self.fdt.parents[self.index]
+        return LazyNode(self.fdt, parent) if parent >= 0 else None
+
+    @property
+    def path(self):
+        # same as fdt.Node.path: path of the parent, '/' for the root
+        names = []
+        index = self.fdt.parents[self.index]
+        while index > 0:
+            names.append(self.fdt.names[index])
+            index = self.fdt.parents[index]
+        return '/' + '/'.join(reversed(names))
+
+    @property
+    def nodes(self):
+        return [LazyNode(self.fdt, i) for i in self.fdt.children[self.index]]
+
+    @property
+    def props(self):
+        props = []
+        for (name, start, size) in self.fdt.props_of(self.index):
+            if self.cache.get(name) is None:
+                self.cache[name] = new_property(name, bytes(self.fdt.mv[start:start + size]))
+            props.append(self.cache[name])
+        return props
+
+    def get_property(self, name):
+        if name not in self.cache:
+            self.cache[name] = None
+            for (pname, start, size) in self.fdt.props_of(self.index):
+                if pname == name:
+                    self.cache[name] = new_property(name, bytes(self.fdt.mv[start:start + size]))
+                    break
+        return self.cache[name]
+
+    def get_raw(self, name):
+        """Undecoded value of a property, a memoryview of the blob, or None."""
+        for (pname, start, size) in self.fdt.props_of(self.index):
+            if pname == name:
+                return self.fdt.mv[start:start + size]
+        return None
+
+    def exist_property(self, name):
+        return self.get_property(name) is not None
+
+    def get_subnode(self, name):
+        for i in self.fdt.children[self.index]:
+            if self.fdt.names[i] == name:
+                return LazyNode(self.fdt, i)
+        return None
+
+    def exist_subnode(self, name):
+        return self.get_subnode(name) is not None
+
+
+def parse_dtb(data, limits=None):
+    return LazyFdt(data, limits)
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+
+# panel-init-sequence of rockchip dsi panels: commands of
+# <type> <wait ms> <length> <length bytes of payload>, back to back
+
+import struct
+
+from fdt.items import PropWords, PropStrings
+
+
+class InitSequenceError(ValueError):
+    """The init sequence is truncated or otherwise does not parse."""
+
+
+def property_bytes(node, name='panel-init-sequence'):
+    """Raw value of a property, however pyfdt guessed its type.
+
+    A LazyNode hands out a memoryview of the blob. An fdt.Node has it
+    decoded already, a byte string whose length is a multiple of 4 as
+    PropWords: its big endian cells are the very same bytes.
+    """
+    if hasattr(node, 'get_raw'):
+        value = node.get_raw(name)
+        if value is None:
+            raise InitSequenceError(f"no {name}")
+        return value
+    prop = node.get_property(name)
+    if prop is None:
+        raise InitSequenceError(f"no {name}")
+    if isinstance(prop, PropWords):
+        return struct.pack(f'>{len(prop.data)}I', *prop.data)
+    if isinstance(prop, PropStrings):
+        return b''.join(s.encode() + b'\0' for s in prop.data)
+    return prop.data
+
+def decode(buf):
+    """Yields (type, wait, payload) per command, payload is a memoryview of buf.
+
+    Walks buf with an offset, nothing is copied. Raises InitSequenceError
+    at a command running past the end, after yielding the ones before it.
+    """
+    mv = memoryview(buf).cast('B')
+    end = len(mv)
+    pos = 0
+    while pos < end:
+        if pos + 3 > end:
+            raise InitSequenceError(f"truncated command at offset {pos}: {end - pos} of 3 header bytes")
+        (cmd, wait, length) = (mv[pos], mv[pos + 1], mv[pos + 2])
+        pos += 3
+        if pos + length > end:
+            raise InitSequenceError(f"command 0x{cmd:x} at offset {pos - 3} has {length} bytes of payload, "
+                                    f"only {end - pos} left")
+        yield (cmd, wait, mv[pos:pos + length])
+        pos += length
+
+def encode(commands):
+    """decode() backwards, returns the bytes of (type, wait, payload) commands."""
+    out = bytearray()
+    for (cmd, wait, payload) in commands:
+        if not (0 <= cmd < 256 and 0 <= wait < 256 and len(payload) < 256):
+            raise InitSequenceError(f"command 0x{cmd:x} wait={wait} with {len(payload)} bytes does not fit")
+        out += bytes((cmd, wait, len(payload)))
+        out += payload
+    return bytes(out)
@@ -0,0 +1,372 @@
+#!/usr/bin/env python3
+
+# Load test replaying the index.html flow against a locally started overlay_server
+#
+#   ./loadtest.py -c 8 -d 30                 # 8 concurrent users for 30s
+#   ./loadtest.py --rate 20 -d 30            # 20 new sessions per second
+#   ./loadtest.py --url http://host:5000     # an already running server (no RSS)
+#
+# A session does what the page does: GET dtbo/<md5+opts>, on 404 POST
+# convert_dtb?opts=..., and sometimes POST feedback/<md5>. Telegram calls go
+# to a stub server started here. Every user has an address of its own, sent
+# as X-Forwarded-For.
+#
+#   ./loadtest.py --flood 4 --rate-limit     # plus one client uploading new dtbs nonstop
+#
+# The server runs without its per client conversion rate limit unless
+# --rate-limit is given, the sessions would mostly measure 429s otherwise.
+
+import os, sys, json, time, random, hashlib, queue, shutil, signal, socket, tempfile, threading
+import subprocess, urllib.parse, http.client, http.server
+
+import fdt
+
+from bench_dtbo import make_stock_dtb
+
+FLAG_MIX = {'': 40, '-LSi': 20, '-HPi': 10, '-LSi-HPi': 8, '-JPmm': 8, '-JPk36': 5, '-RSi': 4, '-DR90': 3, '-DR180': 2}
+SERVER = ("import sys; sys.path.insert(0, sys.argv[1]); import overlay_server; "
+          "overlay_server.app.run(host='127.0.0.1', port=int(sys.argv[2]), threaded=True)")
+
+
+class TelegramStub(http.server.ThreadingHTTPServer):
+    """Answers sendMessage like Telegram does and counts the calls."""
+    daemon_threads = True
+
+    def __init__(self):
+        self.messages = 0
+        super().__init__(('127.0.0.1', 0), TelegramHandler)
+
+class TelegramHandler(http.server.BaseHTTPRequestHandler):
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('content-length', 0)))
+        self.server.messages += 1
+        body = b'{"ok":true,"result":{}}'
+        self.send_response(200)
+        self.send_header('content-type', 'application/json')
+        self.send_header('content-length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def start_server(workdir, port, telegram_url, command=None, rate_limit=False):
+    """Start overlay_server in workdir with a config pointing to the Telegram stub."""
+    config = os.path.join(workdir, 'config.json')
+    settings = {'TELEGRAM_APIKEY': 'loadtest', 'TELEGRAM_CHATS': [1], 'TELEGRAM_API_URL': telegram_url,
+                'CLIENT_ADDRESS_HEADER': 'X-Forwarded-For'}
+    if not rate_limit:
+        settings['CONVERT_RATE'] = None
+    with open(config, 'w') as f:
+        json.dump(settings, f)
+    env = dict(os.environ, OVERLAY_SERVER_CONFIG=config)
+    repo = os.path.dirname(os.path.abspath(__file__))
+    if command:
+        args = [a.format(python=sys.executable, port=port, repo=repo) for a in command.split()]
+    else:
+        args = [sys.executable, '-c', SERVER, repo, str(port)]
+    process = subprocess.Popen(args, cwd=workdir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                               start_new_session=True)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=1)
+            conn.request('GET', '/stats')
+            if conn.getresponse().status == 200:
+                return process
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError("server did not come up")
+
+def tree_rss_kb(pid):
+    """RSS of a process and all its descendants, from /proc."""
+    children = {}
+    for entry in os.listdir('/proc'):
+        if entry.isdigit():
+            try:
+                with open(f'/proc/{entry}/stat') as f:
+                    ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+            except (OSError, IndexError, ValueError):
+                continue
+            children.setdefault(ppid, []).append(int(entry))
+    total = 0
+    todo = [pid]
+    while todo:
+        p = todo.pop()
+        todo += children.get(p, [])
+        try:
+            with open(f'/proc/{p}/status') as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        total += int(line.split()[1])
+        except OSError:
+            pass
+    return total
+
+
+def multipart(filename, content):
+    boundary = 'loadtest' + os.urandom(8).hex()
+    body = (f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="{filename}"\r\n'
+            f'Content-Type: application/octet-stream\r\n\r\n').encode() + content + f'\r\n--{boundary}--\r\n'.encode()
+    return (body, f'multipart/form-data; boundary={boundary}')
+
+
+class LoadTest:
+    def __init__(self, url, dtbs, repeat, feedback, flag_mix, seed=0):
+        parsed = urllib.parse.urlsplit(url)
+        self.host = parsed.hostname
+        self.port = parsed.port or 80
+        self.dtbs = dtbs
+        self.repeat = repeat
+        self.feedback = feedback
+        self.flag_mix = flag_mix
+        self.rnd = random.Random(seed)
+        self.lock = threading.Lock()
+        # dtbs handed out so far, repeats pick from these
+        self.used = 0
+        # endpoint -> latencies, status -> count
+        self.latencies = {}
+        self.statuses = {}
+        self.sessions = 0
+        self.local = threading.local()
+
+    def pick(self):
+        with self.lock:
+            if self.used and (self.used >= len(self.dtbs) or self.rnd.random() < self.repeat):
+                # popular dtbs come back more often
+                dtb = self.dtbs[min(int(self.rnd.expovariate(3 / self.used)), self.used - 1)]
+            else:
+                dtb = self.dtbs[self.used]
+                self.used += 1
+            opts = self.rnd.choices(list(self.flag_mix), weights=list(self.flag_mix.values()))[0]
+            feedback = self.rnd.random() < self.feedback
+        return (dtb, opts, feedback)
+
+    def request(self, endpoint, method, path, body=None, headers={}):
+        headers = dict(headers, **{'x-forwarded-for': getattr(self.local, 'address', '10.255.255.255')})
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = self.local.conn = http.client.HTTPConnection(self.host, self.port, timeout=60)
+        t0 = time.perf_counter()
+        try:
+            conn.request(method, path, body, headers)
+            response = conn.getresponse()
+            response.read()
+            status = response.status
+        except (OSError, http.client.HTTPException) as e:
+            conn.close()
+            self.local.conn = None
+            status = type(e).__name__
+        seconds = time.perf_counter() - t0
+        with self.lock:
+            self.latencies.setdefault(endpoint, []).append(seconds)
+            key = (endpoint, str(status))
+            self.statuses[key] = self.statuses.get(key, 0) + 1
+        return status
+
+    def session(self):
+        (dtb, opts, feedback) = self.pick()
+        md5 = hashlib.md5(dtb).hexdigest()
+        status = self.request('dtbo', 'GET', f'/dtbo/{md5}{opts}')
+        if status == 404:
+            (body, content_type) = multipart('stock.dtb', dtb)
+            self.request('convert_dtb', 'POST', f'/convert_dtb?opts={opts}', body, {'content-type': content_type})
+        if feedback:
+            form = urllib.parse.urlencode({'user': 'loadtest', 'device': 'R36S clone',
+                                           'description': 'screen works, volume keys do not'})
+            self.request('feedback', 'POST', f'/feedback/{md5}{opts}', form,
+                         {'content-type': 'application/x-www-form-urlencoded'})
+        with self.lock:
+            self.sessions += 1
+
+    def run_closed(self, concurrency, duration):
+        """concurrency users doing sessions back to back."""
+        deadline = time.monotonic() + duration
+        def user(i):
+            self.local.address = user_address(i)
+            while time.monotonic() < deadline:
+                self.session()
+        threads = [threading.Thread(target=user, args=(i,), daemon=True) for i in range(concurrency)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+    def run_open(self, rate, duration, max_users=256):
+        """New sessions at a fixed (Poisson) rate, whatever the server keeps up with."""
+        starts = queue.Queue()
+        def user(i):
+            self.local.address = user_address(i)
+            while True:
+                if starts.get() is None:
+                    return
+                self.session()
+        threads = [threading.Thread(target=user, args=(i,), daemon=True) for i in range(max_users)]
+        for t in threads:
+            t.start()
+        t0 = time.monotonic()
+        at = 0.0
+        while at < duration:
+            at += self.rnd.expovariate(rate)
+            time.sleep(max(0, t0 + at - time.monotonic()))
+            starts.put(True)
+        for t in threads:
+            starts.put(None)
+        for t in threads:
+            t.join()
+
+    def flood(self, connections, duration, base):
+        """One client posting dtbs never seen before over `connections`
+        connections, every upload needs a conversion of its own."""
+        deadline = time.monotonic() + duration
+        dt = fdt.parse_dtb(base)
+        iseq = bytes(dt.get_node('/dsi@ff450000/panel@0').get_property('panel-init-sequence').data)
+        start = base.find(iseq)
+        # the wait bytes of the first commands make every dtb distinct
+        waits = []
+        pos = 0
+        while pos < len(iseq) and len(waits) < 3:
+            waits.append(start + pos + 1)
+            pos += 3 + iseq[pos + 2]
+        counter = iter(range(1 << 24))
+        def client():
+            self.local.address = '192.0.2.1'
+            while time.monotonic() < deadline:
+                with self.lock:
+                    n = next(counter)
+                dtb = bytearray(base)
+                for (i, at) in enumerate(waits):
+                    dtb[at] = (n >> (8 * i)) & 0xff
+                (body, content_type) = multipart('flood.dtb', bytes(dtb))
+                self.request('flood', 'POST', '/convert_dtb', body, {'content-type': content_type})
+        threads = [threading.Thread(target=client, daemon=True) for _ in range(connections)]
+        for t in threads:
+            t.start()
+        return threads
+
+
+def user_address(i):
+    return f'10.0.{i // 250}.{i % 250 + 1}'
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))] if values else None
+
+def summarize(test, elapsed):
+    endpoints = {}
+    for (endpoint, latencies) in sorted(test.latencies.items()):
+        statuses = {s: n for ((e, s), n) in test.statuses.items() if e == endpoint}
+        # a 404 from dtbo/ is the normal "not converted yet" answer
+        errors = sum(n for (s, n) in statuses.items()
+                     if not (s.isdigit() and int(s) < 400) and not (endpoint == 'dtbo' and s == '404'))
+        endpoints[endpoint] = {
+            'requests': len(latencies),
+            'rps': round(len(latencies) / elapsed, 2),
+            'p50_ms': round(percentile(latencies, 50) * 1000, 2),
+            'p95_ms': round(percentile(latencies, 95) * 1000, 2),
+            'p99_ms': round(percentile(latencies, 99) * 1000, 2),
+            'max_ms': round(max(latencies) * 1000, 2),
+            'statuses': statuses,
+            'error_rate': round(errors / len(latencies), 4),
+        }
+    return {
+        'seconds': round(elapsed, 2),
+        'sessions': test.sessions,
+        'sessions_per_second': round(test.sessions / elapsed, 2),
+        'distinct_dtbs': test.used,
+        'endpoints': endpoints,
+    }
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Replay the browser flow against overlay_server")
+    parser.add_argument('-c', '--concurrency', type=int, default=8, help="concurrent users (default 8)")
+    parser.add_argument('-r', '--rate', type=float, help="new sessions per second instead of fixed concurrency")
+    parser.add_argument('-d', '--duration', type=float, default=20, help="seconds (default 20)")
+    parser.add_argument('--dtbs', type=int, default=50, help="distinct dtbs available (default 50)")
+    parser.add_argument('--repeat', type=float, default=0.7, help="share of sessions with an already seen dtb (default 0.7)")
+    parser.add_argument('--feedback', type=float, default=0.05, help="share of sessions sending feedback (default 0.05)")
+    parser.add_argument('--flags', help="flag mix as JSON, e.g. '{\"\": 3, \"-LSi\": 1}'")
+    parser.add_argument('--url', help="test this running server instead of starting one")
+    parser.add_argument('--server-cmd', help="command starting the server, with {python} {port} {repo} placeholders")
+    parser.add_argument('--rss-interval', type=float, default=1.0, help="seconds between RSS samples (default 1)")
+    parser.add_argument('--flood', type=int, default=0, metavar='N', help="add a client uploading new dtbs over N connections")
+    parser.add_argument('--rate-limit', action='store_true', help="keep the server's per client conversion rate limit")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('-o', '--output', help="write the JSON report there instead of stdout")
+    args = parser.parse_args()
+
+    print(f"generating {args.dtbs} dtbs", file=sys.stderr)
+    dtbs = [make_stock_dtb(soc=('rk3326', 'rk3566')[i % 2], timings=1 + i % 3, iseq_cmds=40 + i, seed=i)
+            for i in range(args.dtbs)]
+
+    telegram = process = workdir = None
+    if args.url:
+        url = args.url
+    else:
+        telegram = TelegramStub()
+        threading.Thread(target=telegram.serve_forever, daemon=True).start()
+        workdir = tempfile.mkdtemp(prefix='loadtest.')
+        port = free_port()
+        process = start_server(workdir, port, f'http://127.0.0.1:{telegram.server_address[1]}', args.server_cmd,
+                               args.rate_limit)
+        url = f'http://127.0.0.1:{port}'
+
+    rss = []
+    done = threading.Event()
+    def sample_rss():
+        t0 = time.monotonic()
+        while not done.wait(args.rss_interval):
+            rss.append((round(time.monotonic() - t0, 1), tree_rss_kb(process.pid)))
+    if process:
+        threading.Thread(target=sample_rss, daemon=True).start()
+
+    test = LoadTest(url, dtbs, args.repeat, args.feedback, json.loads(args.flags) if args.flags else FLAG_MIX, args.seed)
+    print(f"loading {url} for {args.duration}s", file=sys.stderr)
+    t0 = time.monotonic()
+    try:
+        flooders = test.flood(args.flood, args.duration, dtbs[0]) if args.flood else []
+        if args.rate:
+            test.run_open(args.rate, args.duration)
+        else:
+            test.run_closed(args.concurrency, args.duration)
+        for t in flooders:
+            t.join()
+        elapsed = time.monotonic() - t0
+        done.set()
+
+        report = {'url': url, 'mode': {'rate': args.rate} if args.rate else {'concurrency': args.concurrency},
+                  'flood': args.flood, 'rate_limit': args.rate_limit,
+                  **summarize(test, elapsed)}
+        conn = http.client.HTTPConnection(test.host, test.port, timeout=10)
+        conn.request('GET', '/stats')
+        report['server_stats'] = json.loads(conn.getresponse().read())
+        if process:
+            report['rss_kb'] = rss
+            report['peak_rss_kb'] = max((kb for (_, kb) in rss), default=None)
+            report['telegram_messages'] = telegram.messages
+    finally:
+        done.set()
+        if process:
+            os.killpg(process.pid, signal.SIGTERM)
+            process.wait()
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    out = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(out + '\n')
+    else:
+        print(out)
+    for (endpoint, r) in report['endpoints'].items():
+        print(f"{endpoint:12} {r['requests']:6} req {r['rps']:8.1f}/s  p50 {r['p50_ms']:8.2f}ms  "
+              f"p95 {r['p95_ms']:8.2f}ms  p99 {r['p99_ms']:8.2f}ms  errors {r['error_rate']:.2%}", file=sys.stderr)
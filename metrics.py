@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+
+# Counters and histograms exported in the Prometheus text format, stdlib only
+
+import threading
+
+# seconds, from a cached /dtbo/ hit up to a slow conversion
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+BYTES_BUCKETS = (256, 1024, 4096, 16384, 65536, 131072, 262144, 524288)
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def format_labels(names, values, extra=''):
+    pairs = [f'{n}="{escape(v)}"' for (n, v) in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def inc(self, *labels, amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            values = sorted(self.values.items())
+        for (labels, value) in values:
+            yield f'{self.name}{format_labels(self.labels, labels)} {format_value(value)}'
+
+
+class Histogram:
+    """Fixed buckets, observe() is a bisect and three additions under a lock."""
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(sorted(buckets))
+        self.lock = threading.Lock()
+        # labels -> [per bucket counts (+Inf last), sum]
+        self.values = {}
+
+    def observe(self, value, *labels):
+        i = 0
+        for bound in self.buckets:
+            if value <= bound:
+                break
+            i += 1
+        with self.lock:
+            entry = self.values.get(labels)
+            if entry is None:
+                entry = [[0] * (len(self.buckets) + 1), 0]
+                self.values[labels] = entry
+            entry[0][i] += 1
+            entry[1] += value
+
+    def samples(self):
+        with self.lock:
+            values = sorted((labels, list(counts), total) for (labels, (counts, total)) in self.values.items())
+        for (labels, counts, total) in values:
+            cumulative = 0
+            for (bound, count) in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = 'le="' + format_value(float(bound)) + '"'
+                yield f'{self.name}_bucket{format_labels(self.labels, labels, le)} {cumulative}'
+            yield f'{self.name}_sum{format_labels(self.labels, labels)} {format_value(total)}'
+            yield f'{self.name}_count{format_labels(self.labels, labels)} {cumulative}'
+
+
+class Gauge:
+    """Value read from func() at export time, func returns {labels tuple: value}."""
+    kind = 'gauge'
+
+    def __init__(self, name, help, func, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.func = func
+
+    def samples(self):
+        for (labels, value) in sorted(self.func().items()):
+            yield f'{self.name}{format_labels(self.labels, labels)} {format_value(value)}'
+
+
+class Registry:
+    def __init__(self, prefix=''):
+        self.prefix = prefix
+        self.metrics = []
+
+    def add(self, metric):
+        metric.name = self.prefix + metric.name
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self.add(Counter(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        return self.add(Histogram(name, help, labels, buckets))
+
+    def gauge(self, name, help, func, labels=()):
+        return self.add(Gauge(name, help, func, labels))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            lines.extend(metric.samples())
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+
+# Caching of generated overlays in front of the pack store
+
+import time, threading
+from collections import OrderedDict
+
+
+def parse_opts(opts):
+    """Turn '-LSi-HPi' style opts into a normalized (sorted, unique) flag list."""
+    return sorted(set(f for f in opts.split('-') if f != ''))
+
+def split_name(name):
+    """Split a 'md5+opts' dtbo name into md5 and normalized flags."""
+    return name[:32], parse_opts(name[32:])
+
+def make_name(md5, flags):
+    return md5 + ''.join('-' + f for f in flags)
+
+
+class ConversionCache:
+    """In-process LRU of generated overlays backed by a PackStore.
+
+    Entries are keyed by (input md5, normalized flags, generator version). In
+    the store they are 'dtbo/<version>/<md5+opts>', so overlays produced by
+    an older generator are simply never found again and get regenerated on
+    next upload.
+    """
+    def __init__(self, store, version, max_bytes):
+        self.store = store
+        self.version = version
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def key(self, md5, flags):
+        return (md5, tuple(parse_opts('-'.join(flags))), self.version)
+
+    def store_key(self, key):
+        (md5, flags, version) = key
+        return f'dtbo/{version}/{make_name(md5, flags)}'
+
+    def _remember(self, key, dtbo):
+        # caller holds the lock
+        if key in self.entries:
+            self.size -= len(self.entries.pop(key))
+        if len(dtbo) > self.max_bytes:
+            return
+        self.entries[key] = dtbo
+        self.size += len(dtbo)
+        while self.size > self.max_bytes:
+            (_, old) = self.entries.popitem(last=False)
+            self.size -= len(old)
+
+    def etag(self, md5, flags):
+        # the key fully determines the overlay bytes
+        (md5, flags, version) = self.key(md5, flags)
+        return f'"{make_name(md5, flags)}@{version}"'
+
+    def lookup(self, md5, flags):
+        """Find an overlay without copying it.
+
+        Returns the overlay bytes if it is in memory, a memoryview into the
+        mapped pack if it is only on disk, or None.
+        """
+        key = self.key(md5, flags)
+        with self.lock:
+            dtbo = self.entries.get(key)
+            if dtbo is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return dtbo
+        found = self.store.get(self.store_key(key))
+        with self.lock:
+            if found is not None:
+                self.disk_hits += 1
+                return found
+            self.misses += 1
+            return None
+
+    def get(self, md5, flags):
+        found = self.lookup(md5, flags)
+        if not isinstance(found, memoryview):
+            return found
+        dtbo = bytes(found)
+        with self.lock:
+            self._remember(self.key(md5, flags), dtbo)
+        return dtbo
+
+    def open(self, md5, flags):
+        """File object of an overlay in the pack, see PackStore.open()."""
+        return self.store.open(self.store_key(self.key(md5, flags)))
+
+    def put(self, md5, flags, dtbo):
+        key = self.key(md5, flags)
+        self.store.put(self.store_key(key), dtbo)
+        with self.lock:
+            self._remember(key, dtbo)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'version': self.version,
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'entries': len(self.entries),
+                'bytes': self.size,
+                'max_bytes': self.max_bytes,
+            }
+
+
+class FailureCache:
+    """Remembers dtbs the generator could not convert.
+
+    Keyed by (input md5, generator version), so a generator fix gives every
+    failed dtb another chance. A panel that can not be described may still
+    work with Dno, the only flag changing the panel description, so those
+    failures are also keyed by whether Dno was given. Entries expire after
+    `ttl` seconds (internal errors, likely bugs of the server, after
+    `internal_ttl`) and the oldest go first beyond `max_entries`.
+    """
+    # failures of the panel description, the other codes are about the dtb
+    PANEL_CODES = ('bad_panel', 'bad_init_sequence')
+
+    def __init__(self, version, max_entries, ttl, internal_ttl=60):
+        self.version = version
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.internal_ttl = internal_ttl
+        self.lock = threading.Lock()
+        # (md5, version, Dno or None) -> (code, message, expiry)
+        self.entries = OrderedDict()
+        self.failures = {}
+        self.hits = {}
+
+    def get(self, md5, flags):
+        """Return (code, message) of a failure remembered for these flags or None."""
+        with self.lock:
+            for key in ((md5, self.version, None), (md5, self.version, 'Dno' in flags)):
+                entry = self.entries.get(key)
+                if entry is None:
+                    continue
+                (code, message, expiry) = entry
+                if expiry < time.monotonic():
+                    del self.entries[key]
+                    continue
+                self.hits[code] = self.hits.get(code, 0) + 1
+                return (code, message)
+            return None
+
+    def put(self, md5, flags, code, message):
+        key = (md5, self.version, 'Dno' in flags if code in self.PANEL_CODES else None)
+        ttl = self.internal_ttl if code == 'internal' else self.ttl
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (code, message, time.monotonic() + ttl)
+            self.failures[code] = self.failures.get(code, 0) + 1
+            # expired ones at the front go first, shorter lived ones on get()
+            now = time.monotonic()
+            while self.entries and (len(self.entries) > self.max_entries or next(iter(self.entries.values()))[2] < now):
+                self.entries.popitem(last=False)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'max_entries': self.max_entries,
+                'ttl': self.ttl,
+                'internal_ttl': self.internal_ttl,
+                'failures': dict(self.failures),
+                'hits': dict(self.hits),
+            }
+
+
+class FingerprintCache:
+    """Overlays keyed by the fingerprint of the stock dtb instead of its md5.
+
+    Second level behind ConversionCache: uploads that differ only in parts
+    the generator never reads (see rocknix_dtbo.fingerprint()) share their
+    overlays, stored as 'fingerprint/<version>/<fingerprint+opts>'.
+    Conversion workers look them up on their own, right after fingerprinting
+    and before the panel description, so the server side only stores new
+    overlays and counts how many md5 misses the fingerprint caught.
+    """
+    def __init__(self, store, version):
+        self.store = store
+        self.version = version
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def store_key(self, fingerprint, flags):
+        return f"fingerprint/{self.version}/{make_name(fingerprint, parse_opts('-'.join(flags)))}"
+
+    def get(self, fingerprint, flags):
+        found = self.store.get(self.store_key(fingerprint, flags))
+        return bytes(found) if found is not None else None
+
+    def put(self, fingerprint, flags, dtbo):
+        self.store.put(self.store_key(fingerprint, flags), dtbo)
+
+    def record(self, reused):
+        """Count the result of a conversion, reused lists per flag set if it came from here."""
+        with self.lock:
+            self.hits += sum(reused)
+            self.misses += len(reused) - sum(reused)
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'version': self.version,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else None,
+            }
@@ -1,101 +1,417 @@
 #!/usr/bin/env python3
 
-from flask import Flask, request, render_template
+from flask import Flask, request, render_template, g
 from werkzeug.utils import secure_filename
-import hashlib
-import os, time
-import requests, json, re
+from werkzeug.wsgi import wrap_file
+import os, io, time, zipfile, functools, contextlib
+import json
 
-from rocknix_dtbo import make_dtbo
+from rocknix_dtbo import VERSION, FLAGS, LIMITS, ConversionError
+from overlay_cache import ConversionCache, FailureCache, FingerprintCache, parse_opts, split_name, make_name
+from telegram_notifier import TelegramNotifier
+from static_assets import StaticAssets
+from dtb_ingest import ingest, BadDtb, MultipartFile
+from convert_executor import ConversionExecutor, ExecutorBusy, ConversionTimeout, WorkerDied, make_dtbos_job
+from metrics import Registry, BYTES_BUCKETS
+from speculator import Speculator
+from event_store import EventStore
+from pack_store import PackStore
+from admission import RateLimiter, FairGate, RateLimited, client_key
 
 app = Flask(__name__)
 try:
-    app.config.from_file('config.json', load=json.load)
+    app.config.from_file(os.environ.get('OVERLAY_SERVER_CONFIG', 'config.json'), load=json.load)
 except:
     pass
-app.config['UPLOAD_DIR'] = 'uploads'
-app.config['DTBO_DIR'] = 'dtbo'
+# uploads and overlays, import old uploads/ and dtbo/ with pack_store.py
+app.config['PACK_DIR'] = 'pack'
 app.config['STATIC_DIR'] = 'static'
-app.config['FEEDBACK_DIR'] = 'feedback'
 app.config['MAX_CONTENT_LENGTH'] = 512 * 1024  # 512K should be enough, dtbs are usually about 100K
+app.config.setdefault('DTBO_CACHE_BYTES', 32 * 1024 * 1024)  # overlays are about 10K
+app.config.setdefault('PACK_SEGMENT_BYTES', 64 * 1024 * 1024)
+app.config.setdefault('UPLOAD_COMPRESSION', 'zlib')  # or 'lzma' or None, for the stored dtbs
+app.config.setdefault('STATIC_MAX_AGE', 3600)
+app.config.setdefault('CONVERT_WORKERS', os.cpu_count() or 1)  # 0 converts in the request thread
+app.config.setdefault('CONVERT_QUEUE', 4 * app.config['CONVERT_WORKERS'])
+app.config.setdefault('CONVERT_TIMEOUT', 30)
+# admission of uploads which need a conversion, cached ones always go through
+app.config.setdefault('CONVERT_RATE', 0.5)  # per client and second, None for no limit
+app.config.setdefault('CONVERT_BURST', 10)
+app.config.setdefault('CONVERT_CONCURRENCY', max(app.config['CONVERT_WORKERS'], 1))
+app.config.setdefault('CONVERT_CLIENT_QUEUE', 2)  # waiting conversions per client, more get 429
+app.config.setdefault('CONVERT_QUEUE_TIMEOUT', 10)  # seconds a conversion may wait for its turn
+app.config.setdefault('CLIENT_PREFIX_V4', 32)  # clients are counted per network of this size
+app.config.setdefault('CLIENT_PREFIX_V6', 64)
+app.config.setdefault('CLIENT_ADDRESS_HEADER', None)  # e.g. 'X-Forwarded-For' behind a proxy
+# guarded parsing, config.json may override single limits
+app.config['CONVERT_LIMITS'] = dict(LIMITS, **(app.config.get('CONVERT_LIMITS') or {}))
+app.config.setdefault('FAILURE_CACHE_ENTRIES', 10000)
+app.config.setdefault('FAILURE_CACHE_TTL', 24 * 3600)
+app.config.setdefault('FAILURE_CACHE_INTERNAL_TTL', 60)  # for failures that are not the dtb's fault
+app.config.setdefault('SPECULATE_VARIANTS', 4)  # 0 disables pre-generation
+app.config.setdefault('SPECULATE_QUEUE', 16)
+app.config.setdefault('SPECULATE_CPU_SHARE', 0.5)  # 0 disables pre-generation too
+app.config.setdefault('EVENTS_DB', 'events.sqlite')  # import old uploads/ and feedback/ with event_store.py
+app.config.setdefault('ADMIN_TOKEN', None)  # /events/ answers 404 without it
+# prefork_server.py, every worker process has its own CONVERT_WORKERS
+app.config.setdefault('SERVER_BIND', '127.0.0.1:5000')
+app.config.setdefault('SERVER_WORKERS', 2)
+app.config.setdefault('SERVER_THREADS', 8)
+app.config.setdefault('SERVER_MAX_REQUESTS', 10000)  # 0 never recycles a worker
+app.config.setdefault('SERVER_GRACEFUL_TIMEOUT', app.config['CONVERT_TIMEOUT'] + 10)
 
+app.config.setdefault('TELEGRAM_API_URL', 'https://api.telegram.org')
+app.config.setdefault('TELEGRAM_TIMEOUT', 10)
+app.config.setdefault('TELEGRAM_RETRIES', 3)
+app.config.setdefault('TELEGRAM_COALESCE_SECONDS', 5)
 
-def send_to_telegram(message, params):
-    """Send a message to a Telegram chat."""
-    if not 'TELEGRAM_APIKEY' in app.config:
+convert_job = functools.partial(make_dtbos_job, limits=app.config['CONVERT_LIMITS'],
+                                pack_dir=app.config['PACK_DIR'])
+pack_store = PackStore(app.config['PACK_DIR'], app.config['PACK_SEGMENT_BYTES'], app.logger)
+conversion_cache = ConversionCache(pack_store, VERSION, app.config['DTBO_CACHE_BYTES'])
+fingerprint_cache = FingerprintCache(pack_store, VERSION)
+failure_cache = FailureCache(VERSION, app.config['FAILURE_CACHE_ENTRIES'], app.config['FAILURE_CACHE_TTL'],
+                             app.config['FAILURE_CACHE_INTERNAL_TTL'])
+executor = ConversionExecutor(app.config['CONVERT_WORKERS'], app.config['CONVERT_QUEUE'],
+                              app.config['CONVERT_TIMEOUT'], app.logger, app.config['CONVERT_QUEUE_TIMEOUT'])
+rate_limiter = RateLimiter(app.config['CONVERT_RATE'], app.config['CONVERT_BURST'])
+convert_gate = FairGate(app.config['CONVERT_CONCURRENCY'], app.config['CONVERT_QUEUE'],
+                        app.config['CONVERT_CLIENT_QUEUE'], app.config['CONVERT_QUEUE_TIMEOUT'])
+speculator = Speculator(executor, conversion_cache, convert_job, app.logger,
+                        variants=app.config['SPECULATE_VARIANTS'], queue_size=app.config['SPECULATE_QUEUE'],
+                        cpu_share=app.config['SPECULATE_CPU_SHARE'])
+event_store = EventStore(app.config['EVENTS_DB'], app.logger)
+static_assets = StaticAssets()
+static_assets.get('index.html', 'index.html')
+static_assets.add_dir('static/', app.config['STATIC_DIR'])
+notifier = None
+if 'TELEGRAM_APIKEY' in app.config:
+    notifier = TelegramNotifier(app.config['TELEGRAM_APIKEY'], app.config['TELEGRAM_CHATS'], app.logger,
+                                base_url=app.config['TELEGRAM_API_URL'],
+                                timeout=app.config['TELEGRAM_TIMEOUT'],
+                                retries=app.config['TELEGRAM_RETRIES'],
+                                coalesce_delay=app.config['TELEGRAM_COALESCE_SECONDS'])
+
+metrics = Registry('dtbo_')
+request_seconds = metrics.histogram('http_request_duration_seconds', "Request latency per endpoint", ['endpoint'])
+requests_total = metrics.counter('http_requests_total', "Requests per endpoint and status", ['endpoint', 'status'])
+bytes_in = metrics.counter('http_request_bytes_total', "Request body bytes per endpoint", ['endpoint'])
+bytes_out = metrics.counter('http_response_bytes_total', "Response body bytes per endpoint", ['endpoint'])
+upload_bytes = metrics.histogram('upload_bytes', "Size of uploaded dtbs", buckets=BYTES_BUCKETS)
+stage_seconds = metrics.histogram('conversion_stage_seconds', "Time per make_dtbo() stage", ['stage'])
+conversion_failures = metrics.counter('conversion_failures_total', "Rejected uploads and failed conversions by exception class", ['class'])
+conversion_errors = metrics.counter('conversion_errors_total', "Unconvertible dtbs by error code, cached=1 when served from the failure cache", ['code', 'cached'])
+flag_requests = metrics.counter('flag_requests_total', "Requested overlay flags", ['flag'])
+dtbo_lookups = metrics.counter('overlay_lookups_total', "/dtbo/ lookups by where the overlay was found", ['result'])
+fingerprint_lookups = metrics.counter('fingerprint_lookups_total', "Overlays missing by md5, by whether an equivalent dtb had them", ['result'])
+conversions_rejected = metrics.counter('conversions_rejected_total', "Conversions not admitted by reason", ['reason'])
+metrics.gauge('cache_bytes', "Overlay bytes held in memory", lambda: {(): conversion_cache.stats()['bytes']})
+metrics.gauge('executor_workers', "Conversion workers by state",
+              lambda: {(state,): executor.stats()[state] for state in ('idle', 'pending', 'inflight')}, ['state'])
+metrics.gauge('convert_gate', "Admitted conversions running and waiting for a slot",
+              lambda: {(state,): convert_gate.stats()[state] for state in ('running', 'waiting')}, ['state'])
+
+
+def send_to_telegram(message, params, coalesce=False):
+    """Queue a message to Telegram chats, delivered in background."""
+    if notifier is None:
         return None
-    apikey = app.config['TELEGRAM_APIKEY']
-    url = f"https://api.telegram.org/bot{apikey}/sendMessage"
-    for chat in app.config['TELEGRAM_CHATS']:
-        payload = {
-            "chat_id": chat,
-            "text": message,
-            "parse_mode": "Markdown"
-        }
-        payload.update(params)
-        app.logger.info(f"tg post {json.dumps(payload)}")
-        response = requests.post(url, json=payload)
-    return response.status_code, response.text
+    return notifier.notify(message, params, coalesce)
+
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+
+@app.after_request
+def record_request(response):
+    endpoint = request.endpoint or 'unknown'
+    request_seconds.observe(time.perf_counter() - g.request_start, endpoint)
+    requests_total.inc(endpoint, str(response.status_code))
+    bytes_in.inc(endpoint, amount=request.content_length or 0)
+    bytes_out.inc(endpoint, amount=response.content_length or 0)
+    return response
+
+
+@app.errorhandler(ExecutorBusy)
+def executor_busy(e):
+    return ("Too many conversions in progress, retry later", 503, {'retry-after': '1'})
+
+@app.errorhandler(RateLimited)
+def rate_limited(e):
+    return ("Too many conversions from your address, retry later", 429, {'retry-after': str(e.retry_after)})
+
+@app.errorhandler(ConversionError)
+def conversion_error(e):
+    return (f"Can not convert this dtb ({e.code}): {e}", 422, {'x-dtbo-error': e.code})
+
+@app.errorhandler(ConversionTimeout)
+def conversion_timeout(e):
+    return ("Conversion took too long", 504, {})
 
 
 @app.route('/', methods=['GET'])
 def index():
-    return open('index.html').read()
+    asset = static_assets.get('index.html', 'index.html')
+    if asset is None:
+        return ('Not found', 404, {})
+    return static_assets.response(asset, request, 'no-cache')
 
-@app.route('/dtbo/<md5>')
+@app.route('/dtbo/<md5>', methods=['GET', 'HEAD'])
 def download_dtbo(md5):
+    (md5, flags) = split_name(md5)
+    found = conversion_cache.lookup(md5, flags)
+    dtbo_lookups.inc('miss' if found is None else 'memory' if isinstance(found, bytes) else 'disk')
+    if found is None:
+        return ('Not found', 404, {})
+    speculator.used(md5, flags)
+    # a variant is as popular when fetched again as when converted
+    if request.method == 'GET' and all(flag in FLAGS for flag in flags):
+        speculator.record(flags)
+    headers = {'etag': conversion_cache.etag(md5, flags), 'cache-control': 'no-cache'}
+    if request.if_none_match.contains_raw(headers['etag']):
+        return ('', 304, headers)
+    headers['content-disposition'] = 'attachment; filename="mipi-panel.dtbo"'
+    if isinstance(found, bytes):
+        return (found, 200, headers)
+    # not in memory, let the server sendfile() it from the pack (HEAD drops the body)
+    extent = conversion_cache.open(md5, flags)
+    body = wrap_file(request.environ, extent) if extent is not None else [bytes(found)]
+    headers['content-length'] = str(found.nbytes)
+    return app.response_class(body, 200, headers, mimetype='application/octet-stream', direct_passthrough=True)
+
+@app.route('/dtbo_exists', methods=['POST'])
+def dtbo_exists():
+    """Check many 'md5+opts' names at once: {"names": [...]} -> {name: bool}"""
+    names = (request.get_json(silent=True) or {}).get('names')
+    if not isinstance(names, list) or len(names) > 1000:
+        return ("Bad request", 400, {})
+    return {name: conversion_cache.lookup(*split_name(str(name))) is not None for name in names}
+
+@app.route('/stats')
+def stats():
+    return {
+        'conversion_cache': conversion_cache.stats(),
+        'telegram': notifier.stats() if notifier else None,
+        'executor': executor.stats(),
+        'admission': dict(convert_gate.stats(), **rate_limiter.stats()),
+        'failure_cache': failure_cache.stats(),
+        'fingerprint_cache': fingerprint_cache.stats(),
+        'speculator': speculator.stats(),
+        'event_store': event_store.stats(),
+        'pack_store': pack_store.stats(),
+    }
+
+@app.route('/ready')
+def ready():
+    """Readiness probe, also starts the conversion workers of this process."""
     try:
-        f = open(os.path.join(app.config['DTBO_DIR'], secure_filename(md5)), 'rb')
-        dtbo = f.read()
-        return (dtbo, 200, {'content-disposition': 'attachment; filename="mipi-panel.dtbo"'})
-    except:
+        executor.start()
+        pack_store.stats()
+    except Exception as e:
+        app.logger.warning(f"not ready: {type(e).__name__}: {e}")
+        return ('Not ready', 503, {})
+    return {'version': VERSION, 'pid': os.getpid(), 'executor': executor.stats()}
+
+@app.route('/metrics')
+def export_metrics():
+    return (metrics.render(), 200, {'content-type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+def admin_only():
+    token = app.config['ADMIN_TOKEN']
+    given = request.headers.get('authorization', '').removeprefix('Bearer ') or request.args.get('token')
+    return token is not None and given == token
+
+def query_args():
+    """?before=<unix time>&limit=N paging shared by the /events/ queries"""
+    before = request.args.get('before', type=float)
+    limit = min(max(request.args.get('limit', 100, type=int), 1), 1000)
+    return (before, limit)
+
+@app.route('/events/uploads')
+def query_uploads():
+    """?md5=...&flag=LSi, newest first"""
+    if not admin_only():
         return ('Not found', 404, {})
+    (before, limit) = query_args()
+    rows = event_store.uploads(request.args.get('md5'), request.args.get('flag'), before, limit)
+    return {'uploads': rows}
+
+@app.route('/events/feedback')
+def query_feedback():
+    """?md5=..., newest first"""
+    if not admin_only():
+        return ('Not found', 404, {})
+    (before, limit) = query_args()
+    return {'feedback': event_store.feedback(request.args.get('md5'), before, limit)}
 
 @app.route('/static/<file>')
 def download_static(file):
-    try:
-        f = open(os.path.join(app.config['STATIC_DIR'], secure_filename(file)), 'rb')
-        body = f.read()
-        headers = {}
-        if re.search(r'\.js$', file):
-            headers = {'content-type': 'application/javascript'}
-        elif re.search(r'\.css$', file):
-            headers = {'content-type': 'text/css'}
-        else:
-            headers = {'content-type': 'application/octet-stream', 'content-disposition': f'attachment; filename="{file}"'}
-        return (body, 200, headers)
-    except:
+    file = secure_filename(file)
+    asset = static_assets.get('static/' + file, os.path.join(app.config['STATIC_DIR'], file))
+    if asset is None:
         return ('Not found', 404, {})
+    return static_assets.response(asset, request, f"public, max-age={app.config['STATIC_MAX_AGE']}")
 
-@app.route('/convert_dtb', methods=['POST'])
-def upload_file():
-    if 'file' not in request.files:
-        return 'No file part'
-    file = request.files['file']
-    content = file.read()
+def client():
+    """Network of the requesting client, what rate limits count."""
+    address = request.remote_addr
+    header = app.config['CLIENT_ADDRESS_HEADER']
+    if header and request.headers.get(header):
+        # the address the proxy appended, the ones before are up to the client
+        address = request.headers[header].split(',')[-1].strip()
+    return client_key(address, app.config['CLIENT_PREFIX_V4'], app.config['CLIENT_PREFIX_V6'])
+
+@contextlib.contextmanager
+def admitted():
+    """Take a token and a conversion slot for the client, see executor.run()."""
+    who = client()
+    try:
+        rate_limiter.take(who)
+    except RateLimited:
+        conversions_rejected.inc('rate_limited')
+        raise
+    try:
+        convert_gate.acquire(who)
+    except (RateLimited, ExecutorBusy) as e:
+        # turned away without converting, that costs no token
+        rate_limiter.give(who)
+        conversions_rejected.inc('rate_limited' if isinstance(e, RateLimited) else 'busy')
+        raise
+    try:
+        yield
+    finally:
+        convert_gate.release()
+
+def convert(content, md5, srcname, flagsets):
+    """Get overlays for every flag set, converting only the ones not cached yet.
 
-    md5 = hashlib.md5(content).hexdigest()
-    opts = request.args.get('opts', '')
+    Returns per flag set the overlay or the ConversionError of that flag set,
+    errors of the stock dtb itself are raised.
+    """
+    for flags in flagsets:
+        for flag in flags:
+            flag_requests.inc(flag if flag in FLAGS else 'other')
+        if all(flag in FLAGS for flag in flags):
+            speculator.record(flags)
+    dtbos = [conversion_cache.get(md5, flags) for flags in flagsets]
+    for (flags, dtbo) in zip(flagsets, dtbos):
+        if dtbo is not None:
+            speculator.used(md5, flags)
+    missing = list(dict.fromkeys(tuple(flags) for (flags, dtbo) in zip(flagsets, dtbos) if dtbo is None))
+    if not missing:
+        return dtbos
 
-    ovlname = secure_filename(md5 + opts)
-    filename = secure_filename(md5 + '-' + file.filename)
+    # known bad dtbs (and panels, with or without Dno) never reach the parser again
+    errors = {}
+    for flags in missing:
+        failed = failure_cache.get(md5, flags)
+        if failed is not None:
+            conversion_errors.inc(failed[0], '1')
+            if failed[0] not in FailureCache.PANEL_CODES:
+                raise ConversionError(*failed)
+            errors[flags] = ConversionError(*failed)
+    missing = [flags for flags in missing if flags not in errors]
+    if not missing:
+        return [dtbo if dtbo is not None else errors[tuple(flags)] for (flags, dtbo) in zip(flagsets, dtbos)]
 
-    flags = opts.split('-')
-    flags = [ f for f in flags if f != '']
-    dtbo = make_dtbo(content, {'flags': flags, 'logger': app.logger})
+    # concurrent uploads of the same dtb share one conversion, the worker
+    # takes overlays of an equivalent dtb from fingerprint_cache if it can
+    try:
+        # only a conversion that does not join another one is admitted
+        (made, stages, fingerprint, reused) = executor.run((md5, tuple(missing)), convert_job, content, missing,
+                                                           admit=admitted)
+    except (ExecutorBusy, RateLimited):
+        raise
+    except (ConversionTimeout, WorkerDied) as e:
+        # not necessarily the dtb's fault, may work next time
+        conversion_failures.inc(type(e).__name__)
+        raise
+    except Exception as e:
+        conversion_failures.inc(type(e).__name__)
+        if not isinstance(e, ConversionError):
+            app.logger.warning(f"conversion of {md5} failed: {type(e).__name__}: {e}")
+            e = ConversionError('internal', f"{type(e).__name__}: {e}")
+        failure_cache.put(md5, missing[0], e.code, str(e))
+        conversion_errors.inc(e.code, '0')
+        raise e
+    for (stage, seconds) in stages.items():
+        stage_seconds.observe(seconds, stage)
+    fingerprint_cache.record(reused)
+    for (flags, dtbo, hit) in zip(missing, made, reused):
+        if isinstance(dtbo, ConversionError):
+            errors[flags] = dtbo
+            failure_cache.put(md5, flags, dtbo.code, str(dtbo))
+            conversion_failures.inc(type(dtbo).__name__)
+            conversion_errors.inc(dtbo.code, '0')
+            continue
+        fingerprint_lookups.inc('hit' if hit else 'miss')
+        if not hit:
+            fingerprint_cache.put(fingerprint, flags, dtbo)
+    made = dict((flags, dtbo) for (flags, dtbo) in zip(missing, made) if flags not in errors)
+    found = {**made, **errors}
+    results = [dtbo if dtbo is not None else found[tuple(flags)] for (flags, dtbo) in zip(flagsets, dtbos)]
+    if not made:
+        return results
 
     # Save strictly after getting dtbo to lower abuse
     # Garbage will just crash the extractor, and nothing will be saved on disk
-    os.makedirs(app.config['UPLOAD_DIR'], exist_ok=True)
-    os.makedirs(app.config['DTBO_DIR'], exist_ok=True)
-    with open(os.path.join(app.config['UPLOAD_DIR'], filename), 'wb') as f:
-        f.write(content)
-    with open(os.path.join(app.config['DTBO_DIR'], ovlname), 'wb') as f:
-        f.write(dtbo)
+    # One copy per md5, the filenames are in the event store
+    pack_store.put('dtb/' + md5, content, app.config['UPLOAD_COMPRESSION'], replace=False)
+    for (flags, dtbo) in made.items():
+        conversion_cache.put(md5, flags, dtbo)
+
+    if 'silent' not in request.args:
+        ovlnames = ', '.join(secure_filename(make_name(md5, flags)) for flags in made)
+        send_to_telegram(f"new overlay: {ovlnames} for {srcname}", {"disable_notification": True}, coalesce=True)
+
+    return results
+
+@app.route('/convert_dtb', methods=['POST'])
+def upload_file():
+    if request.mimetype != 'multipart/form-data' or 'boundary' not in request.mimetype_params:
+        return 'No file part'
+    # decoded as it arrives, request.files would buffer the whole body first
+    file = MultipartFile(request.stream, request.mimetype_params['boundary'])
+    try:
+        if not file.find():
+            return 'No file part'
+        (content, md5) = ingest(file, app.config['MAX_CONTENT_LENGTH'])
+    except BadDtb as e:
+        conversion_failures.inc(type(e).__name__)
+        return (f"Not a dtb: {e}", 400, {})
+    upload_bytes.observe(len(content))
 
-    if 'silent' not in request.values:
-        send_to_telegram(f"new overlay: {ovlname} for {file.filename}", {"disable_notification": True})
+    # ?variant=-LSi&variant=-LSi-HPi&... returns a zip with an overlay per variant
+    if 'variant' in request.args:
+        flagsets = [parse_opts(opts) for opts in request.args.getlist('variant')]
+        t0 = time.monotonic()
+        dtbos = convert(content, md5, file.filename, flagsets)
+        errors = [(flags, dtbo) for (flags, dtbo) in zip(flagsets, dtbos) if isinstance(dtbo, ConversionError)]
+        if len(errors) == len(flagsets):
+            raise errors[0][1]
+        event_store.record_upload(md5, file.filename, flagsets, VERSION, len(content), time.monotonic() - t0)
+        speculator.schedule(md5, content, flagsets)
+        body = io.BytesIO()
+        with zipfile.ZipFile(body, 'w') as z:
+            for (flags, dtbo) in zip(flagsets, dtbos):
+                if not isinstance(dtbo, ConversionError):
+                    z.writestr(secure_filename(make_name(md5, flags)) + '.dtbo', dtbo)
+            if errors:
+                # the variants that could not be made, and why
+                z.writestr('errors.txt', ''.join(f"{secure_filename(make_name(md5, flags))}: {e.code}: {e}\n"
+                                                 for (flags, e) in errors))
+        return (body.getvalue(), 200, {'content-type': 'application/zip',
+                                       'content-disposition': 'attachment; filename="mipi-panel-variants.zip"'})
 
+    flags = parse_opts(request.args.get('opts', ''))
+    t0 = time.monotonic()
+    [dtbo] = convert(content, md5, file.filename, [flags])
+    if isinstance(dtbo, ConversionError):
+        raise dtbo
+    event_store.record_upload(md5, file.filename, [flags], VERSION, len(content), time.monotonic() - t0)
+    # the user may come back for another variant
+    speculator.schedule(md5, content, [flags])
     return (dtbo, 200, {'content-disposition': 'attachment; filename="mipi-panel.dtbo"'})
 
 
@@ -106,15 +422,20 @@ def feedback(md5):
     desc = request.form.get('description')
     if (not dev) or (not desc):
         return ("Bad form", 400, {})
-    os.makedirs(app.config['FEEDBACK_DIR'], exist_ok=True)
-    filename = secure_filename(md5) + '-' + str(time.time())
-    report = f"`{filename}`\nfeedback from `{user}`\ndev: `{dev}`\n\n{desc}\n"
-    with open(os.path.join(app.config['FEEDBACK_DIR'], filename), 'w') as f:
-        f.write(report)
+    md5 = secure_filename(md5)
+    event_store.record_feedback(md5, user, dev, desc)
+    report = f"`{md5}-{time.time()}`\nfeedback from `{user}`\ndev: `{dev}`\n\n{desc}\n"
     send_to_telegram(report, {})
 
     return ("Accepted", 201, {})
 
 
+def shutdown():
+    """Finish background work before this process exits."""
+    speculator.stop()
+    event_store.flush()
+    executor.stop()
+
+
 if __name__ == '__main__':
     app.run(debug=True)
@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+
+# Building a dtb overlay directly, without the pyfdt object model
+
+import struct
+
+FDT_MAGIC = 0xd00dfeed
+FDT_BEGIN_NODE = 0x1
+FDT_END_NODE = 0x2
+FDT_PROP = 0x3
+FDT_END = 0x9
+FDT_VERSION = 17
+FDT_LAST_COMP_VERSION = 16
+HEADER = struct.Struct('>10I')
+
+
+def encode_value(value):
+    """Encode a property value the way fdt.Node.set_property() types it."""
+    if value is None:
+        return b''
+    elif isinstance(value, int):
+        return struct.pack('>I', value)
+    elif isinstance(value, str):
+        return value.encode('ascii') + b'\0'
+    elif isinstance(value, list) and isinstance(value[0], int):
+        return struct.pack(f'>{len(value)}I', *value)
+    elif isinstance(value, list) and isinstance(value[0], str):
+        return b''.join(s.encode('ascii') + b'\0' for s in value)
+    elif isinstance(value, (bytes, bytearray)):
+        return bytes(value)
+    else:
+        raise TypeError('Value type not supported')
+
+def align4(n):
+    return (n + 3) & ~3
+
+
+class OverlayNode:
+    """Node of an overlay being built. path is the parent path, like fdt.Node.path."""
+    __slots__ = ('name', 'path', 'props', 'nodes')
+
+    def __init__(self, name, path):
+        self.name = name
+        self.path = path
+        # insertion ordered, re-setting a property keeps its place
+        self.props = {}
+        self.nodes = {}
+
+    def set_property(self, name, value):
+        self.props[name] = encode_value(value)
+
+    def subnode(self, name):
+        node = self.nodes.get(name)
+        if node is None:
+            if self.name == '/':
+                path = '/'
+            elif self.path == '/':
+                path = '/' + self.name
+            else:
+                path = self.path + '/' + self.name
+            node = OverlayNode(name, path)
+            self.nodes[name] = node
+        return node
+
+
+class OverlayWriter:
+    """Collects overlay fragments and fixups and writes the dtb in one go.
+
+    Fragment numbering, __fixups__ and __local_fixups__ are kept in plain
+    dicts and the fixup nodes are emitted after all fragments.
+    """
+    def __init__(self):
+        self.root = OverlayNode('/', '/')
+        self.fragments = 0
+        # label -> list of 'path:property:offset'
+        self.fixups = {}
+        self.local_fixups = OverlayNode('__local_fixups__', '/')
+        self.labels = {}
+
+    def get_node(self, path):
+        node = self.root
+        for name in path.strip('/').split('/'):
+            if name:
+                node = node.subnode(name)
+        return node
+
+    def set_property(self, name, value, path=''):
+        self.get_node(path).set_property(name, value)
+
+    def add_label(self, label):
+        # same numbering as fdt.FDT.add_label()
+        if label not in self.labels:
+            self.labels[label] = len(self.labels) + 1
+        return self.labels[label]
+
+    def add_fragment(self, target):
+        """Add fragment@N for a '/path' or '&label' target, return its __overlay__ node."""
+        nodename = f'fragment@{self.fragments}'
+        self.fragments += 1
+        fragnode = self.root.subnode(nodename)
+        if target[0] == '&':
+            fragnode.set_property('target', 0xffffffff)
+            self.fixups[target[1:]] = ['/' + nodename + ':target:0']
+        else:
+            fragnode.set_property('target-path', target)
+        return fragnode.subnode('__overlay__')
+
+    def add_fixup(self, label, fixup_path):
+        self.fixups.setdefault(label, []).append(fixup_path)
+
+    def add_local_fixup(self, parent_path, name):
+        node = self.local_fixups
+        for part in parent_path.strip('/').split('/'):
+            if part:
+                node = node.subnode(part)
+        node.set_property(name, 0)
+
+    def to_dtb(self):
+        nodes = [self.root]
+        if self.fixups:
+            fixups = OverlayNode('__fixups__', '/')
+            for (label, paths) in self.fixups.items():
+                fixups.set_property(label, paths)
+            nodes.append(fixups)
+        if self.local_fixups.props or self.local_fixups.nodes:
+            nodes.append(self.local_fixups)
+
+        def children(node):
+            if node is self.root:
+                return list(node.nodes.values()) + nodes[1:]
+            return node.nodes.values()
+
+        # first pass: sizes and the string table (shared like pyfdt does)
+        strings = ''
+        stroffs = {}
+        size = 0
+        def measure(node):
+            nonlocal strings, size
+            size += 4 + align4(len(node.name.encode('ascii')) + 1 if node.name != '/' else 1)
+            for (name, raw) in node.props.items():
+                if name not in stroffs:
+                    pos = strings.find(name + '\0')
+                    if pos < 0:
+                        pos = len(strings)
+                        strings += name + '\0'
+                    stroffs[name] = pos
+                size += 12 + align4(len(raw))
+            for child in children(node):
+                measure(child)
+            size += 4
+        measure(self.root)
+        size += 4
+
+        # second pass: write the structure block into one buffer
+        off_struct = HEADER.size + 16
+        strings = strings.encode('ascii')
+        blob = bytearray(off_struct + size + len(strings))
+        pos = off_struct
+        def write(node):
+            nonlocal pos
+            struct.pack_into('>I', blob, pos, FDT_BEGIN_NODE)
+            pos += 4
+            if node.name != '/':
+                name = node.name.encode('ascii')
+                blob[pos:pos + len(name)] = name
+                pos += align4(len(name) + 1)
+            else:
+                pos += 4
+            for (name, raw) in node.props.items():
+                struct.pack_into('>III', blob, pos, FDT_PROP, len(raw), stroffs[name])
+                pos += 12
+                blob[pos:pos + len(raw)] = raw
+                pos += align4(len(raw))
+            for child in children(node):
+                write(child)
+            struct.pack_into('>I', blob, pos, FDT_END_NODE)
+            pos += 4
+        write(self.root)
+        struct.pack_into('>I', blob, pos, FDT_END)
+        pos += 4
+        blob[pos:] = strings
+
+        HEADER.pack_into(blob, 0, FDT_MAGIC, len(blob), off_struct, off_struct + size, HEADER.size,
+                         FDT_VERSION, FDT_LAST_COMP_VERSION, 0, len(strings), size)
+        return bytes(blob)
@@ -0,0 +1,615 @@
+#!/usr/bin/env python3
+
+# Uploads and overlays in a few append-only pack files instead of a file each
+
+import os, mmap, struct, zlib, lzma, hashlib, threading, fcntl, contextlib
+from collections import namedtuple
+
+SEGMENT_MAGIC = b'DTBPACK1'
+INDEX_MAGIC = b'DTBPIDX1'
+# kind, codec, key length, stored length, raw length, crc32 of key and stored bytes
+RECORD = struct.Struct('>BBHIII')
+# used counts deleted slots too, moved is set in a replaced index, active is
+# the segment appended to and end its length, compactions tells other
+# processes to let go of the segments they mapped
+INDEX_HEADER = struct.Struct('>8sIIIIIQI')
+Header = namedtuple('Header', 'magic slots used live moved active end compactions')
+INDEX_HEADER_SIZE = 64
+# key hash (0 = empty), segment (0 = deleted), record offset
+SLOT = struct.Struct('>QII')
+
+PUT = 1
+DELETE = 2
+CODECS = {None: 0, 'zlib': 1, 'lzma': 2}
+MIN_SLOTS = 1024
+
+
+def key_hash(key):
+    return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), 'big') | 1
+
+def compress(data, codec):
+    if codec == 'zlib':
+        return zlib.compress(data, 6)
+    if codec == 'lzma':
+        return lzma.compress(data)
+    return data
+
+def decompress(data, codec_id):
+    if codec_id == CODECS['zlib']:
+        return zlib.decompress(data)
+    if codec_id == CODECS['lzma']:
+        return lzma.decompress(data)
+    return data
+
+def segment_name(seg):
+    return f'{seg:08d}.pack'
+
+
+class Extent:
+    """File object for one value inside a segment.
+
+    The descriptor is positioned at the value, so a server with
+    wsgi.file_wrapper can sendfile() content-length bytes from it, read()
+    stops at the end of the value.
+    """
+    def __init__(self, path, offset, length):
+        self.file = open(path, 'rb')
+        self.file.seek(offset)
+        self.left = length
+
+    def fileno(self):
+        return self.file.fileno()
+
+    def read(self, size=-1):
+        size = self.left if size < 0 else min(size, self.left)
+        data = self.file.read(size)
+        self.left -= len(data)
+        return data
+
+    def close(self):
+        self.file.close()
+
+
+class PackStore:
+    """Key -> bytes store in append-only segment files.
+
+    Every put() appends a record (header, key, maybe compressed value) to the
+    active segment, a new one is started beyond `segment_bytes`. index is an
+    on-disk open addressing hash table of key hash -> (segment, offset),
+    mapped into memory and shared by all processes using the directory, so
+    lookups take no lock and no read(); the key stored in the record decides.
+    Writes take a lockf() lock (per process, so forked workers exclude each
+    other) and a thread lock.
+
+    get() returns a memoryview into the mapped segment for uncompressed
+    values, nothing is copied until the caller does; open() gives a file
+    positioned at the value for sendfile(). On open, records
+    appended after the index was last updated are indexed and a torn tail is
+    cut off; a missing or broken index is rebuilt from the segments.
+    compact() rewrites segments that are mostly garbage.
+    """
+    def __init__(self, directory, segment_bytes=64 * 1024 * 1024, logger=None):
+        self.dir = directory
+        self.segment_bytes = segment_bytes
+        self.logger = logger
+        os.makedirs(directory, exist_ok=True)
+        self.lock = threading.RLock()
+        self.depth = 0
+        self.lock_fd = os.open(os.path.join(directory, 'lock'), os.O_RDWR | os.O_CREAT, 0o644)
+        # only the segment being appended to stays open, the others are mapped
+        self.write_fd = (None, None)
+        self.maps = {}
+        self.index = None
+        self.compactions = 0
+        with self.locked():
+            self.open_index()
+            self.recover()
+
+    def log(self, message):
+        if self.logger is not None:
+            self.logger.warning(f"pack store {self.dir}: {message}")
+
+    @contextlib.contextmanager
+    def locked(self):
+        with self.lock:
+            if self.depth == 0:
+                fcntl.lockf(self.lock_fd, fcntl.LOCK_EX)
+            self.depth += 1
+            try:
+                yield
+            finally:
+                self.depth -= 1
+                if self.depth == 0:
+                    fcntl.lockf(self.lock_fd, fcntl.LOCK_UN)
+
+    # segments
+
+    def segments(self):
+        return sorted(int(name[:-5]) for name in os.listdir(self.dir)
+                      if name.endswith('.pack') and name[:-5].isdigit())
+
+    def segment_path(self, seg):
+        return os.path.join(self.dir, segment_name(seg))
+
+    def segment_fd(self, seg):
+        """Descriptor to append to a segment, created if needed."""
+        (open_seg, fd) = self.write_fd
+        if open_seg != seg:
+            path = self.segment_path(seg)
+            if not os.path.exists(path):
+                tmp = path + '.tmp'
+                with open(tmp, 'wb') as f:
+                    f.write(SEGMENT_MAGIC)
+                os.replace(tmp, path)
+            if fd is not None:
+                # a full segment is not written again, settle it on disk
+                os.fsync(fd)
+                os.close(fd)
+            fd = os.open(path, os.O_RDWR)
+            self.write_fd = (seg, fd)
+        return fd
+
+    def map_segment(self, seg):
+        try:
+            fd = os.open(self.segment_path(seg), os.O_RDONLY)
+        except FileNotFoundError:
+            return None
+        try:
+            size = os.fstat(fd).st_size
+            return mmap.mmap(fd, size, access=mmap.ACCESS_READ) if size else None
+        finally:
+            os.close(fd)
+
+    def segment_map(self, seg, needed):
+        """Mapping of a segment at least `needed` bytes long, or None."""
+        m = self.maps.get(seg)
+        if m is None or len(m) < needed:
+            # views handed out keep an older, shorter mapping alive
+            m = self.map_segment(seg)
+            if m is None or len(m) < needed:
+                return None
+            self.maps[seg] = m
+        return m
+
+    def drop_segment(self, seg):
+        self.maps.pop(seg, None)
+        if self.write_fd[0] == seg:
+            os.close(self.write_fd[1])
+            self.write_fd = (None, None)
+
+    def read_record(self, seg, off):
+        """(kind, codec, key, value view) of a record, None if it does not fit."""
+        m = self.segment_map(seg, off + RECORD.size)
+        if m is None:
+            return None
+        (kind, codec, keylen, stored, raw, crc) = RECORD.unpack_from(m, off)
+        if kind not in (PUT, DELETE):
+            return None
+        end = off + RECORD.size + keylen + stored
+        if end > len(m):
+            m = self.segment_map(seg, end)
+            if m is None:
+                return None
+        view = memoryview(m)
+        start = off + RECORD.size
+        return (kind, codec, bytes(view[start:start + keylen]), view[start + keylen:end])
+
+    def scan(self, seg, start=len(SEGMENT_MAGIC)):
+        """Yield (offset, kind, key, record) of the valid records from start, as bytes.
+
+        Stops at the first incomplete or corrupt record, its offset is in
+        self.scan_end afterwards.
+        """
+        self.scan_end = start
+        m = self.map_segment(seg)
+        if m is None or len(m) <= start:
+            return
+        size = len(m)
+        with m:
+            if m[:len(SEGMENT_MAGIC)] != SEGMENT_MAGIC:
+                self.scan_end = 0
+                return
+            off = start
+            while off + RECORD.size <= size:
+                (kind, codec, keylen, stored, raw, crc) = RECORD.unpack_from(m, off)
+                end = off + RECORD.size + keylen + stored
+                if kind not in (PUT, DELETE) or end > size:
+                    break
+                if zlib.crc32(m[off + RECORD.size:end]) != crc:
+                    break
+                key = m[off + RECORD.size:off + RECORD.size + keylen]
+                yield (off, kind, key, m[off:end])
+                off = end
+                self.scan_end = off
+
+    # index
+
+    def header(self, index=None):
+        return Header._make(INDEX_HEADER.unpack_from(self.index if index is None else index, 0))
+
+    def set_header(self, **fields):
+        INDEX_HEADER.pack_into(self.index, 0, *self.header()._replace(**fields))
+
+    def open_index(self):
+        # the old table is not closed, lookups in other threads may still use it
+        self.index = None
+        path = os.path.join(self.dir, 'index')
+        try:
+            fd = os.open(path, os.O_RDWR)
+        except FileNotFoundError:
+            fd = None
+        if fd is not None:
+            try:
+                size = os.fstat(fd).st_size
+                if size >= INDEX_HEADER_SIZE:
+                    m = mmap.mmap(fd, size)
+                    header = self.header(m)
+                    if (header.magic == INDEX_MAGIC and not header.moved
+                            and size == INDEX_HEADER_SIZE + header.slots * SLOT.size):
+                        self.index = m
+                        return
+                    m.close()
+            finally:
+                os.close(fd)
+            self.log("index is broken, rebuilding it")
+        self.rebuild()
+
+    def check_moved(self):
+        if self.header().moved:
+            self.open_index()
+
+    def current(self):
+        """The index table, reopened if another process replaced it."""
+        index = self.index
+        header = self.header(index)
+        if header.moved:
+            with self.locked():
+                self.check_moved()
+                index = self.index
+                header = self.header(index)
+        if header.compactions != self.compactions:
+            # mappings of deleted segments would keep their disk space
+            self.maps = {}
+            self.compactions = header.compactions
+        return index
+
+    def write_index(self, entries, slots, active, end, compactions=0):
+        """Replace the index by one with `slots` slots holding entries [(hash, seg, off)]."""
+        path = os.path.join(self.dir, 'index')
+        table = bytearray(INDEX_HEADER_SIZE + slots * SLOT.size)
+        INDEX_HEADER.pack_into(table, 0, INDEX_MAGIC, slots, len(entries), len(entries), 0, active, end, compactions)
+        for (h, seg, off) in entries:
+            i = h % slots
+            while SLOT.unpack_from(table, INDEX_HEADER_SIZE + i * SLOT.size)[0]:
+                i = (i + 1) % slots
+            SLOT.pack_into(table, INDEX_HEADER_SIZE + i * SLOT.size, h, seg, off)
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(table)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+        if self.index is not None:
+            # other processes still looking at the old table reopen it
+            self.set_header(moved=1)
+        self.open_index()
+
+    def rebuild(self):
+        """Index everything in the segments, the newest record of a key wins."""
+        found = {}
+        segments = self.segments()
+        (active, end) = (1, len(SEGMENT_MAGIC))
+        for seg in segments:
+            for (off, kind, key, _) in self.scan(seg):
+                if kind == PUT:
+                    found[key] = (seg, off)
+                else:
+                    found.pop(key, None)
+            size = os.path.getsize(self.segment_path(seg))
+            if seg != segments[-1] and self.scan_end < size:
+                self.log(f"{segment_name(seg)} is corrupt after {self.scan_end}, {size - self.scan_end} bytes skipped")
+            (active, end) = (seg, self.scan_end)
+        if segments:
+            self.truncate(active, end)
+        slots = MIN_SLOTS
+        while len(found) * 2 > slots:
+            slots *= 2
+        compactions = self.header().compactions + 1 if self.index is not None else 0
+        self.write_index([(key_hash(key), seg, off) for (key, (seg, off)) in found.items()],
+                         slots, active, end, compactions)
+
+    def truncate(self, seg, end):
+        fd = self.segment_fd(seg)
+        size = os.fstat(fd).st_size
+        if size > end:
+            self.log(f"cutting {segment_name(seg)} at {end}, {size - end} bytes of a torn write")
+            self.maps.pop(seg, None)
+            os.ftruncate(fd, max(end, len(SEGMENT_MAGIC)))
+
+    def recover(self):
+        """Index records written after the last index update, e.g. by a killed process."""
+        (active, end) = (self.header().active, self.header().end)
+        segments = self.segments()
+        if segments and (segments[-1] != active or os.path.getsize(self.segment_path(active)) < end):
+            self.log("index does not match the segments, rebuilding it")
+            self.rebuild()
+            return
+        if not segments or os.path.getsize(self.segment_path(active)) == end:
+            return
+        for (off, kind, key, _) in self.scan(active, end):
+            self.index_record(key, kind, active, off)
+        self.truncate(active, self.scan_end)
+        # the counts may have missed the last slot written
+        slots = [self.slot(i) for i in range(self.header().slots)]
+        self.set_header(end=self.scan_end, used=sum(1 for slot in slots if slot[0]),
+                        live=sum(1 for slot in slots if slot[1]))
+
+    def slot(self, i, index=None):
+        return SLOT.unpack_from(self.index if index is None else index, INDEX_HEADER_SIZE + i * SLOT.size)
+
+    def probe(self, key, h, index=None):
+        """(slot of key or None, first reusable slot) for a key."""
+        index = self.index if index is None else index
+        slots = self.header(index).slots
+        i = h % slots
+        free = None
+        for _ in range(slots):
+            (sh, seg, off) = self.slot(i, index)
+            if sh == 0:
+                return (None, i if free is None else free)
+            if sh == h:
+                if seg == 0:
+                    if free is None:
+                        free = i
+                else:
+                    record = self.read_record(seg, off)
+                    if record is not None and record[2] == key:
+                        return (i, i)
+            i = (i + 1) % slots
+        return (None, free)
+
+    def index_record(self, key, kind, seg, off):
+        # caller holds the lock
+        h = key_hash(key)
+        (i, free) = self.probe(key, h)
+        (slots, used, live) = self.header()[1:4]
+        if kind == DELETE:
+            if i is not None:
+                SLOT.pack_into(self.index, INDEX_HEADER_SIZE + i * SLOT.size, h, 0, 0)
+                self.set_header(live=live - 1)
+            return
+        if i is not None:
+            SLOT.pack_into(self.index, INDEX_HEADER_SIZE + i * SLOT.size, h, seg, off)
+            return
+        if free is None or (used + 1) * 10 > slots * 7:
+            self.grow()
+            (i, free) = self.probe(key, h)
+            (slots, used, live) = self.header()[1:4]
+        if self.slot(free)[0] == 0:
+            used += 1
+        SLOT.pack_into(self.index, INDEX_HEADER_SIZE + free * SLOT.size, h, seg, off)
+        self.set_header(used=used, live=live + 1)
+
+    def entries(self, index=None):
+        """(hash, segment, offset) of every live key."""
+        index = self.index if index is None else index
+        return [(h, seg, off) for (h, seg, off) in (self.slot(i, index) for i in range(self.header(index).slots)) if seg]
+
+    def grow(self):
+        header = self.header()
+        slots = header.slots
+        while (header.live + 1) * 2 > slots:
+            slots *= 2
+        self.write_index(self.entries(), slots, header.active, header.end, header.compactions)
+
+    # public side
+
+    def find(self, key):
+        """(segment, offset) of the record of key or None, without locking."""
+        index = self.current()
+        (i, _) = self.probe(key, key_hash(key), index)
+        if i is None:
+            return None
+        (_, seg, off) = self.slot(i, index)
+        return (seg, off) if seg else None
+
+    def get(self, key):
+        """Value of key, a memoryview into the pack for uncompressed values, or None."""
+        key = key.encode()
+        found = self.find(key)
+        if found is None:
+            return None
+        record = self.read_record(*found)
+        if record is None or record[0] != PUT or record[2] != key:
+            return None
+        (_, codec, _, value) = record
+        return decompress(value, codec) if codec else value
+
+    def open(self, key):
+        """Extent of an uncompressed value, or None."""
+        found = self.find(key.encode())
+        if found is None:
+            return None
+        (seg, off) = found
+        record = self.read_record(seg, off)
+        if record is None or record[0] != PUT or record[1]:
+            return None
+        try:
+            return Extent(self.segment_path(seg), off + RECORD.size + len(record[2]), len(record[3]))
+        except FileNotFoundError:
+            # compacted away just now
+            return None
+
+    def __contains__(self, key):
+        return self.find(key.encode()) is not None
+
+    def append(self, record, key, kind):
+        # caller holds the lock
+        (active, end) = (self.header().active, self.header().end)
+        if end > len(SEGMENT_MAGIC) and end + len(record) > self.segment_bytes:
+            (active, end) = (active + 1, len(SEGMENT_MAGIC))
+        os.pwrite(self.segment_fd(active), record, end)
+        self.index_record(key, kind, active, end)
+        self.set_header(active=active, end=end + len(record))
+        return (active, end)
+
+    def put(self, key, value, codec=None, replace=True):
+        """Store value under key, compressed with codec ('zlib', 'lzma' or None).
+
+        With replace=False an existing value is kept, returns whether it wrote.
+        """
+        key = key.encode()
+        stored = compress(value, codec)
+        record = (RECORD.pack(PUT, CODECS[codec], len(key), len(stored), len(value), zlib.crc32(stored, zlib.crc32(key)))
+                  + key + stored)
+        with self.locked():
+            self.check_moved()
+            if not replace and self.find(key) is not None:
+                return False
+            self.append(record, key, PUT)
+        return True
+
+    def delete(self, key):
+        key = key.encode()
+        with self.locked():
+            self.check_moved()
+            if self.find(key) is None:
+                return False
+            self.append(RECORD.pack(DELETE, 0, len(key), 0, 0, zlib.crc32(key)) + key, key, DELETE)
+        return True
+
+    def keys(self, prefix=''):
+        prefix = prefix.encode()
+        for (_, seg, off) in self.entries(self.current()):
+            record = self.read_record(seg, off)
+            if record is not None and record[2].startswith(prefix):
+                yield record[2].decode()
+
+    def sync(self):
+        with self.locked():
+            if self.write_fd[1] is not None:
+                os.fsync(self.write_fd[1])
+            self.index.flush()
+
+    def compact(self, threshold=0.5):
+        """Rewrite segments with at least `threshold` of garbage, returns bytes freed."""
+        freed = 0
+        with self.locked():
+            self.check_moved()
+            live = set((seg, off) for (_, seg, off) in self.entries())
+            for seg in self.segments()[:-1]:
+                size = os.path.getsize(self.segment_path(seg))
+                oldest = seg == self.segments()[0]
+                kept = []
+                for (off, kind, key, record) in self.scan(seg):
+                    if (seg, off) in live:
+                        kept.append((key, kind, record))
+                    elif kind == DELETE and not oldest and self.find(key) is None:
+                        # still hides a put in an older segment
+                        kept.append((key, kind, record))
+                used = sum(len(record) for (_, _, record) in kept)
+                if size - len(SEGMENT_MAGIC) - used < threshold * (size - len(SEGMENT_MAGIC)):
+                    continue
+                for (key, kind, record) in kept:
+                    if kind == PUT:
+                        self.append(record, key, kind)
+                    else:
+                        # a delete of a missing key only needs to be on disk
+                        self.append_raw(record)
+                # the copies must be on disk before the originals go
+                self.sync()
+                self.drop_segment(seg)
+                os.unlink(self.segment_path(seg))
+                self.set_header(compactions=self.header().compactions + 1)
+                freed += size - used
+        return freed
+
+    def append_raw(self, record):
+        # caller holds the lock
+        (active, end) = (self.header().active, self.header().end)
+        if end > len(SEGMENT_MAGIC) and end + len(record) > self.segment_bytes:
+            (active, end) = (active + 1, len(SEGMENT_MAGIC))
+        os.pwrite(self.segment_fd(active), record, end)
+        self.set_header(active=active, end=end + len(record))
+
+    def stats(self):
+        header = self.header(self.current())
+        segments = self.segments()
+        return {
+            'keys': header.live,
+            'segments': len(segments),
+            'bytes': sum(os.path.getsize(self.segment_path(seg)) for seg in segments),
+            'index_slots': header.slots,
+            'index_used': header.used,
+            'compactions': header.compactions,
+        }
+
+
+def import_dirs(store, uploads_dir=None, dtbo_dir=None, fingerprint_dir=None, codec=None, progress=None):
+    """Copy the old uploads/, dtbo/ and dtbo-fingerprint/ files into a store.
+
+    uploads/<md5>-<filename> become 'dtb/<md5>', one per md5 whatever the
+    filenames were (those are in the event store); the others keep their
+    <version>/<name> path under 'dtbo/' or 'fingerprint/'. Keys already in
+    the store are skipped, so it can run again. Returns {prefix: added}.
+    """
+    added = {'dtb': 0, 'dtbo': 0, 'fingerprint': 0}
+    if uploads_dir and os.path.isdir(uploads_dir):
+        for name in sorted(os.listdir(uploads_dir)):
+            path = os.path.join(uploads_dir, name)
+            if len(name) < 33 or name[32] != '-' or not os.path.isfile(path):
+                continue
+            if 'dtb/' + name[:32] in store:
+                continue
+            with open(path, 'rb') as f:
+                added['dtb'] += store.put('dtb/' + name[:32], f.read(), codec, replace=False)
+    for (prefix, directory) in (('dtbo', dtbo_dir), ('fingerprint', fingerprint_dir)):
+        if not directory or not os.path.isdir(directory):
+            continue
+        for version in sorted(os.listdir(directory)):
+            if not os.path.isdir(os.path.join(directory, version)):
+                continue
+            for name in sorted(os.listdir(os.path.join(directory, version))):
+                path = os.path.join(directory, version, name)
+                if name.endswith('.tmp') or not os.path.isfile(path):
+                    continue
+                key = f'{prefix}/{version}/{name}'
+                if key in store:
+                    continue
+                with open(path, 'rb') as f:
+                    added[prefix] += store.put(key, f.read(), replace=False)
+        if progress:
+            progress(f"{prefix}: {added[prefix]}")
+    return added
+
+
+if __name__ == '__main__':
+    import argparse, json, logging, sys
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description="Maintain the pack store of the overlay server")
+    parser.add_argument('pack', help="pack directory, e.g. pack")
+    sub = parser.add_subparsers(dest='command', required=True)
+    p = sub.add_parser('import', help="import uploads/, dtbo/ and dtbo-fingerprint/")
+    p.add_argument('--uploads', default='uploads')
+    p.add_argument('--dtbo', default='dtbo')
+    p.add_argument('--fingerprints', default='dtbo-fingerprint')
+    p.add_argument('--compress', choices=['zlib', 'lzma'], help="compression for the uploaded dtbs")
+    p = sub.add_parser('compact', help="rewrite segments that are mostly garbage")
+    p.add_argument('--threshold', type=float, default=0.5, help="garbage share that makes a segment rewritten (default 0.5)")
+    sub.add_parser('rebuild', help="rebuild the index from the segments")
+    sub.add_parser('stats')
+    args = parser.parse_args()
+
+    store = PackStore(args.pack, logger=logging.getLogger('pack'))
+    if args.command == 'import':
+        added = import_dirs(store, args.uploads, args.dtbo, args.fingerprints, args.compress,
+                            progress=lambda line: print(line, file=sys.stderr))
+        store.sync()
+        print(json.dumps(added))
+    elif args.command == 'compact':
+        print(f"freed {store.compact(args.threshold)} bytes")
+    elif args.command == 'rebuild':
+        with store.locked():
+            store.rebuild()
+    print(json.dumps(store.stats()))
@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+
+# Serving overlay_server from several pre-forked processes
+
+import gc, logging, multiprocessing, os, random, select, signal, socket, subprocess, sys, threading, time
+
+from werkzeug.serving import BaseWSGIServer, WSGIRequestHandler
+
+# set across a reload, see Master.reload()
+LISTEN_FD_ENV = 'PREFORK_LISTEN_FD'
+OLD_WORKERS_ENV = 'PREFORK_OLD_WORKERS'
+
+logger = logging.getLogger('prefork')
+
+
+class Handler(WSGIRequestHandler):
+    # one request per connection, an idle keep-alive client never holds a thread
+    protocol_version = 'HTTP/1.0'
+    # seconds a client may take to send its request
+    timeout = 60
+
+
+class WorkerServer(BaseWSGIServer):
+    """The WSGI server of one worker process, on the listening socket shared
+    by all workers. Every connection gets a thread, at most `threads` at a
+    time. After `max_requests` connections (0 for no limit) or SIGTERM it
+    stops accepting and waits for the requests in progress.
+    """
+    multithread = True
+    multiprocess = True
+
+    def __init__(self, sock, app, threads, max_requests):
+        (host, port) = sock.getsockname()[:2]
+        super().__init__(host, port, app, handler=Handler, fd=sock.fileno())
+        # workers race for every connection, the losers must not block in accept()
+        self.socket.setblocking(False)
+        self.threads = threads
+        self.max_requests = max_requests
+        self.cond = threading.Condition()
+        self.active = 0
+        self.handled = 0
+        self.stopping = False
+
+    def get_request(self):
+        (conn, addr) = self.socket.accept()
+        conn.setblocking(True)
+        return (conn, addr)
+
+    def process_request(self, request, client_address):
+        with self.cond:
+            self.active += 1
+            self.handled += 1
+        threading.Thread(target=self.process_request_thread, args=(request, client_address), daemon=True).start()
+
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            with self.cond:
+                self.active -= 1
+                self.cond.notify_all()
+
+    def stop(self, *_):
+        self.stopping = True
+
+    def serve(self, graceful_timeout):
+        """Accept until stopped or recycled, returns whether all requests finished."""
+        while not self.stopping and not (self.max_requests and self.handled >= self.max_requests):
+            with self.cond:
+                if self.active >= self.threads:
+                    self.cond.wait(0.5)
+                    continue
+            if select.select([self.socket], [], [], 0.5)[0]:
+                self._handle_request_noblock()
+        self.socket.close()
+        with self.cond:
+            return self.cond.wait_for(lambda: self.active == 0, graceful_timeout)
+
+
+class Master:
+    """Forks `workers` processes serving the (already imported) app and
+    replaces the ones that exit. Workers call shutdown() before exiting.
+
+    Signals: TERM/INT stop the workers gracefully and exit. HUP reloads the
+    code: after the new code imported fine in a test process, the master
+    execs itself keeping the listening socket, starts new workers and only
+    then stops the old ones, which finish their requests first.
+    """
+    def __init__(self, app, shutdown, bind, workers, threads, max_requests, graceful_timeout):
+        self.app = app
+        self.shutdown = shutdown
+        self.bind = bind
+        self.nworkers = workers
+        self.threads = threads
+        self.max_requests = max_requests
+        self.graceful_timeout = graceful_timeout
+        self.workers = {}
+        self.old = set()
+        self.signals = []
+        self.stopping = False
+
+    def listen(self):
+        fd = os.environ.pop(LISTEN_FD_ENV, None)
+        if fd is not None:
+            sock = socket.socket(fileno=int(fd))
+        else:
+            (host, _, port) = self.bind.rpartition(':')
+            host = host.strip('[]') or '0.0.0.0'
+            family = socket.AF_INET6 if ':' in host else socket.AF_INET
+            sock = socket.create_server((host, int(port)), family=family, backlog=1024)
+        sock.set_inheritable(True)
+        return sock
+
+    def run(self):
+        self.sock = self.listen()
+        self.old = set(int(pid) for pid in os.environ.pop(OLD_WORKERS_ENV, '').split(',') if pid)
+        # everything imported so far is shared copy-on-write by the workers,
+        # frozen objects are not touched by the collector (and not copied)
+        gc.collect()
+        gc.freeze()
+        for sig in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP):
+            signal.signal(sig, lambda sig, _: self.signals.append(sig))
+        logger.info(f"listening on {self.sock.getsockname()}, {self.nworkers} workers with {self.threads} threads")
+
+        ready = [self.spawn() for _ in range(self.nworkers)]
+        if self.old:
+            self.wait_ready(ready)
+            logger.info(f"new workers ready, stopping old workers {sorted(self.old)}")
+            self.kill(self.old, signal.SIGTERM)
+        else:
+            for fd in ready:
+                os.close(fd)
+        while True:
+            while self.signals:
+                sig = self.signals.pop(0)
+                if sig == signal.SIGHUP:
+                    self.reload()
+                else:
+                    return self.stop()
+            self.reap()
+            time.sleep(0.2)
+
+    def spawn(self):
+        """Fork a worker, returns a pipe which becomes readable once it accepts."""
+        (r, w) = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                os.close(r)
+                self.worker(w)
+                code = 0
+            except BaseException:
+                logger.exception("worker failed")
+            finally:
+                os._exit(code)
+        os.close(w)
+        self.workers[pid] = time.monotonic()
+        return r
+
+    def worker(self, ready_fd):
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        server = WorkerServer(self.sock, self.app, self.threads,
+                              self.max_requests + random.randint(0, self.max_requests // 10))
+        signal.signal(signal.SIGTERM, server.stop)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        try:
+            os.write(ready_fd, b'1')
+        except BrokenPipeError:
+            # nobody is waiting for it
+            pass
+        os.close(ready_fd)
+        if not server.serve(self.graceful_timeout):
+            logger.warning("exiting with requests in progress")
+        self.shutdown()
+        for child in multiprocessing.active_children():
+            child.kill()
+            child.join()
+
+    def wait_ready(self, fds, timeout=60):
+        deadline = time.monotonic() + timeout
+        while fds and time.monotonic() < deadline:
+            for fd in select.select(fds, [], [], max(0, deadline - time.monotonic()))[0]:
+                # one byte when ready, nothing if it died before
+                os.read(fd, 1)
+                os.close(fd)
+                fds.remove(fd)
+        for fd in fds:
+            os.close(fd)
+
+    def reap(self):
+        while True:
+            try:
+                (pid, status) = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            code = os.waitstatus_to_exitcode(status)
+            if pid in self.old:
+                self.old.discard(pid)
+                logger.info(f"old worker {pid} exited ({code})")
+                continue
+            started = self.workers.pop(pid, None)
+            if started is None or self.stopping:
+                continue
+            logger.info(f"worker {pid} exited ({code}), starting another")
+            if time.monotonic() - started < 1:
+                # do not spin if workers die right away
+                time.sleep(1)
+            os.close(self.spawn())
+
+    def kill(self, pids, sig):
+        for pid in pids:
+            try:
+                os.kill(pid, sig)
+            except ProcessLookupError:
+                pass
+
+    def stop(self):
+        logger.info("stopping workers")
+        self.stopping = True
+        self.kill(list(self.workers) + list(self.old), signal.SIGTERM)
+        deadline = time.monotonic() + self.graceful_timeout + 5
+        while (self.workers or self.old) and time.monotonic() < deadline:
+            try:
+                (pid, _) = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if pid == 0:
+                time.sleep(0.1)
+                continue
+            self.workers.pop(pid, None)
+            self.old.discard(pid)
+        self.kill(list(self.workers) + list(self.old), signal.SIGKILL)
+        self.sock.close()
+
+    def reload(self):
+        # a broken generator must not take the running server down
+        check = subprocess.run([sys.executable, '-c', 'import overlay_server'],
+                               capture_output=True, text=True, timeout=120)
+        if check.returncode != 0:
+            logger.error(f"not reloading, overlay_server does not import:\n{check.stderr}")
+            return
+        logger.info("reloading")
+        os.environ[LISTEN_FD_ENV] = str(self.sock.fileno())
+        os.environ[OLD_WORKERS_ENV] = ','.join(str(pid) for pid in list(self.workers) + list(self.old))
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os.execv(sys.executable, [sys.executable, os.path.abspath(sys.argv[0])] + sys.argv[1:])
+
+
+if __name__ == '__main__':
+    import argparse
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s [%(process)d] %(name)s: %(message)s')
+
+    parser = argparse.ArgumentParser(description="Run overlay_server with pre-forked worker processes")
+    parser.add_argument('--bind', help="host:port (default SERVER_BIND of the config)")
+    parser.add_argument('--workers', type=int, help="worker processes (default SERVER_WORKERS)")
+    parser.add_argument('--threads', type=int, help="requests at a time per worker (default SERVER_THREADS)")
+    parser.add_argument('--max-requests', type=int, help="recycle a worker after about this many requests (default SERVER_MAX_REQUESTS)")
+    args = parser.parse_args()
+
+    # fdt, rocknix_dtbo, static assets and config are loaded once, here
+    import overlay_server
+    config = overlay_server.app.config
+    master = Master(overlay_server.app, overlay_server.shutdown,
+                    args.bind or config['SERVER_BIND'],
+                    args.workers or config['SERVER_WORKERS'],
+                    args.threads or config['SERVER_THREADS'],
+                    config['SERVER_MAX_REQUESTS'] if args.max_requests is None else args.max_requests,
+                    config['SERVER_GRACEFUL_TIMEOUT'])
+    master.run()
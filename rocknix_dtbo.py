@@ -3,10 +3,30 @@
 # https://pypi.org/project/fdt/
 # pip install fdt
 
-import os, sys
-import fdt
+import os, sys, time, hashlib
 import math
-
+import fdt_reader
+import init_sequence
+from overlay_writer import OverlayWriter
+
+# Generator version, bump on every change that affects produced overlays.
+# Cached overlays made by another version are regenerated on next request.
+VERSION = '2025-06-21'
+
+# Flags make_dtbo() knows about, anything else in args['flags'] is ignored
+FLAGS = ('LSi', 'RSi', 'HPi', 'Dno', 'JPk36', 'JPmm', 'DR90', 'DR180', 'DR270')
+
+# Guarded mode limits (args['limits']), far above anything seen in stock dtbs:
+# about 1500 nodes, 6 levels deep, 8000 properties, 1-3 timings, 300 commands.
+# ops counts mode solver steps, a 720x720 panel needs about 85000 (per Dno).
+LIMITS = {
+    'nodes': 20000,
+    'depth': 64,
+    'props': 100000,
+    'timings': 64,
+    'iseq_cmds': 4096,
+    'ops': 2000000,
+}
 
 
 def prop_default(panel, prop, default):
@@ -15,10 +35,124 @@ def prop_default(panel, prop, default):
     except:
         return default
 
+class ConversionError(Exception):
+    """The stock dtb can not be converted.
+
+    code is a stable reason for machines: bad_dtb, no_symbols, no_dsi,
+    no_panel, bad_panel, bad_init_sequence, no_reset_gpio, no_compatible
+    or internal.
+    """
+    def __init__(self, code, message):
+        super().__init__(message)
+        self.code = code
+
+    def __reduce__(self):
+        # survives the trip back from a worker process
+        return (ConversionError, (self.code, str(self)))
+
+class LimitExceeded(ConversionError):
+    """The stock dtb is over one of the guarded mode limits."""
+    def __init__(self, message):
+        super().__init__('limit_exceeded', message)
+
+    def __reduce__(self):
+        return (LimitExceeded, (str(self),))
+
+class Budget:
+    """Operations left for one conversion, see LIMITS['ops']."""
+    def __init__(self, ops):
+        self.left = ops
+
+def stage_done(args, name, t0):
+    """Add time since t0 to args['stages'][name] (if collecting), return now.
+
+    Stages: parse, panel, modes, gpio, fingerprint, assemble, serialize.
+    """
+    now = time.perf_counter()
+    stages = args.get('stages')
+    if stages is not None:
+        stages[name] = stages.get(name, 0) + now - t0
+    return now
+
 def absfrac(x):
     return abs(x - round(x))
 
-def panel_to_desc(panel, args):
+def solve_mode(targetfps, clock, maxclock, htotal, vtotal, maxvtotal, budget=None):
+    """Find the best (deviation, clock, vtotal) for targetfps, or None.
+
+    Same result as trying every 10kHz clock step in [clock, maxclock) for every
+    vtotal in [vtotal, maxvtotal] and keeping the one whose htotal is closest to
+    an integer in [htotal, htotal*1.05), but instead of walking the clock range
+    it jumps straight to the clock step nearest to each integer htotal.
+    Every step is charged to budget, LimitExceeded is raised when it runs out.
+    """
+    def fits(c, vt):
+        h = c*1000/targetfps/vt
+        return (h >= htotal) and (h < htotal*1.05)
+
+    lastj = (maxclock - clock - 1)//10
+    # (approximate deviation, clock step, vtotal) worth an exact look
+    shortlist = []
+    bestdev = math.inf
+    left = budget.left if budget else math.inf
+    # a vtotal step costs about as much as ten clock or htotal steps
+    left -= 10*(maxvtotal - vtotal + 1)
+    if left < 0:
+        raise LimitExceeded("mode search over the operation budget")
+    for vt in range(vtotal, maxvtotal+1):
+        # clock + 10*j gives htotal j/q + c0/q
+        q = targetfps*vt/10000
+        c0 = clock/10
+        # first and last clock steps satisfying the htotal window
+        ja = max(0, math.floor(htotal*q - c0) - 1)
+        jb = min(lastj, math.ceil(htotal*1.05*q - c0) + 1)
+        while ja <= jb and not fits(clock + 10*ja, vt):
+            ja += 1
+        while jb >= ja and not fits(clock + 10*jb, vt):
+            jb -= 1
+        if ja > jb:
+            continue
+
+        hlo = round((ja + c0)/q)
+        hhi = round((jb + c0)/q)
+        left -= min(jb - ja, hhi - hlo) + 1
+        if left < 0:
+            raise LimitExceeded("mode search over the operation budget")
+        if jb - ja <= hhi - hlo:
+            # fewer clock steps than integer htotals, just take them all
+            for j in range(ja, jb+1):
+                c = clock + 10*j
+                dev = absfrac(c*1000/targetfps/vt)
+                if dev <= bestdev + 1e-6:
+                    shortlist.append((dev, j, vt))
+                    bestdev = min(bestdev, dev)
+            continue
+        for h in range(hlo, hhi+1):
+            jstar = h*q - c0
+            j = min(max(round(jstar), ja), jb)
+            dev = abs(jstar - j)/q
+            if dev <= bestdev + 1e-6:
+                shortlist.append((dev, j, vt))
+                bestdev = min(bestdev, dev)
+
+    best = None
+    for (dev, j0, vt) in shortlist:
+        if dev > bestdev + 1e-6:
+            continue
+        for j in (j0 - 1, j0, j0 + 1):
+            c = clock + 10*j
+            if (j < 0) or (j > lastj) or not fits(c, vt):
+                continue
+            option = (absfrac(c*1000/targetfps/vt), c, vt)
+            if best is None or option < best:
+                best = option
+    if budget:
+        budget.left = left
+    return best
+
+def panel_to_desc(panel, args, budget=None):
+    t = time.perf_counter()
+    limits = args.get('limits') or {}
     if 'name' in args:
         g_name = args['name'] + ' '
     else:
@@ -46,6 +180,8 @@ def panel_to_desc(panel, args):
 
 
     timings = panel.get_subnode("display-timings")
+    if len(timings.nodes) > limits.get('timings', math.inf):
+        raise LimitExceeded(f"more than {limits['timings']} display timings")
     if 'Dno' in args['flags']:
         # Skip original mode (it may be broken)
         native = None
@@ -119,6 +255,7 @@ def panel_to_desc(panel, args):
         def_fps = orig_def_fps
     common_fpss = [50/1.001, 50, 50.0070, 57.5, 59.7275, 60/1.001, 60, 60.0988, 75.47, 90, 120];
     common_fpss = [ fps for fps in common_fpss if fps != orig_def_fps]
+    t = stage_done(args, 'panel', t)
     for targetfps in [orig_def_fps] + common_fpss:
         if not targetfps:
             continue
@@ -149,16 +286,12 @@ def panel_to_desc(panel, args):
             clock = math.ceil(perfectclock/10)*10
 
         maxvtotal = round(vtotal*1.25)
-        # A little bruteforce to find a best totals for target fps
-        # TODO: maybe iterate over some clock values too
-        options = [(absfrac(c*1000/targetfps/vt), c, vt)
-                for vt in range(vtotal, maxvtotal+1)
-                for c in range(clock, round(1.25*perfectclock), 10)
-                if ((c*1000/targetfps/vt) >= htotal) and ((c*1000/targetfps/vt) < htotal*1.05) ]
-        if options == []:
+        # Find best totals for target fps, trying clocks up to 25% over the perfect one
+        best = solve_mode(targetfps, clock, round(1.25*perfectclock), htotal, vtotal, maxvtotal, budget)
+        if best is None:
             acc += [f"# failed to find mode for fps={targetfps:.6f} c={clock} h={htotal} v={vtotal}"]
             continue
-        (mindev, newclock, newvtotal) = min(options)
+        (mindev, newclock, newvtotal) = best
         # construct a new mode with chosen vtotal
         newhtotal = round(newclock*1000/targetfps/newvtotal)
         addhtotal = newhtotal - htotal
@@ -173,83 +306,78 @@ def panel_to_desc(panel, args):
         acc += [f"M clock={newclock} horizontal={hor_str} vertical={ver_str}{maybe_default}{maybe_comment}"]
 
     acc += [""]
-
-    iseq0 = panel.get_property("panel-init-sequence")
-    if (hasattr(iseq0, 'value')) and (isinstance(iseq0.value, (int))):
-        iseq = b''.join(map(lambda w : w.to_bytes(4, "big"), list(iseq0)))
-    else:
-        iseq = bytearray(iseq0)
-
-    while iseq:
-        cmd = iseq[0]
-        wait = iseq[1]
-        datalen = iseq[2]
-        iseq = iseq[3:]
-
-        data = iseq[0:datalen]
-        iseq = iseq[datalen:]
-
+    t = stage_done(args, 'modes', t)
+
+    # decoded in place, the blob is not copied even when pyfdt would see u32 cells
+    iseq = init_sequence.property_bytes(panel)
+    max_cmds = limits.get('iseq_cmds', math.inf)
+    for (cmd, wait, data) in init_sequence.decode(iseq):
+        max_cmds -= 1
+        if max_cmds < 0:
+            raise LimitExceeded(f"more than {limits['iseq_cmds']} init sequence commands")
         maybe_wait = f" wait={wait}" if (wait) else ""
         maybe_comment = f" # orig_cmd=0x{cmd:x}" if comment else ""
         acc += [f"I seq={data.hex()}{maybe_wait}{maybe_comment}"]
 
+    stage_done(args, 'panel', t)
     return acc
 
-def node_by_phandle(dt, phandle):
-    nodes = [p.parent
-             for p in dt.search('phandle', fdt.ItemType.PROP_WORDS)
-             if p.value == phandle]
-    return nodes[0]
-
-def resolve_phandle(dt, phandle):
-    p = node_by_phandle(dt, phandle)
+class DtbIndex:
+    """Lookup tables for a parsed (fdt_reader.LazyFdt) stock tree.
+
+    phandles maps phandle -> node, symbols maps node path -> __symbols__ name
+    and labels maps __symbols__ name -> node path.
+    """
+    def __init__(self, dt):
+        self.dt = dt
+        # phandles were already collected while scanning the blob
+        self.phandles = dt.phandles()
+        self.symbols = {}
+        self.labels = {}
+        if dt.exist_node('__symbols__'):
+            for p in dt.get_node('__symbols__').props:
+                self.labels.setdefault(p.name, p.value)
+                self.symbols.setdefault(p.value, p.name)
+
+def node_by_phandle(idx, phandle):
+    return idx.phandles[phandle]
+
+def resolve_phandle(idx, phandle):
+    p = node_by_phandle(idx, phandle)
     return os.path.join(p.path, p.name)
 
+def symbol_by_phandle(idx, phandle):
+    # e.g. <0x6f> -> '/pinctrl/gpio2@ff260000' -> 'gpio2'
+    return idx.symbols[resolve_phandle(idx, phandle)]
+
 def add_overlay(overlay, path):
-    for f in range(100):
-        nodename = 'fragment@' + str(f)
-        if overlay.exist_node(nodename):
-            pass
-        else:
-            fragnode = fdt.Node(nodename)
-            if path[0] == '&':
-                fragnode.set_property('target', 0xffffffff)
-                overlay.set_property(path[1:], '/'+nodename+':target:0', path='/__fixups__')
-            else:
-                fragnode.set_property('target-path', path)
-            overlay.add_item(fragnode)
-            ovlnode = fdt.Node('__overlay__')
-            fragnode.append(ovlnode)
-            return ovlnode
+    return overlay.add_fragment(path)
 
 def add_fixup(overlay, label, fixup_path):
-    if overlay.exist_node('__fixups__'):
-        fixups = overlay.get_node('__fixups__')
-    else:
-        fixups = fdt.Node('__fixups__')
-        overlay.add_item(fixups)
-    prev_paths = fixups.get_property(label)
-    if prev_paths:
-        fixups.set_property(label, prev_paths.data + [fixup_path])
-    else:
-        fixups.set_property(label, [fixup_path])
+    overlay.add_fixup(label, fixup_path)
 
 def add_local_fixup(overlay, parent_path, name):
-    overlay.set_property(name, 0, path='__local_fixups__'+parent_path)
-
-def add_gpio_vol_keys(dt, overlay, gpio_keys_ovl):
-    symbols = dt.get_node('__symbols__')
+    overlay.add_local_fixup(parent_path, name)
 
+def find_gpio_vol_keys(idx):
+    dt = idx.dt
     keydata = dt.get_node('/play_joystick').get_property('key-gpios').data
     pindata = dt.get_node('/pinctrl/buttons/gpio-key-pin').get_property('rockchip,pins').data
     # extract volume keys from array
-    vol_up = keydata[14*3:15*3]
-    vol_up_pin = pindata[14*4:15*4]
-    vol_dn = keydata[15*3:16*3]
-    vol_dn_pin = pindata[15*4:16*4]
-
-    gpio_path = resolve_phandle(dt, vol_up[0])
-    gpio_sym = [p.name for p in symbols.props if p.value == gpio_path][0]
+    return {
+        'vol_up': keydata[14*3:15*3],
+        'vol_up_pin': pindata[14*4:15*4],
+        'vol_dn': keydata[15*3:16*3],
+        'vol_dn_pin': pindata[15*4:16*4],
+        'gpio_sym': symbol_by_phandle(idx, keydata[14*3]),
+    }
+
+def add_gpio_vol_keys(overlay, gpio_keys_ovl, keys):
+    vol_up = keys['vol_up']
+    vol_up_pin = keys['vol_up_pin']
+    vol_dn = keys['vol_dn']
+    vol_dn_pin = keys['vol_dn_pin']
+    gpio_sym = keys['gpio_sym']
     gpio_phandle = 0xffffffff
 
     pins_path = gpio_keys_ovl.path+'/__overlay__/pinctrl/btns/btn-pins-vol-overlay'
@@ -303,26 +431,171 @@ def switch_joypad_to_mymini(overlay, jp_ovl):
     jp_ovl.set_property('poll-interval', 10)
 
 
-def make_dtbo(dtb_data, args):
-    dt = fdt.parse_dtb(dtb_data)
-    symbols = dt.get_node('__symbols__')
+def analyze_dtb(dtb_data, args):
+    """Parse a stock dtb and collect everything overlays need from it.
+
+    The result does not depend on flags (except for the panel description,
+    which is built lazily per Dno) and can be fed to emit_dtbo() many times.
+    """
+    stock = inspect_dtb(dtb_data, args)
+    describe_panel(stock, args)
+    return stock
 
-    dsipath = symbols.get_property('dsi').value
+def inspect_dtb(dtb_data, args):
+    """analyze_dtb() without the panel description, enough for fingerprint()."""
+    # only a small part of the stock tree is ever looked at, so read it lazily
+    t = time.perf_counter()
+    limits = args.get('limits')
+    try:
+        dt = fdt_reader.parse_dtb(dtb_data, limits)
+        idx = DtbIndex(dt)
+    except fdt_reader.LimitError as e:
+        raise LimitExceeded(str(e))
+    except Exception as e:
+        raise ConversionError('bad_dtb', f"can not parse the dtb: {e}")
+    stock = {'dt': dt, 'idx': idx, 'pdesc': {}, 'budget': Budget(limits['ops']) if limits else None}
+    stage_done(args, 'parse', t)
+
+    if not idx.labels:
+        raise ConversionError('no_symbols', "no __symbols__, the dtb was not built with -@")
+    if 'dsi' not in idx.labels:
+        raise ConversionError('no_dsi', "no dsi symbol, not a rockchip mipi panel device?")
+    dsipath = idx.labels['dsi']
     # panelpath is /dsi@ff450000/panel@0 on rk3326 and /dsi@fe060000/panel@0 on rk3566
-    panelpath = dsipath + '/panel@0'
-    panel = dt.get_node(panelpath)
-    pdesc = panel_to_desc(panel, args)
+    stock['panelpath'] = dsipath + '/panel@0'
+    if not dt.exist_node(stock['panelpath']):
+        raise ConversionError('no_panel', f"no {stock['panelpath']} node")
+    stock['panel'] = dt.get_node(stock['panelpath'])
+    t = time.perf_counter()
+
+    panel = stock['panel']
+    try:
+        stock['rst_gpio'] = panel.get_property('reset-gpios').data
+        stock['rst_sym'] = symbol_by_phandle(idx, stock['rst_gpio'][0])
+    except Exception as e:
+        raise ConversionError('no_reset_gpio', f"can not resolve the panel reset-gpios: {type(e).__name__}: {e}")
+
+    try:
+        stock['compat'] = dt.get_node('/').get_property('compatible').data[0]
+    except Exception:
+        raise ConversionError('no_compatible', "no root compatible")
+    if 'odroidgo3' in stock['compat']:
+        # well supported R36s only needs the panel
+        stage_done(args, 'gpio', t)
+        return stock
 
-    # remove empty lines as pyfdt does not like them
-    pdesc = [ l for l in pdesc if l != '']
+    # power supply gpio fetch (some trees do not have power-supply prop)
+    try:
+        panel_ps = node_by_phandle(idx, panel.get_property('power-supply').value)
+        panel_ps_gpio = panel_ps.get_property('gpio').data
+        stock['ps_sym'] = symbol_by_phandle(idx, panel_ps_gpio[0])
+        stock['ps_num'] = int(stock['ps_sym'][4:])
+        stock['ps_gpio'] = panel_ps_gpio
+    except:
+        stock['ps_gpio'] = None
+    # some devices (e.g. R36s clone) have enable-gpios defined
+    try:
+        panel_en_gpio = panel.get_property('enable-gpios').data
+        stock['en_sym'] = symbol_by_phandle(idx, panel_en_gpio[0])
+        stock['en_gpio'] = panel_en_gpio
+    except:
+        stock['en_gpio'] = None
 
-    panel_rst_gpio = panel.get_property('reset-gpios').data
-    gpio_sym = [p.name for p in symbols.props if p.value == resolve_phandle(dt, panel_rst_gpio[0])][0]
+    # If stock DTB does not have ADC keys, disable adc-keys in overlay
+    need_adckeys_disable = False
+    if not dt.exist_node('/adc-keys'):
+        need_adckeys_disable = True
+    else:
+        adckeys_orig = dt.get_node('/adc-keys')
+        adckeys_status = adckeys_orig.get_property('status')
+        if (adckeys_status) and (adckeys_status.value == 'disabled'):
+            need_adckeys_disable = True
+        else:
+            # usually we just don't have status property, so consider this valid
+            need_adckeys_disable = False
+    stock['need_adckeys_disable'] = need_adckeys_disable
+    stock['vol_keys'] = None
+    if need_adckeys_disable and dt.exist_node('/play_joystick'):
+        stock['vol_keys'] = find_gpio_vol_keys(idx)
+
+    try:
+        snd = dt.get_node('/rk817-sound')
+        # fetch raw   hp-det-gpio = <0x6f 0x16 0x00>;
+        hpdet = snd.get_property('hp-det-gpio').data
+        hp_det = dt.get_node('/pinctrl/headphone/hp-det')
+        hp_det_pins = hp_det.get_property('rockchip,pins')
+        hp_det_pull_node = node_by_phandle(idx, hp_det_pins[3])
+        # resolve <0x6f> into '/pinctrl/gpio2@ff260000' and find its symbol 'gpio2'
+        stock['hpdet'] = {
+            'gpio': list(hpdet),
+            'sym': symbol_by_phandle(idx, hpdet[0]),
+            'pins': hp_det_pins[0:3],
+            'pull_down': hp_det_pull_node.exist_property('bias-pull-down'),
+        }
+    except Exception as e:
+        stock['hpdet'] = None
+        stock['hpdet_error'] = e
+
+    stage_done(args, 'gpio', t)
+    return stock
+
+def describe_panel(stock, args):
+    try:
+        return panel_description(stock, args)
+    except ConversionError:
+        raise
+    except init_sequence.InitSequenceError as e:
+        raise ConversionError('bad_init_sequence', f"can not decode the panel-init-sequence: {e}")
+    except Exception as e:
+        raise ConversionError('bad_panel', f"can not describe the panel: {type(e).__name__}: {e}")
+
+def node_digest(h, node):
+    # names, property types and values of a whole subtree, in blob order
+    h.update(repr(node.name).encode())
+    for p in node.props:
+        h.update(repr((p.name, type(p).__name__, getattr(p, 'data', None))).encode())
+    for n in node.nodes:
+        node_digest(h, n)
+    h.update(b'}')
+
+def fingerprint(stock, args):
+    """Hash of exactly the parts of the stock dtb emit_dtbo() uses.
+
+    Uploads that differ elsewhere (memory nodes, serial numbers, bootargs)
+    get the same fingerprint and the same overlays.
+    """
+    t = time.perf_counter()
+    h = hashlib.blake2b(digest_size=16)
+    h.update(repr((VERSION, stock['compat'], stock['panelpath'])).encode())
+    node_digest(h, stock['panel'])
+    # resolved gpio symbols, adc-keys status, volume keys and hp-det;
+    # missing on odroidgo3 where only the panel is used
+    for key in ('rst_gpio', 'rst_sym', 'ps_gpio', 'ps_sym', 'en_gpio', 'en_sym',
+                'need_adckeys_disable', 'vol_keys', 'hpdet'):
+        h.update(repr((key, stock.get(key))).encode())
+    stage_done(args, 'fingerprint', t)
+    return h.hexdigest()
+
+def panel_description(stock, args):
+    # only Dno changes the panel description
+    dno = 'Dno' in args['flags']
+    if dno not in stock['pdesc']:
+        pdesc = panel_to_desc(stock['panel'], args, stock['budget'])
+        # remove empty lines as pyfdt does not like them
+        stock['pdesc'][dno] = [ l for l in pdesc if l != '']
+    return stock['pdesc'][dno]
+
+def emit_dtbo(stock, args):
+    """Build an overlay for args['flags'] from analyze_dtb() results."""
+    pdesc = describe_panel(stock, args)
+    t = time.perf_counter()
+    panelpath = stock['panelpath']
+    panel_rst_gpio = stock['rst_gpio']
+    gpio_sym = stock['rst_sym']
     gpio_num = int(gpio_sym[4:])
 
     # create an overlay tree
-    overlay = fdt.FDT()
-    overlay.header.version = 17
+    overlay = OverlayWriter()
 
     panel_ovl = add_overlay(overlay, '/')
     panel_ovl_path = panel_ovl.path+'/__overlay__'+panelpath
@@ -335,11 +608,11 @@ def make_dtbo(dtb_data, args):
     elif 'DR270' in args['flags']:
         overlay.set_property('rotation', 270, path=panel_ovl_path)
 
-    compat = dt.get_node('/').get_property('compatible').data[0]
+    compat = stock['compat']
     args['logger'].info(f"compatible {compat}")
     if 'odroidgo3' in compat:
         # quick return for well supported R36s
-        return overlay.to_dtb()
+        return serialize(overlay, args, t)
 
     # copy reset config
     pins_path = panel_ovl.path+'/__overlay__/pinctrl/gpio-lcd/lcd-rst'
@@ -347,12 +620,10 @@ def make_dtbo(dtb_data, args):
     add_fixup(overlay, gpio_sym, panel_ovl_path+':reset-gpios:0')
     overlay.set_property('rockchip,pins', [gpio_num, panel_rst_gpio[1], 0, 0xffffffff], path=pins_path)
     add_fixup(overlay, 'pcfg_pull_none', pins_path+':rockchip,pins:12')
-    # power supply gpio fetch (some trees do not have power-supply prop)
-    try:
-        panel_ps = dt.get_node(resolve_phandle(dt, panel.get_property('power-supply').value))
-        panel_ps_gpio = panel_ps.get_property('gpio').data
-        gpio_sym = [p.name for p in symbols.props if p.value == resolve_phandle(dt, panel_ps_gpio[0])][0]
-        gpio_num = int(gpio_sym[4:])
+    panel_ps_gpio = stock['ps_gpio']
+    if panel_ps_gpio:
+        gpio_sym = stock['ps_sym']
+        gpio_num = stock['ps_num']
         # power supply reg
         panel_reg_path = panel_ovl.path+'/__overlay__/vcc18-lcd0'
         overlay.set_property('gpio', [0xffffffff, panel_ps_gpio[1], panel_ps_gpio[2]], path=panel_reg_path)
@@ -361,38 +632,22 @@ def make_dtbo(dtb_data, args):
         panel_ps_pin_path = panel_ovl.path+'/__overlay__/pinctrl/vcc18-lcd/vcc18-lcd-n'
         overlay.set_property('rockchip,pins', [gpio_num, panel_ps_gpio[1], 0, 0xffffffff], path=panel_ps_pin_path)
         add_fixup(overlay, 'pcfg_pull_none', panel_ps_pin_path+':rockchip,pins:12')
-    except:
-        pass
-    # some devices (e.g. R36s clone) have enable-gpios defined
-    try:
-        panel_en_gpio = panel.get_property('enable-gpios').data
-        gpio_sym = [p.name for p in symbols.props if p.value == resolve_phandle(dt, panel_en_gpio[0])][0]
+    panel_en_gpio = stock['en_gpio']
+    if panel_en_gpio:
+        gpio_sym = stock['en_sym']
         overlay.set_property('enable-gpios', [0xffffffff, panel_en_gpio[1], panel_en_gpio[2]], path=panel_ovl_path)
         add_fixup(overlay, gpio_sym, panel_ovl_path+':enable-gpios:0')
-    except:
-        pass
 
 
-    # If stock DTB does not have ADC keys, disable adc-keys in overlay
-    need_adckeys_disable = False
-    if not dt.exist_node('/adc-keys'):
-        need_adckeys_disable = True
-    else:
-        adckeys_orig = dt.get_node('/adc-keys')
-        adckeys_status = adckeys_orig.get_property('status')
-        if (adckeys_status) and (adckeys_status.value == 'disabled'):
-            need_adckeys_disable = True
-        else:
-            # usually we just don't have status property, so consider this valid
-            need_adckeys_disable = False
+    need_adckeys_disable = stock['need_adckeys_disable']
     if need_adckeys_disable:
         noadck_ovl = add_overlay(overlay, '/')
         overlay.set_property('dtbo_comment', 'deliberately-disabled-adc-keys', path=noadck_ovl.path+'/__overlay__/adc-keys')
         overlay.set_property('status', 'disabled', path=noadck_ovl.path+'/__overlay__/adc-keys')
         args['logger'].info(f"disabled adc-keys")
-        # TODO: extract GPIO keys from play_joystick.key-gpios[14..15]
-        if dt.exist_node('/play_joystick'):
-            add_gpio_vol_keys(dt, overlay, noadck_ovl)
+        # volume keys are taken from play_joystick.key-gpios[14..15]
+        if stock['vol_keys']:
+            add_gpio_vol_keys(overlay, noadck_ovl, stock['vol_keys'])
     else:
         adck_ovl = add_overlay(overlay, '/')
         overlay.set_property('status', 'okay', path=adck_ovl.path+'/__overlay__/adc-keys')
@@ -423,53 +678,165 @@ def make_dtbo(dtb_data, args):
         args['logger'].info(f"invert right stick on {jp_ovl.path}")
 
 
-    try:
-        snd = dt.get_node('/rk817-sound')
-        # fetch raw   hp-det-gpio = <0x6f 0x16 0x00>;
-        hpdet = snd.get_property('hp-det-gpio').data
-        hp_det = dt.get_node('/pinctrl/headphone/hp-det')
+    hpdet_stock = stock['hpdet']
+    if hpdet_stock:
+        hpdet = hpdet_stock['gpio'].copy()
         # for some reason hp detection polarity needs to be inverted on some devices
         if 'HPi' in args['flags']:
             if hpdet[2] == 0:
                 hpdet[2] = 1
             else:
                 hpdet[2] = 0
-        hp_det_pins = hp_det.get_property('rockchip,pins')
-        hp_det_pull_node = node_by_phandle(dt, hp_det_pins[3])
-        # resolve <0x6f> into '/pinctrl/gpio2@ff260000'
-        hpdet_gpio_path = resolve_phandle(dt, hpdet[0])
-        # find symbol 'gpio2' for path '/pinctrl/gpio2@ff260000'
-        gpiosyms = [p.name for p in symbols.props if p.value == hpdet_gpio_path]
-        # on success, add overlay
-        gpio_sym = gpiosyms[0]
+        gpio_sym = hpdet_stock['sym']
         hpdet_ovl = add_overlay(overlay, '/')
         rk817_path = hpdet_ovl.path+'/__overlay__/rk817-sound'
         overlay.set_property('simple-audio-card,hp-det-gpio', [0xffffffff, hpdet[1], hpdet[2]], path=rk817_path)
         add_fixup(overlay, gpio_sym, rk817_path+':simple-audio-card,hp-det-gpio:0')
         pins_path = hpdet_ovl.path+'/__overlay__/pinctrl/headphone/hp-det'
-        overlay.set_property('rockchip,pins', hp_det_pins[0:3] + [0xffffffff], path=pins_path)
+        overlay.set_property('rockchip,pins', hpdet_stock['pins'] + [0xffffffff], path=pins_path)
         # Restore bias reference
-        if hp_det_pull_node.exist_property('bias-pull-down'):
+        if hpdet_stock['pull_down']:
             add_fixup(overlay, 'pcfg_pull_down', pins_path+':rockchip,pins:12')
         else:
             add_fixup(overlay, 'pcfg_pull_up', pins_path+':rockchip,pins:12')
-        args['logger'].info(f"hp-det-gpio {gpiosyms[0]} on {hpdet_ovl.path}")
-    except Exception as e:
-        args['logger'].info(e)
+        args['logger'].info(f"hp-det-gpio {gpio_sym} on {hpdet_ovl.path}")
+    else:
+        args['logger'].info(stock['hpdet_error'])
+
+    # send the overlay to output, fixups go to the very end
+    return serialize(overlay, args, t)
+
+def serialize(overlay, args, t):
+    t = stage_done(args, 'assemble', t)
+    dtbo = overlay.to_dtb()
+    stage_done(args, 'serialize', t)
+    return dtbo
+
+def make_dtbo(dtb_data, args):
+    return emit_dtbo(analyze_dtb(dtb_data, args), args)
 
-    # Move fixups to the very end (if any)
-    if overlay.exist_node('__fixups__'):
-        fixups = overlay.get_node('__fixups__')
-        overlay.remove_node('__fixups__')
-        overlay.add_item(fixups)
+def make_dtbos(dtb_data, flagsets, args):
+    """Make overlays for several flag sets, parsing and analysing the stock dtb once.
 
-    if overlay.exist_node('__local_fixups__'):
-        fixups = overlay.get_node('__local_fixups__')
-        overlay.remove_node('__local_fixups__')
-        overlay.add_item(fixups)
+    Returns an overlay or the ConversionError per flag set, a panel that can
+    not be described with one flag set may still work with another (Dno).
+    Errors of the stock dtb itself are raised.
+    """
+    stock = inspect_dtb(dtb_data, dict(args, flags=flagsets[0] if flagsets else []))
+    return [try_emit_dtbo(stock, dict(args, flags=flags)) for flags in flagsets]
 
-    # send the overlay to output
-    return overlay.to_dtb()
+def try_emit_dtbo(stock, args):
+    try:
+        return emit_dtbo(stock, args)
+    except ConversionError as e:
+        return e
+
+
+
+# Batch conversion, e.g. to regenerate overlays for all uploads after a fix
+
+def batch_name(md5, flags):
+    return md5 + ''.join('-' + f for f in flags)
+
+def batch_inputs(paths):
+    """Expand directories (recursively) and glob patterns into a sorted file list."""
+    import glob
+    files = set()
+    for path in paths:
+        if os.path.isdir(path):
+            for (dirpath, _, filenames) in os.walk(path):
+                files.update(os.path.join(dirpath, name) for name in filenames)
+        else:
+            files.update(p for p in glob.glob(path) if os.path.isfile(p))
+    return sorted(files)
+
+def batch_job(task):
+    """Convert one input for all flag sets missing in the manifest, in a pool worker."""
+    import logging
+    (path, md5, flagsets, outdir) = task
+    entries = {}
+    t0 = time.perf_counter()
+    try:
+        with open(path, 'rb') as f:
+            content = f.read()
+        dtbos = make_dtbos(content, flagsets, {'logger': logging.getLogger('dtbo'), 'limits': LIMITS})
+    except Exception as e:
+        dtbos = [e] * len(flagsets)
+    seconds = (time.perf_counter() - t0) / max(len(flagsets), 1)
+    for (flags, dtbo) in zip(flagsets, dtbos):
+        name = batch_name(md5, flags)
+        entry = {'input': path, 'input_md5': md5, 'flags': flags, 'version': VERSION,
+                 'output': None, 'output_md5': None, 'seconds': round(seconds, 4), 'error': None}
+        if isinstance(dtbo, ConversionError):
+            entry['error'] = f"{dtbo.code}: {dtbo}"
+        elif isinstance(dtbo, Exception):
+            entry['error'] = f"internal: {type(dtbo).__name__}: {dtbo}"
+        else:
+            entry['output'] = os.path.join(outdir, name)
+            entry['output_md5'] = hashlib.md5(dtbo).hexdigest()
+            tmp = entry['output'] + '.tmp'
+            with open(tmp, 'wb') as f:
+                f.write(dtbo)
+            os.replace(tmp, entry['output'])
+        entries[name] = entry
+    return entries
+
+def batch_convert(paths, flagsets, outdir, jobs=None, manifest=None, force=False, progress=sys.stderr):
+    """Convert every input for every flag set with a process pool.
+
+    The manifest (outdir/manifest.json by default) records input md5, flags,
+    output md5, timing and error per overlay. Overlays whose input and
+    generator version did not change since the last run are skipped.
+    Returns the manifest.
+    """
+    import json, multiprocessing
+    flagsets = [sorted(set(flags)) for flags in flagsets]
+    manifest_path = manifest or os.path.join(outdir, 'manifest.json')
+    os.makedirs(outdir, exist_ok=True)
+    try:
+        with open(manifest_path) as f:
+            entries = json.load(f)['entries']
+    except (OSError, ValueError, KeyError):
+        entries = {}
+
+    # hash inputs here, the same dtb uploaded under several names is converted once
+    tasks = {}
+    skipped = 0
+    for path in batch_inputs(paths):
+        with open(path, 'rb') as f:
+            md5 = hashlib.md5(f.read()).hexdigest()
+        todo = []
+        for flags in flagsets:
+            old = entries.get(batch_name(md5, flags))
+            if (not force and old is not None and old['version'] == VERSION
+                    and (old['error'] is not None or os.path.isfile(old['output'] or ''))):
+                skipped += 1
+            elif flags not in todo:
+                todo.append(flags)
+        if todo and md5 not in tasks:
+            tasks[md5] = (path, md5, todo, outdir)
+
+    total = len(tasks)
+    done = made = failed = 0
+    t0 = time.perf_counter()
+    print(f"{total} inputs to convert, {skipped} overlays up to date", file=progress)
+    try:
+        with multiprocessing.Pool(jobs) as pool:
+            for result in pool.imap_unordered(batch_job, tasks.values()):
+                entries.update(result)
+                done += 1
+                made += sum(1 for e in result.values() if e['error'] is None)
+                failed += sum(1 for e in result.values() if e['error'] is not None)
+                elapsed = time.perf_counter() - t0
+                print(f"[{done}/{total}] {made} overlays, {failed} failed, "
+                      f"{made / elapsed:.1f} overlays/s", file=progress)
+    finally:
+        # also keep what got done before an interruption
+        result = {'version': VERSION, 'entries': dict(sorted(entries.items()))}
+        with open(manifest_path + '.tmp', 'w') as f:
+            json.dump(result, f, indent=1)
+        os.replace(manifest_path + '.tmp', manifest_path)
+    return result
 
 
 if __name__ == "__main__":
@@ -479,14 +846,30 @@ if __name__ == "__main__":
 
     parser = argparse.ArgumentParser(description="Generate a dtbo from a stock dtb")
     parser.add_argument(dest="src", help="input stock dtb path", metavar="/path/to/stock.dtb")
-    parser.add_argument(dest="opts", help="dtbo options", nargs='?', metavar="LSi-HPi", default="")
+    parser.add_argument(dest="opts", help="dtbo options", nargs='*', metavar="LSi-HPi")
     parser.add_argument("-o", "--output", help="output (dtbo) path")
+    parser.add_argument("-b", "--batch", metavar="OUTDIR",
+                        help="batch mode: all arguments are dtb files, directories or globs, overlays go to OUTDIR")
+    parser.add_argument("-f", "--flags", action="append", metavar="LSi-HPi",
+                        help="batch mode: flag combination to generate, can be repeated (default: none)")
+    parser.add_argument("-j", "--jobs", type=int, help="batch mode: worker processes (default: cpu count)")
+    parser.add_argument("--manifest", help="batch mode: manifest path (default: OUTDIR/manifest.json)")
+    parser.add_argument("--force", action="store_true", help="batch mode: convert even if up to date")
     args = parser.parse_args()
 
+    if args.batch:
+        logger.setLevel(logging.WARNING)
+        paths = [args.src] + args.opts
+        flagsets = [[f for f in opts.split('-') if f != ''] for opts in (args.flags or [''])]
+        manifest = batch_convert(paths, flagsets, args.batch, args.jobs, args.manifest, args.force)
+        sys.exit(1 if any(e['error'] for e in manifest['entries'].values()) else 0)
+
     with open(args.src, 'rb') as f:
         content = f.read()
 
-    flags = args.opts.split('-')
+    if len(args.opts) > 1:
+        parser.error("only one OPTS argument without --batch")
+    flags = (args.opts or [''])[0].split('-')
     flags = [ f for f in flags if f != '']
     dtbo = make_dtbo(content, {'flags': flags, 'logger': logger})
 
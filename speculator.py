@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+
+# Generating popular flag variants of an upload before anybody asks for them
+
+import threading, time
+from collections import Counter, OrderedDict, deque
+
+from convert_executor import ExecutorBusy
+
+
+class Speculator:
+    """Background pre-generation of the most requested flag variants.
+
+    After an upload, schedule() queues the `variants` most popular flag sets
+    (counted by record() from real requests) that are not cached yet. A single
+    low priority thread converts them only while the executor has an idle
+    worker and nobody waiting, and sleeps after each job so speculation takes
+    at most `cpu_share` of one worker. The queue keeps the newest `queue_size`
+    uploads, older ones are dropped. cancel() forgets the queued work of an
+    md5, stop() all of it. Either `variants` or `cpu_share` 0 disables it.
+    """
+    def __init__(self, executor, cache, job, logger, variants=4, queue_size=16, cpu_share=0.5,
+                 poll_interval=0.05, remember=10000):
+        if not 0 <= cpu_share <= 1:
+            raise ValueError(f"cpu_share {cpu_share} is not between 0 and 1")
+        self.executor = executor
+        self.cache = cache
+        self.job = job
+        self.logger = logger
+        self.variants = variants
+        self.queue_size = queue_size
+        self.cpu_share = cpu_share
+        self.poll_interval = poll_interval
+        self.remember = remember
+        self.cond = threading.Condition()
+        self.queue = deque()
+        self.popularity = Counter()
+        # 'md5-flags' names generated speculatively and not asked for yet
+        self.speculated = OrderedDict()
+        self.worker = None
+        self.stopped = False
+        self.scheduled = 0
+        self.generated = 0
+        self.dropped = 0
+        self.cancelled = 0
+        self.failed = 0
+        self.hits = 0
+        self.busy_seconds = 0.0
+
+    def start(self):
+        with self.cond:
+            if self.worker is None or not self.worker.is_alive():
+                self.stopped = False
+                self.worker = threading.Thread(target=self.run, name='speculator', daemon=True)
+                self.worker.start()
+
+    def stop(self):
+        with self.cond:
+            self.cancelled += len(self.queue)
+            self.queue.clear()
+            self.stopped = True
+            self.cond.notify()
+
+    def record(self, flags):
+        """Count a requested flag set, converted or fetched."""
+        with self.cond:
+            self.popularity[tuple(flags)] += 1
+
+    def used(self, md5, flags):
+        """Note a request of an overlay, counts a hit if it was speculated."""
+        name = md5 + ''.join('-' + f for f in flags)
+        with self.cond:
+            if self.speculated.pop(name, None) is not None:
+                self.hits += 1
+
+    def schedule(self, md5, content, requested):
+        """Queue generation of popular variants of an upload besides the requested ones."""
+        if self.variants <= 0 or self.cpu_share <= 0:
+            return
+        with self.cond:
+            popular = [flags for (flags, _) in self.popularity.most_common(self.variants + len(requested))]
+        requested = set(tuple(flags) for flags in requested)
+        flagsets = [flags for flags in popular if flags not in requested][:self.variants]
+        if not flagsets:
+            return
+        self.start()
+        with self.cond:
+            self.cancel_locked(md5)
+            self.queue.append((md5, content, flagsets))
+            self.scheduled += 1
+            while len(self.queue) > self.queue_size:
+                self.queue.popleft()
+                self.dropped += 1
+            self.cond.notify()
+
+    def cancel(self, md5):
+        with self.cond:
+            self.cancel_locked(md5)
+
+    def cancel_locked(self, md5):
+        kept = [item for item in self.queue if item[0] != md5]
+        self.cancelled += len(self.queue) - len(kept)
+        self.queue = deque(kept)
+
+    def next_item(self):
+        # newest upload first, its user is the most likely to come back soon
+        with self.cond:
+            while not self.queue and not self.stopped:
+                self.cond.wait()
+            if self.stopped:
+                return None
+            return self.queue.pop()
+
+    def run(self):
+        while True:
+            item = self.next_item()
+            if item is None:
+                return
+            if self.cpu_share <= 0:
+                # disabled after it was queued
+                continue
+            # foreground conversions go first
+            while self.executor.idle_workers() == 0 and not self.stopped:
+                time.sleep(self.poll_interval)
+            (md5, content, flagsets) = item
+            missing = [list(flags) for flags in flagsets if self.cache.lookup(md5, list(flags)) is None]
+            if not missing:
+                continue
+            t0 = time.monotonic()
+            try:
+                (dtbos, *_) = self.executor.run((md5, tuple(map(tuple, missing))), self.job, content, missing)
+            except ExecutorBusy:
+                with self.cond:
+                    self.dropped += 1
+                continue
+            except Exception as e:
+                with self.cond:
+                    self.failed += 1
+                self.logger.info(f"speculative conversion of {md5} failed: {e}")
+                continue
+            # a variant the panel can not be described with is just not offered
+            made = [(flags, dtbo) for (flags, dtbo) in zip(missing, dtbos) if not isinstance(dtbo, Exception)]
+            for (flags, dtbo) in made:
+                self.cache.put(md5, flags, dtbo)
+            spent = time.monotonic() - t0
+            with self.cond:
+                self.generated += len(made)
+                self.failed += len(missing) - len(made)
+                self.busy_seconds += spent
+                for (flags, _) in made:
+                    self.speculated[md5 + ''.join('-' + f for f in flags)] = True
+                while len(self.speculated) > self.remember:
+                    self.speculated.popitem(last=False)
+            # stay within the cpu budget
+            time.sleep(spent * (1 / self.cpu_share - 1))
+
+    def stats(self):
+        with self.cond:
+            return {
+                'queued': len(self.queue),
+                'scheduled': self.scheduled,
+                'generated': self.generated,
+                'dropped': self.dropped,
+                'cancelled': self.cancelled,
+                'failed': self.failed,
+                'hits': self.hits,
+                'hit_rate': self.hits / self.generated if self.generated else None,
+                'busy_seconds': round(self.busy_seconds, 3),
+                'popular': ['-'.join(flags) for (flags, _) in self.popularity.most_common(self.variants)],
+            }
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+
+# In-memory, precompressed static files
+
+import os, time, threading, hashlib, gzip, zlib
+from flask import Response
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+def content_headers(name):
+    if name.endswith('.js'):
+        return {'content-type': 'application/javascript'}
+    elif name.endswith('.css'):
+        return {'content-type': 'text/css'}
+    elif name.endswith('.html'):
+        return {'content-type': 'text/html; charset=utf-8'}
+    else:
+        return {'content-type': 'application/octet-stream', 'content-disposition': f'attachment; filename="{name}"'}
+
+
+class Asset:
+    """A file kept in memory together with its compressed variants."""
+    def __init__(self, name, path):
+        self.name = name
+        self.path = path
+        self.mtime = os.stat(path).st_mtime_ns
+        with open(path, 'rb') as f:
+            body = f.read()
+        tag = hashlib.sha1(body).hexdigest()[:20]
+        # encoding -> (body, etag)
+        self.variants = {'identity': (body, f'"{tag}"')}
+        compressed = {'gzip': gzip.compress(body, 9, mtime=0), 'deflate': zlib.compress(body, 9)}
+        if brotli:
+            compressed['br'] = brotli.compress(body)
+        for (enc, data) in compressed.items():
+            # not worth it for tiny or incompressible files
+            if len(data) < len(body) * 0.9:
+                self.variants[enc] = (data, f'"{tag}-{enc}"')
+        self.headers = content_headers(name)
+        self.checked = time.monotonic()
+
+
+class StaticAssets:
+    """Serve files from memory, reloading them when their mtime changes.
+
+    Responses carry strong ETags, Cache-Control and Vary headers, answer
+    If-None-Match with 304 and pick the best encoding the client accepts.
+    """
+    # preferred order when the client accepts several
+    encodings = ['br', 'gzip', 'deflate']
+
+    def __init__(self, check_interval=1.0):
+        self.check_interval = check_interval
+        self.lock = threading.Lock()
+        self.assets = {}
+
+    def add(self, name, path):
+        asset = Asset(name, path)
+        with self.lock:
+            self.assets[name] = asset
+        return asset
+
+    def add_dir(self, prefix, directory):
+        if not os.path.isdir(directory):
+            return
+        for name in sorted(os.listdir(directory)):
+            path = os.path.join(directory, name)
+            if os.path.isfile(path):
+                self.add(prefix + name, path)
+
+    def get(self, name, path=None):
+        """Get a fresh asset; path allows picking up files added after startup."""
+        asset = self.assets.get(name)
+        if asset is None:
+            if path is None or not os.path.isfile(path):
+                return None
+            return self.add(name, path)
+        now = time.monotonic()
+        if now - asset.checked >= self.check_interval:
+            asset.checked = now
+            try:
+                if os.stat(asset.path).st_mtime_ns != asset.mtime:
+                    asset = self.add(name, asset.path)
+            except OSError:
+                with self.lock:
+                    self.assets.pop(name, None)
+                return None
+        return asset
+
+    def response(self, asset, request, cache_control):
+        encoding = 'identity'
+        for enc in self.encodings:
+            if enc in asset.variants and request.accept_encodings[enc]:
+                encoding = enc
+                break
+        (body, etag) = asset.variants[encoding]
+        headers = {'etag': etag, 'cache-control': cache_control}
+        if len(asset.variants) > 1:
+            headers['vary'] = 'Accept-Encoding'
+        if request.if_none_match.contains_raw(etag):
+            return Response(b'', 304, headers)
+        headers.update(asset.headers)
+        if encoding != 'identity':
+            headers['content-encoding'] = encoding
+        return Response(body, 200, headers)
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+
+# Background delivery of Telegram notifications
+
+import queue, threading, time
+import requests
+
+
+class TelegramNotifier:
+    """Send Telegram messages from a background thread.
+
+    notify() only puts the message on a bounded queue, a single worker posts
+    them through a pooled session with timeouts and retries. Bursts of
+    coalescable messages (e.g. "new overlay") are merged into one digest.
+    """
+    def __init__(self, apikey, chats, logger, base_url='https://api.telegram.org',
+                 queue_size=1000, timeout=10, retries=3, backoff=1.0,
+                 coalesce_delay=5.0, digest_max=50):
+        self.apikey = apikey
+        self.chats = chats
+        self.logger = logger
+        self.url = f"{base_url.rstrip('/')}/bot{apikey}/sendMessage"
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.coalesce_delay = coalesce_delay
+        self.digest_max = digest_max
+        self.session = None
+        self.worker = None
+        self.lock = threading.Lock()
+        self.sent = 0
+        self.failed = 0
+        self.dropped = 0
+        self.coalesced = 0
+
+    def start(self):
+        # started lazily, so a forked process gets its own thread and session
+        with self.lock:
+            if self.worker is None or not self.worker.is_alive():
+                self.session = requests.Session()
+                self.worker = threading.Thread(target=self.run, name='telegram-notifier', daemon=True)
+                self.worker.start()
+
+    def notify(self, message, params, coalesce=False):
+        """Queue a message, never blocks. Returns False if it was dropped."""
+        self.start()
+        try:
+            self.queue.put_nowait((message, params, coalesce))
+            return True
+        except queue.Full:
+            with self.lock:
+                self.dropped += 1
+            self.logger.warning(f"tg queue full, dropped: {message}")
+            return False
+
+    def run(self):
+        later = []
+        while True:
+            if later:
+                item = later.pop(0)
+            else:
+                item = self.queue.get()
+            (message, params, coalesce) = item
+            if coalesce:
+                (message, params) = self.collect_digest(message, params, later)
+            self.send(message, params)
+
+    def collect_digest(self, message, params, later):
+        # wait a little for more coalescable messages, keep the others for later
+        lines = [message]
+        deadline = time.monotonic() + self.coalesce_delay
+        while len(lines) < self.digest_max:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                (m, p, c) = self.queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if c:
+                lines.append(m)
+            else:
+                later.append((m, p, c))
+        if len(lines) == 1:
+            return (message, params)
+        with self.lock:
+            self.coalesced += len(lines) - 1
+        return ('\n'.join([f"{len(lines)} notifications:"] + lines), params)
+
+    def send(self, message, params):
+        for chat in self.chats:
+            payload = {
+                "chat_id": chat,
+                "text": message,
+                "parse_mode": "Markdown"
+            }
+            payload.update(params)
+            self.logger.info(f"tg post {chat}: {message[:100]!r}")
+            if self.post(payload):
+                with self.lock:
+                    self.sent += 1
+            else:
+                with self.lock:
+                    self.failed += 1
+
+    def post(self, payload):
+        delay = self.backoff
+        for attempt in range(self.retries + 1):
+            try:
+                response = self.session.post(self.url, json=payload, timeout=self.timeout)
+                if response.status_code < 300:
+                    return True
+                if response.status_code == 429:
+                    # telegram tells how long to back off
+                    try:
+                        delay = max(delay, response.json()['parameters']['retry_after'])
+                    except Exception:
+                        pass
+                elif response.status_code < 500:
+                    self.logger.warning(f"tg post failed {response.status_code} {response.text}")
+                    return False
+                self.logger.warning(f"tg post attempt {attempt+1} got {response.status_code}")
+            except requests.RequestException as e:
+                self.logger.warning(f"tg post attempt {attempt+1} failed: {e}")
+            if attempt < self.retries:
+                time.sleep(delay)
+                delay *= 2
+        return False
+
+    def stats(self):
+        with self.lock:
+            return {
+                'queued': self.queue.qsize(),
+                'sent': self.sent,
+                'failed': self.failed,
+                'dropped': self.dropped,
+                'coalesced': self.coalesced,
+            }
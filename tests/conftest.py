@@ -0,0 +1,25 @@
+import json, os, sys
+
+import pytest
+
+# the modules live at the top of the repo, not in a package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture(scope='session')
+def server(tmp_path_factory):
+    """overlay_server converting in the request thread, without rate limits,
+    with its pack and event store in a temporary directory."""
+    workdir = tmp_path_factory.mktemp('server')
+    config = workdir / 'config.json'
+    config.write_text(json.dumps({'CONVERT_WORKERS': 0, 'CONVERT_RATE': None, 'SPECULATE_VARIANTS': 0}))
+    os.environ['OVERLAY_SERVER_CONFIG'] = str(config)
+    cwd = os.getcwd()
+    # the server keeps its files in the current directory
+    os.chdir(workdir)
+    try:
+        import overlay_server
+        yield overlay_server
+        overlay_server.shutdown()
+    finally:
+        os.chdir(cwd)
@@ -0,0 +1,279 @@
+import contextlib, hashlib, io, statistics, threading, time
+
+import fdt
+import pytest
+
+from admission import FairGate, RateLimited, RateLimiter, client_key
+from bench_dtbo import make_stock_dtb
+from convert_executor import ConversionExecutor, ExecutorBusy
+
+
+def test_client_key():
+    assert client_key('192.0.2.7') == '192.0.2.7/32'
+    assert client_key('192.0.2.7', prefix_v4=24) == '192.0.2.0/24'
+    assert client_key('2001:db8::1') == client_key('2001:db8::ffff') == '2001:db8::/64'
+    assert client_key('::ffff:192.0.2.7') == '192.0.2.7/32'
+    assert client_key('not an address') == 'not an address'
+
+
+def test_rate_limiter():
+    limiter = RateLimiter(0.5, 3)
+    for _ in range(3):
+        limiter.take('a', now=100)
+    with pytest.raises(RateLimited) as e:
+        limiter.take('a', now=100)
+    # one token in 2s
+    assert e.value.retry_after == 2
+    # other clients have their own bucket
+    limiter.take('b', now=100)
+    with pytest.raises(RateLimited) as e:
+        limiter.take('a', now=101)
+    assert e.value.retry_after == 1
+    limiter.take('a', now=102)
+    with pytest.raises(RateLimited):
+        limiter.take('a', now=102)
+    # refilled up to burst only
+    for _ in range(3):
+        limiter.take('a', now=1000)
+    with pytest.raises(RateLimited):
+        limiter.take('a', now=1000)
+    assert limiter.stats() == {'clients': 2, 'limited': 4}
+
+def test_rate_limiter_give():
+    limiter = RateLimiter(0.5, 2)
+    limiter.take('a', now=100)
+    limiter.take('a', now=100)
+    limiter.give('a')
+    limiter.take('a', now=100)
+    with pytest.raises(RateLimited):
+        limiter.take('a', now=100)
+    # not beyond burst, and nothing for clients never seen
+    for _ in range(3):
+        limiter.give('a')
+    limiter.give('b')
+    limiter.take('a', now=100)
+    limiter.take('a', now=100)
+    with pytest.raises(RateLimited):
+        limiter.take('a', now=100)
+    assert limiter.stats()['clients'] == 1
+
+def test_rate_limiter_forgets():
+    limiter = RateLimiter(0.5, 1, max_clients=2)
+    for client in ('a', 'b', 'c'):
+        limiter.take(client, now=0)
+    # 'a' was forgotten and starts over with a full bucket
+    limiter.take('a', now=0)
+    with pytest.raises(RateLimited):
+        limiter.take('c', now=0)
+
+def test_rate_limiter_off():
+    limiter = RateLimiter(None, 0)
+    for _ in range(100):
+        limiter.take('a')
+    limiter = RateLimiter(0, 1)
+    limiter.take('a')
+    with pytest.raises(RateLimited) as e:
+        limiter.take('a')
+    assert e.value.retry_after == 3600
+
+
+def queue(gate, client, order):
+    """Start a thread waiting for a slot of gate, which notes client in order when admitted."""
+    waiting = gate.stats()['waiting']
+    def run():
+        gate.acquire(client)
+        order.append(client)
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    while gate.stats()['waiting'] == waiting:
+        time.sleep(0.001)
+    return thread
+
+def test_fair_gate_round_robin():
+    gate = FairGate(limit=1, max_waiting=10, per_client=3, timeout=10)
+    gate.acquire('x')
+    order = []
+    threads = [queue(gate, client, order) for client in ('a', 'a', 'a', 'b', 'c', 'b')]
+    for n in range(1, len(threads) + 1):
+        gate.release()
+        while len(order) < n:
+            time.sleep(0.001)
+    # one client's backlog does not hold up the others
+    assert order == ['a', 'b', 'c', 'a', 'b', 'a']
+    for thread in threads:
+        thread.join()
+    gate.release()
+    stats = gate.stats()
+    assert (stats['running'], stats['waiting'], stats['admitted'], stats['queued']) == (0, 0, 7, 6)
+
+def test_fair_gate_limits():
+    gate = FairGate(limit=1, max_waiting=3, per_client=2, timeout=10)
+    gate.acquire('x')
+    order = []
+    threads = [queue(gate, 'a', order), queue(gate, 'a', order)]
+    with pytest.raises(RateLimited):
+        gate.acquire('a')
+    threads.append(queue(gate, 'b', order))
+    with pytest.raises(ExecutorBusy):
+        gate.acquire('c')
+    for _ in threads:
+        gate.release()
+    for thread in threads:
+        thread.join()
+    assert gate.stats()['rejected'] == 2
+
+def test_fair_gate_timeout():
+    gate = FairGate(limit=1, max_waiting=3, per_client=2, timeout=0.05)
+    with gate.slot('x'):
+        with pytest.raises(ExecutorBusy):
+            gate.acquire('a')
+    assert gate.stats()['timeouts'] == 1
+    # the slot is free again, and nobody is left waiting
+    with gate.slot('a'):
+        assert gate.stats()['waiting'] == 0
+
+
+def test_run_joins_without_admission():
+    executor = ConversionExecutor(0, 0, 10, None)
+    started = threading.Event()
+    finish = threading.Event()
+    admitted = []
+    def admit(who):
+        def enter():
+            admitted.append(who)
+            return contextlib.nullcontext()
+        return enter
+    def job():
+        started.set()
+        finish.wait(10)
+        return 'done'
+    results = []
+    leader = threading.Thread(target=lambda: results.append(executor.run('k', job, admit=admit('leader'))))
+    leader.start()
+    started.wait(10)
+    follower = threading.Thread(target=lambda: results.append(executor.run('k', job, admit=admit('follower'))))
+    follower.start()
+    while executor.stats()['coalesced'] == 0:
+        time.sleep(0.001)
+    finish.set()
+    leader.join()
+    follower.join()
+    assert results == ['done', 'done']
+    assert admitted == ['leader']
+
+def test_run_rejected_leader():
+    # a follower does not get the leader's 429, it goes through admission itself
+    executor = ConversionExecutor(0, 0, 10, None)
+    class Rejecting:
+        def __enter__(self):
+            while executor.stats()['coalesced'] == 0:
+                time.sleep(0.001)
+            raise RateLimited(5)
+        def __exit__(self, *exc):
+            return False
+    errors = []
+    def lead():
+        try:
+            executor.run('k', lambda: 'done', admit=Rejecting)
+        except RateLimited as e:
+            errors.append(e)
+    leader = threading.Thread(target=lead)
+    leader.start()
+    while executor.stats()['inflight'] == 0:
+        time.sleep(0.001)
+    assert executor.run('k', lambda: 'done', admit=contextlib.nullcontext) == 'done'
+    leader.join()
+    assert len(errors) == 1
+
+def distinct_dtbs(base, count):
+    """Copies of base differing in the init sequence, each needs its own conversion."""
+    dt = fdt.parse_dtb(base)
+    iseq = bytes(dt.get_node('/dsi@ff450000/panel@0').get_property('panel-init-sequence').data)
+    at = base.find(iseq) + 1
+    for n in range(count):
+        dtb = bytearray(base)
+        dtb[at] = n & 0xff
+        dtb[at + 3 + iseq[2]] = (n >> 8) & 0xff
+        yield bytes(dtb)
+
+def post(client, dtb, address, opts='-LSi'):
+    return client.post('/convert_dtb?silent=1&opts=' + opts, data={'file': (io.BytesIO(dtb), 'stock.dtb')},
+                       environ_base={'REMOTE_ADDR': address})
+
+def test_retry_after(server, monkeypatch):
+    monkeypatch.setattr(server, 'rate_limiter', RateLimiter(0.01, 1))
+    client = server.app.test_client()
+    [first, second] = distinct_dtbs(make_stock_dtb(seed=60), 2)
+    assert post(client, first, '192.0.2.1').status_code == 200
+    response = post(client, second, '192.0.2.1')
+    assert response.status_code == 429
+    assert response.headers['retry-after'] == '100'
+    # cached overlays are no conversion and go through
+    assert post(client, first, '192.0.2.1').status_code == 200
+    # other clients have their own budget
+    assert post(client, second, '192.0.2.2').status_code == 200
+    assert post(client, second, '192.0.2.1').status_code == 200
+
+def test_busy_costs_no_token(server, monkeypatch):
+    monkeypatch.setattr(server, 'rate_limiter', RateLimiter(0.01, 1))
+    gate = server.convert_gate
+    # a gate without room turns everybody away
+    monkeypatch.setattr(server, 'convert_gate', FairGate(limit=0, max_waiting=0, per_client=1, timeout=10))
+    client = server.app.test_client()
+    [dtb] = distinct_dtbs(make_stock_dtb(seed=64), 1)
+    for _ in range(3):
+        assert post(client, dtb, '192.0.2.4').status_code == 503
+    monkeypatch.setattr(server, 'convert_gate', gate)
+    assert post(client, dtb, '192.0.2.4').status_code == 200
+
+def test_retry_after_known_failure(server, monkeypatch):
+    monkeypatch.setattr(server, 'rate_limiter', RateLimiter(0.01, 1))
+    client = server.app.test_client()
+    dt = fdt.parse_dtb(make_stock_dtb(seed=61))
+    dt.remove_node('__symbols__')
+    bad = dt.to_dtb()
+    assert post(client, bad, '192.0.2.3').status_code == 422
+    # the failure cache answers without a token
+    assert post(client, bad, '192.0.2.3').status_code == 422
+    assert post(client, bad, '192.0.2.3', '-Dno').status_code == 422
+
+def test_flood(server, monkeypatch):
+    monkeypatch.setattr(server, 'rate_limiter', RateLimiter(0.5, 2))
+    client = server.app.test_client()
+    base = make_stock_dtb(seed=62)
+    assert post(client, base, '192.0.2.10').status_code == 200
+    name = hashlib.md5(base).hexdigest() + '-LSi'
+
+    statuses = []
+    def lookups(flood_requests=0):
+        # until the flood got as many requests in
+        seconds = []
+        while len(seconds) < 200 or len(statuses) < flood_requests:
+            t0 = time.perf_counter()
+            assert client.get('/dtbo/' + name, environ_base={'REMOTE_ADDR': '192.0.2.10'}).status_code == 200
+            seconds.append(time.perf_counter() - t0)
+        return statistics.median(seconds)
+
+    quiet = lookups()
+    stop = threading.Event()
+    def flood(dtbs):
+        flooder = server.app.test_client()
+        for dtb in dtbs:
+            if stop.is_set():
+                break
+            statuses.append(post(flooder, dtb, '198.51.100.1').status_code)
+    dtbs = list(distinct_dtbs(make_stock_dtb(seed=63), 2000))
+    threads = [threading.Thread(target=flood, args=(dtbs[i::2],)) for i in range(2)]
+    for thread in threads:
+        thread.start()
+    try:
+        flooded = lookups(200)
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+
+    # the flood was turned away, not converted, and lookups did not notice
+    assert statuses.count(429) > 10 * statuses.count(200)
+    assert statuses.count(200) <= 2
+    assert flooded < 3 * quiet + 0.001, (quiet, flooded)
@@ -0,0 +1,108 @@
+import logging, os, threading, time
+
+import pytest
+
+from convert_executor import ConversionExecutor, ConversionTimeout, ExecutorBusy, WorkerDied
+
+
+# jobs, run in the worker processes
+
+def pid():
+    return os.getpid()
+
+def wait_for(path):
+    while not os.path.exists(path):
+        time.sleep(0.01)
+    return os.getpid()
+
+def crash():
+    os._exit(3)
+
+
+@pytest.fixture
+def executor():
+    executors = []
+    def make(workers=1, timeout=30, queue_timeout=10):
+        executors.append(ConversionExecutor(workers, 4, timeout, logging.getLogger('test'), queue_timeout))
+        return executors[-1]
+    yield make
+    for executor in executors:
+        executor.stop()
+
+def wait_until(condition):
+    deadline = time.monotonic() + 10
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.001)
+
+def test_stuck_job_replaced(executor, tmp_path):
+    executor = executor(timeout=0.3)
+    first = executor.run('pid', pid)
+    with pytest.raises(ConversionTimeout):
+        executor.run('stuck', wait_for, str(tmp_path / 'never'))
+    assert executor.stats()['timeouts'] == 1
+    assert executor.stats()['idle'] == 1
+    # the stuck worker was killed, a new one does the next job
+    assert executor.run('pid', pid) != first
+    with pytest.raises(ProcessLookupError):
+        os.kill(first, 0)
+
+def test_crash(executor):
+    executor = executor(workers=2)
+    with pytest.raises(WorkerDied):
+        executor.run('crash', crash)
+    stats = executor.stats()
+    assert stats['failures'] == 1
+    assert stats['idle'] == 2 and len(executor.workers) == 2
+    assert executor.run('pid', pid) != os.getpid()
+
+def test_coalesced_across_processes(executor, tmp_path):
+    executor = executor(workers=2)
+    go = str(tmp_path / 'go')
+    results = []
+    def run():
+        results.append(executor.run('same', wait_for, go))
+    threads = [threading.Thread(target=run) for _ in range(3)]
+    threads[0].start()
+    wait_until(lambda: executor.stats()['idle'] == 1)
+    for thread in threads[1:]:
+        thread.start()
+    wait_until(lambda: executor.stats()['coalesced'] == 2)
+    open(go, 'w').close()
+    for thread in threads:
+        thread.join()
+    # one worker did it for all
+    assert len(set(results)) == 1 and len(results) == 3
+    assert executor.stats()['jobs'] == 1
+
+def test_queue_timeout(executor, tmp_path):
+    # waiting for a worker is bounded by the queue timeout, not the conversion timeout
+    executor = executor(timeout=30, queue_timeout=0.2)
+    go = str(tmp_path / 'go')
+    busy = threading.Thread(target=executor.run, args=('busy', wait_for, go))
+    busy.start()
+    wait_until(lambda: executor.stats()['idle'] == 0)
+    t0 = time.monotonic()
+    with pytest.raises(ExecutorBusy):
+        executor.run('other', pid)
+    assert time.monotonic() - t0 < 5
+    open(go, 'w').close()
+    busy.join()
+
+def test_stop_kills_busy(executor, tmp_path):
+    executor = executor(workers=2)
+    errors = []
+    def run():
+        try:
+            executor.run('busy', wait_for, str(tmp_path / 'never'))
+        except WorkerDied as e:
+            errors.append(e)
+    thread = threading.Thread(target=run)
+    thread.start()
+    wait_until(lambda: executor.stats()['idle'] == 1)
+    processes = [worker.process for worker in executor.workers]
+    executor.stop()
+    thread.join(10)
+    assert len(errors) == 1
+    assert all(not process.is_alive() for process in processes)
+    assert executor.workers == [] and executor.idle == []
@@ -0,0 +1,98 @@
+import hashlib, io
+
+import pytest
+
+from bench_dtbo import make_stock_dtb
+
+
+@pytest.fixture
+def uploaded(server):
+    """(name, dtbo) of an overlay made by /convert_dtb."""
+    client = server.app.test_client()
+    dtb = make_stock_dtb(seed=70)
+    response = client.post('/convert_dtb?silent=1&opts=-LSi', data={'file': (io.BytesIO(dtb), 'stock.dtb')})
+    assert response.status_code == 200
+    return (hashlib.md5(dtb).hexdigest() + '-LSi', response.data)
+
+def forget_memory(server):
+    # only the copy in the pack is left
+    cache = server.conversion_cache
+    with cache.lock:
+        cache.entries.clear()
+        cache.size = 0
+
+def transferred(client, name, rounds, method='GET'):
+    """Status codes and body bytes of rounds lookups revalidating the etag."""
+    statuses = []
+    total = 0
+    etag = None
+    for _ in range(rounds):
+        response = client.open(f'/dtbo/{name}', method=method, headers={'if-none-match': etag} if etag else {})
+        statuses.append(response.status_code)
+        total += len(response.get_data())
+        etag = response.headers.get('etag', etag)
+        response.close()
+    return (statuses, total)
+
+
+@pytest.mark.parametrize('disk', [False, True])
+def test_repeat_lookups(server, uploaded, disk):
+    (name, dtbo) = uploaded
+    if disk:
+        forget_memory(server)
+    (statuses, total) = transferred(server.app.test_client(), name, 10)
+    # the overlay once, then only 304s without a body
+    assert statuses == [200] + [304] * 9
+    assert total == len(dtbo)
+
+@pytest.mark.parametrize('disk', [False, True])
+def test_body(server, uploaded, disk):
+    (name, dtbo) = uploaded
+    if disk:
+        forget_memory(server)
+    response = server.app.test_client().get(f'/dtbo/{name}')
+    assert response.status_code == 200
+    assert response.data == dtbo
+    assert response.headers['content-length'] == str(len(dtbo))
+
+@pytest.mark.parametrize('disk', [False, True])
+def test_head(server, uploaded, disk):
+    (name, dtbo) = uploaded
+    if disk:
+        forget_memory(server)
+    client = server.app.test_client()
+    response = client.head(f'/dtbo/{name}')
+    assert response.status_code == 200
+    assert response.get_data() == b''
+    assert response.headers['content-length'] == str(len(dtbo))
+    assert response.headers['etag'] == client.get(f'/dtbo/{name}').headers['etag']
+    (statuses, total) = transferred(client, name, 3, 'HEAD')
+    assert statuses == [200, 304, 304] and total == 0
+
+def test_not_modified_does_not_open(server, uploaded, monkeypatch):
+    (name, dtbo) = uploaded
+    forget_memory(server)
+    client = server.app.test_client()
+    opened = []
+    open_extent = server.conversion_cache.open
+    def counting_open(md5, flags):
+        extent = open_extent(md5, flags)
+        opened.append(extent)
+        return extent
+    monkeypatch.setattr(server.conversion_cache, 'open', counting_open)
+
+    response = client.get(f'/dtbo/{name}')
+    assert response.data == dtbo
+    response.close()
+    assert len(opened) == 1
+    # the pack file is closed with the response
+    assert opened[0].file.closed
+
+    forget_memory(server)
+    response = client.get(f'/dtbo/{name}', headers={'if-none-match': response.headers['etag']})
+    assert response.status_code == 304
+    assert len(opened) == 1
+
+def test_unknown(server):
+    response = server.app.test_client().get('/dtbo/' + '0' * 32 + '-LSi')
+    assert response.status_code == 404
@@ -0,0 +1,68 @@
+import logging, sqlite3
+
+from event_store import EventStore
+
+MD5 = 'a' * 32
+OTHER = 'b' * 32
+
+
+def store(path, **kwargs):
+    return EventStore(str(path), logging.getLogger('test'), flush_interval=0.01, **kwargs)
+
+def test_rows_after_reopen(tmp_path):
+    db = tmp_path / 'events.sqlite'
+    events = store(db)
+    events.record_upload(MD5, 'r36s.dtb', [['LSi'], ['LSi', 'Dno']], '3', 1000, 0.5, when=100)
+    events.record_upload(OTHER, 'other.dtb', [['HPi']], '3', 2000, 0.25, when=200)
+    events.record_upload(MD5, 'again.dtb', [[]], '3', 1000, 0.125, when=300)
+    events.record_feedback(MD5, 'someone', 'R36S', 'works', when=150)
+    events.flush()
+    stats = events.stats()
+    assert (stats['queued'], stats['written'], stats['dropped']) == (0, 4, 0)
+
+    again = store(db)
+    uploads = again.uploads()
+    assert [row['filename'] for row in uploads] == ['again.dtb', 'other.dtb', 'r36s.dtb']
+    assert uploads[2]['opts'] == '-LSi,-LSi-Dno' and uploads[2]['size'] == 1000
+    assert [row['time'] for row in again.uploads(md5=MD5)] == [300, 100]
+    assert [row['md5'] for row in again.uploads(flag='LSi')] == [MD5]
+    assert [row['md5'] for row in again.uploads(flag='HPi', md5=OTHER)] == [OTHER]
+    assert again.uploads(flag='Dno', before=100) == []
+    assert [row['time'] for row in again.uploads(before=300, limit=1)] == [200]
+    [feedback] = again.feedback(md5=MD5)
+    assert (feedback['user'], feedback['device'], feedback['description'], feedback['time']) == (
+        'someone', 'R36S', 'works', 150)
+    assert again.feedback(md5=OTHER) == []
+
+    db = sqlite3.connect(str(db))
+    assert db.execute("PRAGMA journal_mode").fetchone()[0] == 'wal'
+    assert sorted(db.execute("SELECT flag FROM upload_flags")) == [('Dno',), ('HPi',), ('LSi',)]
+    # NORMAL, not the default FULL
+    assert again.reader().execute("PRAGMA synchronous").fetchone()[0] == 1
+
+def test_writer_survives_errors(tmp_path):
+    events = store(tmp_path / 'events.sqlite')
+    insert = events.insert
+    def broken(db, rows):
+        events.insert = insert
+        raise RuntimeError('broken')
+    events.insert = broken
+    events.record_feedback(MD5, 'someone', 'R36S', 'lost')
+    # flush() returns although the batch failed
+    events.flush()
+    events.record_feedback(MD5, 'someone', 'R36S', 'kept')
+    events.flush()
+    assert [row['description'] for row in events.feedback()] == ['kept']
+    assert events.writer.is_alive()
+
+def test_full_queue_drops(tmp_path):
+    events = store(tmp_path / 'events.sqlite', max_queued=2)
+    start = events.start
+    # nothing writes until the queue is full
+    events.start = lambda: None
+    for i in range(3):
+        events.record_feedback(MD5, 'someone', 'R36S', str(i), when=i + 1)
+    assert events.stats()['dropped'] == 1
+    start()
+    events.flush()
+    assert [row['description'] for row in events.feedback()] == ['1', '0']
@@ -0,0 +1,75 @@
+import io
+
+import fdt
+
+from bench_dtbo import make_stock_dtb
+from overlay_cache import FailureCache
+from test_make_dtbos import without_native_mode
+
+
+def test_panel_failures_per_dno():
+    cache = FailureCache('v1', 100, 3600)
+    cache.put('md5', ['LSi'], 'bad_panel', "no native mode")
+    assert cache.get('md5', []) == ('bad_panel', "no native mode")
+    assert cache.get('md5', ['HPi']) == ('bad_panel', "no native mode")
+    assert cache.get('md5', ['Dno']) is None
+    assert cache.get('md5', ['Dno', 'LSi']) is None
+    cache.put('md5', ['Dno'], 'bad_init_sequence', "truncated")
+    assert cache.get('md5', ['Dno', 'HPi']) == ('bad_init_sequence', "truncated")
+    assert cache.get('md5', []) == ('bad_panel', "no native mode")
+
+def test_dtb_failures_for_all_flags():
+    cache = FailureCache('v1', 100, 3600)
+    for code in ('bad_dtb', 'no_symbols', 'no_dsi', 'no_panel', 'no_reset_gpio', 'no_compatible', 'limit_exceeded'):
+        cache.put(code, ['LSi'], code, "")
+        assert cache.get(code, []) == (code, "")
+        assert cache.get(code, ['Dno']) == (code, "")
+
+def test_version():
+    cache = FailureCache('v1', 100, 3600)
+    cache.put('md5', [], 'bad_dtb', "")
+    cache.version = 'v2'
+    assert cache.get('md5', []) is None
+
+def test_internal_ttl():
+    cache = FailureCache('v1', 100, 3600, internal_ttl=0)
+    cache.put('md5', [], 'internal', "KeyError")
+    assert cache.get('md5', []) is None
+    cache = FailureCache('v1', 100, 3600, internal_ttl=60)
+    cache.put('md5', [], 'internal', "KeyError")
+    assert cache.get('md5', ['Dno']) == ('internal', "KeyError")
+
+def test_max_entries():
+    cache = FailureCache('v1', 2, 3600)
+    for md5 in ('a', 'b', 'c'):
+        cache.put(md5, [], 'bad_dtb', "")
+    assert cache.get('a', []) is None
+    assert cache.get('c', []) is not None
+    assert cache.stats()['entries'] == 2
+
+
+def post(client, dtb, opts):
+    return client.post('/convert_dtb?silent=1&opts=' + opts, data={'file': (io.BytesIO(dtb), 'stock.dtb')})
+
+def test_dno_after_bad_panel(server):
+    client = server.app.test_client()
+    dtb = without_native_mode(make_stock_dtb(seed=50))
+    hits = server.failure_cache.stats()['hits'].get('bad_panel', 0)
+    response = post(client, dtb, '-LSi')
+    assert response.status_code == 422 and response.headers['x-dtbo-error'] == 'bad_panel'
+    # the workaround is not blocked by the failure without it
+    assert post(client, dtb, '-Dno-LSi').status_code == 200
+    assert post(client, dtb, '-Dno').status_code == 200
+    response = post(client, dtb, '')
+    assert response.status_code == 422 and response.headers['x-dtbo-error'] == 'bad_panel'
+    assert server.failure_cache.stats()['hits']['bad_panel'] == hits + 1
+
+def test_bad_dtb_for_all_flags(server):
+    client = server.app.test_client()
+    dt = fdt.parse_dtb(make_stock_dtb(seed=51))
+    dt.remove_node('__symbols__')
+    dtb = dt.to_dtb()
+    assert post(client, dtb, '').headers['x-dtbo-error'] == 'no_symbols'
+    hits = server.failure_cache.stats()['hits'].get('no_symbols', 0)
+    assert post(client, dtb, '-Dno').headers['x-dtbo-error'] == 'no_symbols'
+    assert server.failure_cache.stats()['hits']['no_symbols'] == hits + 1
@@ -0,0 +1,66 @@
+import logging, time, tracemalloc
+
+import pytest
+
+import rocknix_dtbo
+from bench_dtbo import make_hostile_corpus
+
+CORPUS = make_hostile_corpus()
+
+# what the crafted dtbs must end in, None for an overlay
+EXPECTED = {
+    'deep-nesting': 'limit_exceeded',
+    'many-nodes': 'limit_exceeded',
+    'many-props': 'no_symbols',
+    'many-timings': 'limit_exceeded',
+    'huge-vtotal': 'limit_exceeded',
+    'huge-htotal': 'limit_exceeded',
+    # a silly clock is still a clock, only the mode search must stay bounded
+    'huge-clock': None,
+    'long-init-sequence': 'limit_exceeded',
+    'truncated-init-sequence': 'bad_init_sequence',
+}
+# every code a corrupted dtb may end in
+CODES = {'bad_dtb', 'bad_init_sequence', 'bad_panel', 'limit_exceeded', 'no_compatible', 'no_dsi', 'no_panel',
+         'no_reset_gpio', 'no_symbols'}
+
+MAX_SECONDS = 1
+MAX_PEAK_BYTES = 16 * 1024 * 1024
+
+
+def convert(dtb):
+    """The error code of converting dtb, None if it converted."""
+    try:
+        rocknix_dtbo.make_dtbo(dtb, {'logger': logging.getLogger('dtbo'), 'limits': rocknix_dtbo.LIMITS, 'flags': []})
+    except rocknix_dtbo.ConversionError as e:
+        return e.code
+    return None
+
+def test_corpus_names():
+    assert set(EXPECTED) <= set(CORPUS)
+
+@pytest.mark.parametrize('name', sorted(EXPECTED))
+def test_crafted(name):
+    t0 = time.perf_counter()
+    assert convert(CORPUS[name]) == EXPECTED[name]
+    assert time.perf_counter() - t0 < MAX_SECONDS
+    tracemalloc.start()
+    try:
+        convert(CORPUS[name])
+        (_, peak) = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    assert peak < MAX_PEAK_BYTES
+
+def test_mutations():
+    codes = {}
+    for (name, dtb) in CORPUS.items():
+        if name in EXPECTED:
+            continue
+        t0 = time.perf_counter()
+        code = convert(dtb)
+        assert time.perf_counter() - t0 < MAX_SECONDS, name
+        assert code is None or code in CODES, (name, code)
+        codes[code] = codes.get(code, 0) + 1
+    # most corruption is caught while parsing
+    assert codes['bad_dtb'] > len(CORPUS) // 2
@@ -0,0 +1,104 @@
+import hashlib, io
+
+import pytest
+from werkzeug.http import parse_options_header
+from werkzeug.test import EnvironBuilder
+
+from bench_dtbo import make_stock_dtb
+from dtb_ingest import BadDtb, MultipartFile, ingest
+
+MAX_SIZE = 512 * 1024
+
+
+class CountingStream(io.BytesIO):
+    """Counts the bytes read from it."""
+    def __init__(self, data):
+        super().__init__(data)
+        self.count = 0
+
+    def read(self, size=-1):
+        data = super().read(size)
+        self.count += len(data)
+        return data
+
+def multipart(fields):
+    """(body, content type) of a multipart/form-data request."""
+    environ = EnvironBuilder(method='POST', data=fields).get_environ()
+    return (environ['wsgi.input'].read(), environ['CONTENT_TYPE'])
+
+def boundary(content_type):
+    return parse_options_header(content_type)[1]['boundary']
+
+
+def test_ingest():
+    dtb = make_stock_dtb(seed=90)
+    (content, md5) = ingest(io.BytesIO(dtb), MAX_SIZE)
+    assert content == dtb and md5 == hashlib.md5(dtb).hexdigest()
+
+@pytest.mark.parametrize('data', [b'', b'\xd0\x0d\xfe\xed', b'x' * 100, b'x' * (MAX_SIZE + 1)])
+def test_not_dtb(data):
+    with pytest.raises(BadDtb):
+        ingest(io.BytesIO(data), MAX_SIZE)
+
+def test_truncated():
+    dtb = make_stock_dtb(seed=91)
+    with pytest.raises(BadDtb, match='truncated'):
+        ingest(io.BytesIO(dtb[:-100]), MAX_SIZE)
+
+def test_multipart_file():
+    dtb = make_stock_dtb(seed=92)
+    (body, content_type) = multipart({'a': '1', 'file': (io.BytesIO(dtb), 'stock.dtb'), 'b': '2'})
+    for chunk_size in (100, 4096, 64 * 1024):
+        file = MultipartFile(io.BytesIO(body), boundary(content_type), chunk_size=chunk_size)
+        assert file.find() and file.filename == 'stock.dtb'
+        assert ingest(file, MAX_SIZE) == (dtb, hashlib.md5(dtb).hexdigest())
+
+def test_multipart_without_file():
+    (body, content_type) = multipart({'other': (io.BytesIO(b'x'), 'stock.dtb')})
+    assert not MultipartFile(io.BytesIO(body), boundary(content_type)).find()
+
+@pytest.mark.parametrize('cut', [10, 300, -10])
+def test_multipart_truncated(cut):
+    (body, content_type) = multipart({'file': (io.BytesIO(make_stock_dtb(seed=93)), 'stock.dtb')})
+    file = MultipartFile(io.BytesIO(body[:cut]), boundary(content_type))
+    with pytest.raises(BadDtb):
+        file.find()
+        ingest(file, MAX_SIZE)
+
+def test_bad_header_stops_reading():
+    (body, content_type) = multipart({'file': (io.BytesIO(b'x' * 400000), 'stock.dtb')})
+    stream = CountingStream(body)
+    file = MultipartFile(stream, boundary(content_type))
+    assert file.find()
+    with pytest.raises(BadDtb, match='bad magic'):
+        ingest(file, MAX_SIZE)
+    assert stream.count <= 64 * 1024
+
+
+def test_upload_bad_header_stops_reading(server):
+    (body, content_type) = multipart({'file': (io.BytesIO(b'x' * 400000), 'stock.dtb')})
+    stream = CountingStream(body)
+    response = server.app.test_client().post('/convert_dtb', input_stream=stream, content_type=content_type,
+                                              content_length=len(body))
+    assert response.status_code == 400
+    assert b'bad magic' in response.data
+    assert stream.count <= 64 * 1024
+
+def test_upload_form_fields(server, monkeypatch):
+    sent = []
+    monkeypatch.setattr(server, 'send_to_telegram', lambda message, params, coalesce=False: sent.append(message))
+    client = server.app.test_client()
+    dtb = make_stock_dtb(seed=94)
+    response = client.post('/convert_dtb', data={'silent': '1', 'file': (io.BytesIO(dtb), 'x.dtb')})
+    assert response.status_code == 200
+    assert response.data.startswith(b'\xd0\x0d\xfe\xed')
+    # silent counts in the query string only, the other form fields are ignored
+    assert len(sent) == 1 and 'x.dtb' in sent[0]
+    response = client.post('/convert_dtb?silent=1', data={'file': (io.BytesIO(make_stock_dtb(seed=95)), 'y.dtb')})
+    assert response.status_code == 200
+    assert len(sent) == 1
+
+def test_upload_without_file(server):
+    client = server.app.test_client()
+    assert client.post('/convert_dtb', data={'other': '1'}).data == b'No file part'
+    assert client.post('/convert_dtb', data=b'x', content_type='application/octet-stream').data == b'No file part'
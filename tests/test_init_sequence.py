@@ -0,0 +1,78 @@
+import logging
+
+import fdt
+import pytest
+
+import fdt_reader
+import init_sequence
+import rocknix_dtbo
+from bench_dtbo import make_corpus, make_stock_dtb
+from init_sequence import InitSequenceError
+
+
+def panels(dtb):
+    """The panel node of a dtb, as fdt_reader and as pyfdt parse it."""
+    path = next(node.path + '/' + node.name for node in fdt.parse_dtb(dtb).search('panel@0', fdt.ItemType.NODE))
+    return (fdt_reader.parse_dtb(dtb).get_node(path), fdt.parse_dtb(dtb).get_node(path))
+
+CORPUS = make_corpus()
+
+@pytest.mark.parametrize('name', sorted(CORPUS))
+def test_corpus_round_trip(name):
+    (lazy, node) = panels(CORPUS[name])
+    iseq = bytes(init_sequence.property_bytes(lazy))
+    assert bytes(init_sequence.property_bytes(node)) == iseq
+    commands = list(init_sequence.decode(iseq))
+    assert len(commands) >= 40
+    assert init_sequence.encode(commands) == iseq
+
+def test_words_round_trip():
+    # a length of a multiple of 4 makes pyfdt see u32 cells
+    iseq = bytes([0x15, 0, 1, 0x11, 0x39, 5, 2, 0xb0, 0x01, 0x05, 120, 0])
+    dt = fdt.parse_dtb(make_stock_dtb(seed=70))
+    [panel] = dt.search('panel@0', fdt.ItemType.NODE)
+    panel.set_property('panel-init-sequence', list(int.from_bytes(iseq[i:i + 4], 'big') for i in range(0, 12, 4)))
+    (lazy, node) = panels(dt.to_dtb())
+    assert isinstance(node.get_property('panel-init-sequence'), fdt.PropWords)
+    for panel in (lazy, node):
+        assert init_sequence.encode(init_sequence.decode(init_sequence.property_bytes(panel))) == iseq
+
+@pytest.mark.parametrize(('iseq', 'complete'), [
+    (bytes([0x05]), 0),
+    (bytes([0x05, 0]), 0),
+    (bytes([0x39, 0, 3, 1, 2]), 0),
+    (bytes([0x15, 0, 1, 0x11, 0x05]), 1),
+    (bytes([0x15, 0, 1, 0x11, 0x39, 0, 0xff]) + bytes(100), 1),
+])
+def test_truncated(iseq, complete):
+    decoded = []
+    with pytest.raises(InitSequenceError):
+        for command in init_sequence.decode(iseq):
+            decoded.append(command)
+    # the complete commands before it come out
+    assert len(decoded) == complete
+
+@pytest.mark.parametrize('command', [
+    (0x39, 0, bytes(256)),
+    (0x39, 256, b'\x01'),
+    (0x100, 0, b''),
+    (0x05, -1, b''),
+])
+def test_oversized(command):
+    with pytest.raises(InitSequenceError):
+        init_sequence.encode([command])
+
+def test_longest():
+    # the most one command holds
+    commands = [(0xff, 255, bytes(range(255))), (0x05, 255, b''), (0x15, 255, b'\x29')]
+    iseq = init_sequence.encode(commands)
+    assert len(iseq) == 3 + 255 + 3 + 4
+    assert [(cmd, wait, bytes(payload)) for (cmd, wait, payload) in init_sequence.decode(iseq)] == commands
+
+def test_max_wait_in_overlay():
+    dt = fdt.parse_dtb(make_stock_dtb(seed=71))
+    [panel] = dt.search('panel@0', fdt.ItemType.NODE)
+    panel.set_property('panel-init-sequence', bytes([0x05, 255, 1, 0x11, 0x39, 0, 2, 0x01, 0x02]))
+    dtbo = rocknix_dtbo.make_dtbo(dt.to_dtb(), {'logger': logging.getLogger('dtbo'), 'limits': rocknix_dtbo.LIMITS,
+                                                'flags': []})
+    assert b'I seq=11 wait=255\0I seq=0102\0' in dtbo
@@ -0,0 +1,78 @@
+import io, logging, zipfile
+
+import fdt
+
+import rocknix_dtbo
+from bench_dtbo import make_stock_dtb
+from convert_executor import make_dtbos_job
+
+FLAGSETS = [[], ['Dno'], ['LSi'], ['Dno', 'LSi']]
+
+
+def without_native_mode(dtb):
+    """A stock dtb whose panel only converts with Dno."""
+    dt = fdt.parse_dtb(dtb)
+    for node in dt.search('display-timings', fdt.ItemType.NODE):
+        node.remove_property('native-mode')
+    return dt.to_dtb()
+
+def args():
+    return {'logger': logging.getLogger('dtbo'), 'limits': rocknix_dtbo.LIMITS}
+
+
+def test_errors_per_flagset():
+    dtbos = rocknix_dtbo.make_dtbos(without_native_mode(make_stock_dtb(seed=40)), FLAGSETS, args())
+    assert [getattr(d, 'code', None) for d in dtbos] == ['bad_panel', None, 'bad_panel', None]
+    assert all(isinstance(d, bytes) for d in dtbos[1::2])
+    # the same overlays as for a single flag set
+    assert dtbos[1] == rocknix_dtbo.make_dtbo(without_native_mode(make_stock_dtb(seed=40)),
+                                              dict(args(), flags=['Dno']))
+
+def test_stock_errors_raise():
+    try:
+        rocknix_dtbo.make_dtbos(b'\0' * 100, FLAGSETS, args())
+    except rocknix_dtbo.ConversionError as e:
+        assert e.code == 'bad_dtb'
+    else:
+        assert False, "no ConversionError"
+
+def test_job():
+    (dtbos, _, _, reused) = make_dtbos_job(without_native_mode(make_stock_dtb(seed=41)), FLAGSETS)
+    assert [getattr(d, 'code', None) for d in dtbos] == ['bad_panel', None, 'bad_panel', None]
+    assert reused == [False] * len(FLAGSETS)
+
+def test_batch_manifest(tmp_path):
+    dtb = without_native_mode(make_stock_dtb(seed=42))
+    (tmp_path / 'stock.dtb').write_bytes(dtb)
+    entries = rocknix_dtbo.batch_job((str(tmp_path / 'stock.dtb'), 'md5', FLAGSETS, str(tmp_path)))
+    errors = {name: e['error'] for (name, e) in entries.items()}
+    assert errors['md5'].startswith('bad_panel: ')
+    assert errors['md5-LSi'].startswith('bad_panel: ')
+    assert errors['md5-Dno'] is None and errors['md5-Dno-LSi'] is None
+    assert (tmp_path / 'md5-Dno').read_bytes().startswith(b'\xd0\x0d\xfe\xed')
+
+def test_variants_zip(server):
+    client = server.app.test_client()
+    dtb = without_native_mode(make_stock_dtb(seed=43))
+    response = client.post('/convert_dtb?silent=1&variant=&variant=-Dno&variant=-Dno-LSi',
+                           data={'file': (io.BytesIO(dtb), 'stock.dtb')})
+    assert response.status_code == 200
+    with zipfile.ZipFile(io.BytesIO(response.data)) as z:
+        names = sorted(z.namelist())
+        errors = z.read('errors.txt').decode()
+    assert len(names) == 3 and 'errors.txt' in names
+    assert all(n.endswith('-Dno.dtbo') or n.endswith('-Dno-LSi.dtbo') for n in names if n != 'errors.txt')
+    assert 'bad_panel' in errors
+
+    response = client.post('/convert_dtb?silent=1&opts=-Dno', data={'file': (io.BytesIO(dtb), 'stock.dtb')})
+    assert response.status_code == 200
+    response = client.post('/convert_dtb?silent=1&opts=-LSi', data={'file': (io.BytesIO(dtb), 'stock.dtb')})
+    assert response.status_code == 422
+    assert response.headers['x-dtbo-error'] == 'bad_panel'
+
+def test_variants_all_failing(server):
+    client = server.app.test_client()
+    dtb = without_native_mode(make_stock_dtb(seed=44))
+    response = client.post('/convert_dtb?silent=1&variant=&variant=-LSi', data={'file': (io.BytesIO(dtb), 'stock.dtb')})
+    assert response.status_code == 422
+    assert response.headers['x-dtbo-error'] == 'bad_panel'
@@ -0,0 +1,94 @@
+import logging
+
+import fdt
+import pytest
+
+import rocknix_dtbo
+from bench_dtbo import make_corpus
+
+FLAGSETS = [[], ['LSi'], ['HPi'], ['Dno'], ['JPmm', 'RSi'], ['JPk36'], ['DR90'], ['LSi', 'RSi', 'HPi']]
+
+
+class PyfdtOverlay(fdt.FDT):
+    """The overlay as emit_dtbo() built it with pyfdt before OverlayWriter."""
+    def __init__(self):
+        super().__init__()
+        self.header.version = 17
+
+    def add_fragment(self, path):
+        for f in range(100):
+            nodename = 'fragment@' + str(f)
+            if self.exist_node(nodename):
+                pass
+            else:
+                fragnode = fdt.Node(nodename)
+                if path[0] == '&':
+                    fragnode.set_property('target', 0xffffffff)
+                    self.set_property(path[1:], '/'+nodename+':target:0', path='/__fixups__')
+                else:
+                    fragnode.set_property('target-path', path)
+                self.add_item(fragnode)
+                ovlnode = fdt.Node('__overlay__')
+                fragnode.append(ovlnode)
+                return ovlnode
+
+    def add_fixup(self, label, fixup_path):
+        if self.exist_node('__fixups__'):
+            fixups = self.get_node('__fixups__')
+        else:
+            fixups = fdt.Node('__fixups__')
+            self.add_item(fixups)
+        prev_paths = fixups.get_property(label)
+        if prev_paths:
+            fixups.set_property(label, prev_paths.data + [fixup_path])
+        else:
+            fixups.set_property(label, [fixup_path])
+
+    def add_local_fixup(self, parent_path, name):
+        self.set_property(name, 0, path='__local_fixups__'+parent_path)
+
+    def to_dtb(self):
+        # Move fixups to the very end (if any)
+        if self.exist_node('__fixups__'):
+            fixups = self.get_node('__fixups__')
+            self.remove_node('__fixups__')
+            self.add_item(fixups)
+
+        if self.exist_node('__local_fixups__'):
+            fixups = self.get_node('__local_fixups__')
+            self.remove_node('__local_fixups__')
+            self.add_item(fixups)
+        return super().to_dtb()
+
+
+@pytest.fixture(scope='module')
+def overlays():
+    """(name, flags) -> (OverlayWriter overlay, pyfdt overlay) over the corpus."""
+    args = {'logger': logging.getLogger('dtbo')}
+    results = {}
+    for (name, dtb) in make_corpus().items():
+        stock = rocknix_dtbo.analyze_dtb(dtb, dict(args, flags=[]))
+        for flags in FLAGSETS:
+            written = rocknix_dtbo.emit_dtbo(stock, dict(args, flags=flags))
+            with pytest.MonkeyPatch.context() as m:
+                m.setattr(rocknix_dtbo, 'OverlayWriter', PyfdtOverlay)
+                results[(name, '-'.join(flags))] = (written, rocknix_dtbo.emit_dtbo(stock, dict(args, flags=flags)))
+    return results
+
+def test_same_bytes(overlays):
+    for (key, (written, old)) in overlays.items():
+        assert written == old, key
+
+def test_cases_covered(overlays):
+    dts = {key: fdt.parse_dtb(old) for (key, (_, old)) in overlays.items()}
+    # volume keys, with the local fixup of their pinctrl-0
+    vol_keys = [key for (key, dt) in dts.items() if dt.exist_node('__local_fixups__')]
+    assert vol_keys
+    for key in vol_keys:
+        assert any(n.name == 'gpio-keys-overlay' for n in dts[key].search('gpio-keys-overlay', fdt.ItemType.NODE))
+    # the joypad fragment targets &joypad, My Mini adds the saradc fixups
+    for (key, dt) in dts.items():
+        fixups = dt.get_node('__fixups__')
+        assert fixups.exist_property('joypad'), key
+        if 'JPmm' in key[1]:
+            assert len(fixups.get_property('saradc').data) == 4, key
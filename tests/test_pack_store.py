@@ -0,0 +1,222 @@
+import multiprocessing, os
+
+import pytest
+
+import convert_executor
+from pack_store import PackStore, import_dirs, SEGMENT_MAGIC
+
+
+def values(n, size=100):
+    return {f'k{i}': bytes([i % 251]) * size for i in range(n)}
+
+def test_put_get_delete(tmp_path):
+    store = PackStore(str(tmp_path))
+    assert store.get('a') is None
+    assert store.put('a', b'one')
+    assert store.put('b', b'two' * 1000, 'zlib')
+    assert store.put('c', b'three', 'lzma')
+    assert bytes(store.get('a')) == b'one'
+    assert store.get('b') == b'two' * 1000
+    assert store.get('c') == b'three'
+    assert not store.put('a', b'other', replace=False)
+    assert store.put('a', b'uno')
+    assert bytes(store.get('a')) == b'uno'
+    extent = store.open('a')
+    assert extent.read() == b'uno' and extent.read() == b''
+    extent.close()
+    # compressed values have no extent to sendfile() from
+    assert store.open('b') is None
+    assert store.delete('b')
+    assert not store.delete('b')
+    assert 'b' not in store and store.get('b') is None
+    assert sorted(store.keys()) == ['a', 'c']
+    assert store.stats()['keys'] == 2
+
+def test_reopen(tmp_path):
+    store = PackStore(str(tmp_path), segment_bytes=4096)
+    data = values(100)
+    for (key, value) in data.items():
+        store.put(key, value)
+    store.delete('k0')
+    store.sync()
+    again = PackStore(str(tmp_path), segment_bytes=4096)
+    assert again.stats()['segments'] > 1
+    assert sorted(again.keys()) == sorted(key for key in data if key != 'k0')
+    for (key, value) in data.items():
+        assert again.get(key) == (None if key == 'k0' else value)
+
+def test_torn_tail(tmp_path):
+    store = PackStore(str(tmp_path))
+    store.put('a', b'one')
+    store.put('b', b'two')
+    store.sync()
+    path = store.segment_path(store.segments()[-1])
+    size = os.path.getsize(path)
+    with open(path, 'ab') as f:
+        # the start of a record header, as a killed writer leaves it
+        f.write(b'\x01\x00\x00')
+    again = PackStore(str(tmp_path))
+    assert os.path.getsize(path) == size
+    assert bytes(again.get('a')) == b'one' and bytes(again.get('b')) == b'two'
+    again.put('c', b'three')
+    assert bytes(PackStore(str(tmp_path)).get('c')) == b'three'
+
+def test_unindexed_records(tmp_path):
+    store = PackStore(str(tmp_path))
+    store.put('a', b'one')
+    store.sync()
+    index = tmp_path / 'index'
+    old = index.read_bytes()
+    store.put('b', b'two')
+    store.sync()
+    # a writer killed before its index update reached the disk
+    index.write_bytes(old)
+    again = PackStore(str(tmp_path))
+    assert bytes(again.get('b')) == b'two'
+    assert again.stats()['keys'] == 2
+
+def test_missing_index(tmp_path):
+    store = PackStore(str(tmp_path), segment_bytes=4096)
+    data = values(50)
+    for (key, value) in data.items():
+        store.put(key, value)
+    store.delete('k1')
+    store.put('k2', b'new')
+    store.sync()
+    os.unlink(tmp_path / 'index')
+    again = PackStore(str(tmp_path), segment_bytes=4096)
+    assert again.get('k1') is None
+    assert bytes(again.get('k2')) == b'new'
+    assert bytes(again.get('k3')) == data['k3']
+    assert again.stats()['keys'] == 49
+
+def test_corrupt_segment(tmp_path):
+    store = PackStore(str(tmp_path), segment_bytes=4096)
+    for (key, value) in values(50).items():
+        store.put(key, value)
+    store.sync()
+    with open(store.segment_path(1), 'r+b') as f:
+        f.seek(len(SEGMENT_MAGIC) + 20)
+        f.write(b'\xff' * 8)
+    os.unlink(tmp_path / 'index')
+    again = PackStore(str(tmp_path), segment_bytes=4096)
+    # the records after the damage in that segment are lost, the others not
+    assert again.get('k0') is None
+    assert bytes(again.get('k49')) == values(50)['k49']
+
+
+def serve(conn, directory):
+    store = convert_executor.open_store(directory)
+    while True:
+        (command, arg) = conn.recv()
+        if command == 'stop':
+            return
+        elif command == 'get':
+            value = store.get(arg)
+            conn.send(None if value is None else bytes(value))
+        elif command == 'keys':
+            conn.send(sorted(store.keys(arg)))
+        elif command == 'mapped':
+            conn.send(sorted(store.maps))
+        elif command == 'put':
+            conn.send(store.put(*arg))
+
+@pytest.fixture
+def other(tmp_path):
+    """Commands to a second process with the store open, like a conversion worker."""
+    ctx = multiprocessing.get_context('fork')
+    (conn, child_conn) = ctx.Pipe()
+    process = ctx.Process(target=serve, args=(child_conn, str(tmp_path)), daemon=True)
+    process.start()
+    child_conn.close()
+    def call(command, arg=None):
+        conn.send((command, arg))
+        return conn.recv()
+    yield call
+    # the child has its own copy of this end, it would never see EOF
+    conn.send(('stop', None))
+    conn.close()
+    process.join(10)
+
+def test_compact_while_mapped(tmp_path, other):
+    store = PackStore(str(tmp_path), segment_bytes=4096)
+    data = values(100)
+    for (key, value) in data.items():
+        store.put(key, value)
+    assert other('get', 'k0') == data['k0']
+    assert 1 in other('mapped')
+    # the first segments become garbage
+    for key in list(data)[:60]:
+        data[key] = b'new ' + key.encode()
+        store.put(key, data[key])
+    store.delete('k99')
+    del data['k99']
+    before = store.stats()
+    freed = store.compact()
+    assert freed > 0
+    assert store.stats()['compactions'] > before['compactions']
+    assert not os.path.exists(store.segment_path(1))
+    for (key, value) in data.items():
+        assert bytes(store.get(key)) == value
+        assert other('get', key) == value
+    assert other('keys', 'k') == sorted(data)
+    # the deleted segment is let go of
+    assert 1 not in other('mapped')
+    assert PackStore(str(tmp_path)).stats()['keys'] == len(data)
+
+def test_grown_index(tmp_path, other):
+    store = PackStore(str(tmp_path))
+    store.put('first', b'1')
+    assert other('keys', '') == ['first']
+    slots = store.stats()['index_slots']
+    data = values(slots)
+    for (key, value) in data.items():
+        store.put(key, value)
+    assert store.stats()['index_slots'] > slots
+    # the second process still has the old table mapped
+    assert other('keys', 'k') == sorted(data)
+    assert other('get', f'k{slots - 1}') == data[f'k{slots - 1}']
+    # and writes into the new one
+    assert other('put', ('second', b'2'))
+    assert bytes(store.get('second')) == b'2'
+
+def test_rebuilt_index(tmp_path, other):
+    store = PackStore(str(tmp_path))
+    for (key, value) in values(10).items():
+        store.put(key, value)
+    assert len(other('keys', '')) == 10
+    store.delete('k0')
+    with store.locked():
+        store.rebuild()
+    store.put('k10', b'ten')
+    assert other('keys', '') == sorted(['k10'] + [f'k{i}' for i in range(1, 10)])
+    assert other('get', 'k10') == b'ten'
+    assert other('get', 'k0') is None
+
+
+def test_import_dirs(tmp_path):
+    uploads = tmp_path / 'uploads'
+    uploads.mkdir()
+    md5 = 'a' * 32
+    (uploads / f'{md5}-rk3326-gameconsole-r36s.dtb').write_bytes(b'dtb one')
+    # the same dtb uploaded under another name
+    (uploads / f'{md5}-other.dtb').write_bytes(b'dtb one')
+    (uploads / f'{"b" * 32}-x.dtb').write_bytes(b'dtb two')
+    (uploads / 'README').write_bytes(b'not an upload')
+    for (directory, names) in (('dtbo', ['LSi.dtbo', 'LSi.dtbo.tmp']), ('fingerprint', ['f.dtbo'])):
+        version = tmp_path / directory / '3'
+        version.mkdir(parents=True)
+        for name in names:
+            (version / name).write_bytes(name.encode())
+    (tmp_path / 'dtbo' / 'stray').write_bytes(b'not a version')
+    store = PackStore(str(tmp_path / 'pack'))
+    added = import_dirs(store, str(uploads), str(tmp_path / 'dtbo'), str(tmp_path / 'fingerprint'), 'zlib')
+    assert added == {'dtb': 2, 'dtbo': 1, 'fingerprint': 1}
+    assert store.get(f'dtb/{md5}') == b'dtb one'
+    assert store.get(f'dtb/{"b" * 32}') == b'dtb two'
+    assert bytes(store.get('dtbo/3/LSi.dtbo')) == b'LSi.dtbo'
+    assert bytes(store.get('fingerprint/3/f.dtbo')) == b'f.dtbo'
+    assert sorted(store.keys('dtbo/')) == ['dtbo/3/LSi.dtbo']
+    # running it again adds nothing
+    assert import_dirs(store, str(uploads), str(tmp_path / 'dtbo'), str(tmp_path / 'fingerprint')) == {
+        'dtb': 0, 'dtbo': 0, 'fingerprint': 0}
@@ -0,0 +1,75 @@
+import math, random
+
+import pytest
+
+from rocknix_dtbo import Budget, LimitExceeded, absfrac, solve_mode
+
+COMMON_FPSS = [50/1.001, 50, 50.0070, 57.5, 59.7275, 60/1.001, 60, 60.0988, 75.47, 90, 120]
+
+# (clock kHz, htotal, vtotal) of modes like the stock dtbs have
+PANELS = [
+    (24000, 656, 522),
+    (33000, 780, 715),
+    (25000, 528, 520),
+    (49500, 1680, 500),
+    (67850, 1120, 1010),
+    (19000, 552, 540),
+]
+
+
+def brute_force(targetfps, clock, maxclock, htotal, vtotal, maxvtotal):
+    """The list comprehension solve_mode() replaced."""
+    options = [(absfrac(c*1000/targetfps/vt), c, vt)
+            for vt in range(vtotal, maxvtotal+1)
+            for c in range(clock, maxclock, 10)
+            if ((c*1000/targetfps/vt) >= htotal) and ((c*1000/targetfps/vt) < htotal*1.05) ]
+    return min(options) if options else None
+
+def mode_args(clock, htotal, vtotal, targetfps):
+    """solve_mode() arguments as panel_to_desc() picks them."""
+    perfectclock = targetfps*htotal*vtotal/1000
+    if clock < perfectclock or clock > 1.25*perfectclock:
+        clock = math.ceil(perfectclock/10)*10
+    return (targetfps, clock, round(1.25*perfectclock), htotal, vtotal, round(vtotal*1.25))
+
+
+@pytest.mark.parametrize('panel', PANELS)
+def test_panels(panel):
+    (clock, htotal, vtotal) = panel
+    for targetfps in [clock*1000/(htotal*vtotal)] + COMMON_FPSS:
+        args = mode_args(clock, htotal, vtotal, targetfps)
+        assert solve_mode(*args) == brute_force(*args), args
+
+def test_random_geometries():
+    rnd = random.Random(1)
+    for _ in range(1500):
+        htotal = rnd.randint(10, 300)
+        vtotal = rnd.randint(10, 300)
+        targetfps = rnd.choice([rnd.uniform(20, 130)] + COMMON_FPSS)
+        clock = rnd.randint(1, 3000) * 10
+        args = mode_args(clock, htotal, vtotal, targetfps)
+        assert solve_mode(*args) == brute_force(*args), args
+
+def test_narrow_windows():
+    # clock windows of a few steps, where solve_mode() takes every step
+    rnd = random.Random(2)
+    for _ in range(1500):
+        htotal = rnd.randint(10, 200)
+        vtotal = rnd.randint(10, 200)
+        targetfps = rnd.uniform(20, 130)
+        clock = math.ceil(targetfps*htotal*vtotal/10000)*10
+        args = (targetfps, clock, clock + 10*rnd.randint(0, 5), htotal, vtotal, vtotal + rnd.randint(0, 3))
+        assert solve_mode(*args) == brute_force(*args), args
+
+def test_no_mode():
+    # the clock window is below the htotal window
+    assert solve_mode(60, 1000, 1010, 600, 500, 510) is None
+    assert brute_force(60, 1000, 1010, 600, 500, 510) is None
+
+def test_budget():
+    args = mode_args(33000, 780, 715, 60)
+    with pytest.raises(LimitExceeded):
+        solve_mode(*args, Budget(10))
+    budget = Budget(10**6)
+    assert solve_mode(*args, budget) == brute_force(*args)
+    assert 0 < budget.left < 10**6
@@ -0,0 +1,70 @@
+import hashlib, io, threading
+
+import pytest
+
+from bench_dtbo import make_stock_dtb
+from speculator import Speculator
+
+
+class Cache:
+    def __init__(self):
+        self.entries = {}
+
+    def lookup(self, md5, flags):
+        return self.entries.get((md5, tuple(flags)))
+
+    def put(self, md5, flags, dtbo):
+        self.entries[(md5, tuple(flags))] = dtbo
+
+class Executor:
+    def __init__(self):
+        self.runs = []
+        self.done = threading.Event()
+
+    def idle_workers(self):
+        return 1
+
+    def run(self, key, job, content, missing):
+        self.runs.append(key)
+        self.done.set()
+        return ([b'dtbo'] * len(missing),)
+
+
+def speculator(executor, cache, **kwargs):
+    return Speculator(executor, cache, None, None, poll_interval=0.001, **kwargs)
+
+def test_schedules_popular():
+    (executor, cache) = (Executor(), Cache())
+    spec = speculator(executor, cache, variants=2, cpu_share=1)
+    for flags in (['LSi'], ['LSi'], ['HPi'], ['LSi'], ['Dno'], ['HPi']):
+        spec.record(flags)
+    spec.schedule('md5', b'', [['LSi']])
+    assert executor.done.wait(5)
+    spec.stop()
+    assert executor.runs == [('md5', (('HPi',), ('Dno',)))]
+    assert cache.lookup('md5', ['HPi']) == b'dtbo'
+
+@pytest.mark.parametrize('kwargs', [{'variants': 0}, {'cpu_share': 0}])
+def test_disabled(kwargs):
+    spec = speculator(Executor(), Cache(), **kwargs)
+    spec.record(['LSi'])
+    spec.schedule('md5', b'', [[]])
+    assert spec.stats()['scheduled'] == 0 and spec.worker is None
+
+@pytest.mark.parametrize('cpu_share', [-0.5, 1.5])
+def test_bad_cpu_share(cpu_share):
+    with pytest.raises(ValueError):
+        speculator(Executor(), Cache(), cpu_share=cpu_share)
+
+def test_fetches_count(server, monkeypatch):
+    monkeypatch.setattr(server, 'speculator', speculator(Executor(), Cache(), variants=0))
+    client = server.app.test_client()
+    dtb = make_stock_dtb(seed=80)
+    response = client.post('/convert_dtb?silent=1&opts=-LSi', data={'file': (io.BytesIO(dtb), 'stock.dtb')})
+    assert response.status_code == 200
+    name = hashlib.md5(dtb).hexdigest() + '-LSi'
+    for _ in range(3):
+        assert client.get('/dtbo/' + name).status_code == 200
+    client.head('/dtbo/' + name)
+    client.get('/dtbo/' + hashlib.md5(dtb).hexdigest() + '-NOPE')
+    assert dict(server.speculator.popularity) == {('LSi',): 4}
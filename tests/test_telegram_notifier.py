@@ -0,0 +1,84 @@
+import http.server, json, logging, threading, time
+
+import pytest
+
+from telegram_notifier import TelegramNotifier
+
+
+class Stub(http.server.ThreadingHTTPServer):
+    """Telegram's sendMessage, answering with the replies given, 200 after those."""
+    daemon_threads = True
+
+    def __init__(self):
+        self.replies = []
+        self.posts = []
+        super().__init__(('127.0.0.1', 0), Handler)
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    def do_POST(self):
+        payload = json.loads(self.rfile.read(int(self.headers['content-length'])))
+        self.server.posts.append((time.monotonic(), self.path, payload))
+        (status, body) = self.server.replies.pop(0) if self.server.replies else (200, {'ok': True, 'result': {}})
+        body = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('content-type', 'application/json')
+        self.send_header('content-length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture
+def stub():
+    server = Stub()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+def notifier(stub, chats=(1,), **kwargs):
+    return TelegramNotifier('KEY', list(chats), logging.getLogger('test'),
+                            base_url=f'http://127.0.0.1:{stub.server_address[1]}', backoff=0.01, **kwargs)
+
+def wait_for(notifier, **stats):
+    deadline = time.monotonic() + 10
+    while any(notifier.stats()[name] < value for (name, value) in stats.items()):
+        assert time.monotonic() < deadline, notifier.stats()
+        time.sleep(0.01)
+
+def test_delivery(stub):
+    tg = notifier(stub, chats=(1, 2))
+    assert tg.notify('hello', {'disable_notification': True})
+    wait_for(tg, sent=2)
+    assert [path for (_, path, _) in stub.posts] == ['/botKEY/sendMessage'] * 2
+    assert [payload for (_, _, payload) in stub.posts] == [
+        {'chat_id': chat, 'text': 'hello', 'parse_mode': 'Markdown', 'disable_notification': True} for chat in (1, 2)]
+    assert tg.stats()['failed'] == 0
+
+def test_retry_after(stub):
+    stub.replies = [(429, {'ok': False, 'error_code': 429, 'parameters': {'retry_after': 1}})]
+    tg = notifier(stub)
+    tg.notify('hello', {})
+    wait_for(tg, sent=1)
+    [(first, _, _), (second, _, payload)] = stub.posts
+    # the delay Telegram asked for, not the backoff
+    assert second - first >= 1
+    assert payload['text'] == 'hello'
+
+def test_client_error_not_retried(stub):
+    stub.replies = [(400, {'ok': False, 'error_code': 400, 'description': 'Bad Request'})]
+    tg = notifier(stub)
+    tg.notify('hello', {})
+    wait_for(tg, failed=1)
+    assert len(stub.posts) == 1
+
+def test_coalesced(stub):
+    tg = notifier(stub, coalesce_delay=0.3)
+    for name in ('a', 'b', 'c'):
+        tg.notify(f'new overlay {name}', {}, coalesce=True)
+    tg.notify('feedback', {})
+    wait_for(tg, sent=2)
+    assert [payload['text'] for (_, _, payload) in stub.posts] == [
+        '3 notifications:\nnew overlay a\nnew overlay b\nnew overlay c', 'feedback']
+    assert tg.stats()['coalesced'] == 2